@@ -0,0 +1,130 @@
+# app_metrics.py
+import os
+
+from config import DATA_FILE_PATH, JOURNAL_FILE_PATH, SNAPSHOT_FILE_PATH, \
+                   SQLITE_DB_PATH
+from metrics import Counter, Gauge
+from request_index import STATUS_GROUPS
+from render_cache import render_cache
+from locks import request_locks
+from outbound import scheduler as outbound_scheduler, PRIORITY_NAMES
+from message_updates import message_updater
+from idempotency import idempotency_cache
+from ingest import ingest_queue
+from routing import escalations
+from logs import log_setup
+from tracing import tracer
+import utils
+
+DATA_FILES = (DATA_FILE_PATH, JOURNAL_FILE_PATH, SNAPSHOT_FILE_PATH,
+              SQLITE_DB_PATH, f"{SQLITE_DB_PATH}-wal")
+
+
+def _gauge(name, help_text, value, labels=(), label_values=()):
+    gauge = Gauge(name, help_text, labels)
+    gauge.set(value, *label_values)
+    return gauge
+
+
+def _counter(name, help_text, value):
+    counter = Counter(name, help_text)
+    counter.inc(amount=value)
+    return counter
+
+
+async def collect_requests():
+    keys = [("open", ), *(("status", group) for group in STATUS_GROUPS)]
+    open_count, *status_counts = await utils.count_requests(keys)
+    by_status = Gauge("tgbot_requests", "Requests in the working set by status group.",
+                      ("status", ))
+    for group, count in zip(STATUS_GROUPS, status_counts):
+        by_status.set(count, group)
+    files = Gauge("tgbot_data_file_bytes", "Size of the storage files.",
+                  ("file", ))
+    for path in DATA_FILES:
+        try:
+            files.set(os.path.getsize(path), path)
+        except OSError:
+            pass
+    archive = utils.archive_stats()
+    storage = utils.storage_stats()
+    return [
+        by_status,
+        _gauge("tgbot_open_requests", "Requests not finished yet.",
+               open_count),
+        files,
+        _gauge("tgbot_archived_requests", "Requests in the archive index.",
+               archive["indexed"]),
+        _counter("tgbot_archive_lookups_total", "Archive lookups.",
+                 archive["lookups"]),
+        _gauge("tgbot_storage_pending_writes", "Changes queued for writing.",
+               storage["pending_writes"]),
+    ]
+
+
+def collect_components():
+    render = render_cache.stats()
+    locks = request_locks.stats()
+    outbound = outbound_scheduler.stats()
+    idempotency = idempotency_cache.stats()
+    logs = log_setup.stats()
+    traces = tracer.stats()
+    queued = Gauge("tgbot_outbound_queued", "API calls waiting for a rate limit slot.",
+                   ("priority", ))
+    sent = Counter("tgbot_outbound_sent_total", "API calls let through the scheduler.",
+                   ("priority", ))
+    for name in PRIORITY_NAMES.values():
+        queued.set(outbound[name]["queued"], name)
+        sent.inc(name, amount=outbound[name]["sent"])
+    return [
+        _counter("tgbot_render_cache_hits_total", "Request texts served from the cache.",
+                 render["hits"]),
+        _counter("tgbot_render_cache_misses_total", "Request texts rendered.",
+                 render["misses"]),
+        _counter("tgbot_lock_contended_total", "Request lock acquisitions that waited.",
+                 locks["contended"]),
+        _gauge("tgbot_lock_wait_max_seconds", "Longest request lock wait.",
+               locks["wait_max"]),
+        queued,
+        sent,
+        _counter("tgbot_outbound_retried_total", "API calls retried after a 429.",
+                 outbound["retried"]),
+        _counter("tgbot_edits_sent_total", "Request message edits sent.",
+                 message_updater.edits_sent),
+        _counter("tgbot_edits_skipped_total", "Edits skipped, message already current.",
+                 message_updater.edits_skipped),
+        _counter("tgbot_idempotent_hits_total", "Repeated form submissions.",
+                 idempotency["hits"]),
+        _gauge("tgbot_ingest_queued", "Notifications waiting in the ingest queue.",
+               ingest_queue.qsize()),
+        _counter("tgbot_ingest_failed_total", "Failed notification attempts in the ingest queue.",
+                 ingest_queue.failed),
+        _counter("tgbot_ingest_given_up_total", "Queued notifications left for the next start.",
+                 ingest_queue.given_up),
+        _gauge("tgbot_escalations_pending", "Requests waiting for escalation.",
+               len(escalations)),
+        _counter("tgbot_log_records_dropped_total", "Log records dropped, queue full.",
+                 logs["dropped"]),
+        _counter("tgbot_log_records_suppressed_total",
+                 "Repetitive log records dropped by sampling.", logs["suppressed"]),
+        _counter("tgbot_traces_written_total", "Traces kept by sampling.",
+                 traces["written"]),
+        _counter("tgbot_traces_discarded_total", "Traces dropped by sampling.",
+                 traces["discarded"]),
+    ]
+
+
+def collect_webhook(handler):
+    """Collector for a PooledRequestHandler."""
+
+    def collect():
+        return [
+            _gauge("tgbot_webhook_in_flight", "Updates being processed.",
+                   handler.in_flight),
+            _counter("tgbot_webhook_duplicates_total", "Redelivered updates dropped.",
+                     handler.duplicates),
+            _counter("tgbot_webhook_failed_total", "Updates whose handling failed.",
+                     handler.failed),
+        ]
+
+    return collect
@@ -0,0 +1,212 @@
+# archive.py
+import asyncio
+import copy
+import gzip
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ARCHIVE_DIR, ARCHIVE_CACHE_SEGMENTS
+from records import json_default, to_record
+
+
+def segment_name(req_data):
+    """Segment (date of the last update) a request is archived into."""
+    timestamp = req_data.get("last_updated_timestamp") or \
+        req_data.get("form_timestamp") or ""
+    return timestamp[:10] if len(timestamp) >= 10 else "undated"
+
+
+class RequestArchive:
+    """Cold storage for requests that are finished and no longer change.
+
+    Records are appended to gzip segments `<dir>/<YYYY-MM-DD>.jsonl.gz`
+    (every append adds a gzip member, so files are never rewritten) and
+    `<dir>/index.jsonl` maps request ids to their segment. Only the index is
+    kept in memory; segments are decoded on lookup and the last few stay in
+    an LRU. All file access runs on one worker thread.
+    """
+
+    def __init__(self, path=ARCHIVE_DIR, cache_segments=ARCHIVE_CACHE_SEGMENTS):
+        self.path = path
+        self.index_path = os.path.join(path, "index.jsonl")
+        self.cache_segments = cache_segments
+        self._index = {}  # req_id -> segment name
+        self._index_offset = 0  # Bytes of index.jsonl already read
+        self._segments = OrderedDict()  # segment name -> {req_id: data}
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="archive")
+        # Metrics
+        self.archived = 0
+        self.lookups = 0
+        self.segment_loads = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, req_id):
+        return int(req_id) in self._index
+
+    def _segment_path(self, name):
+        return os.path.join(self.path, f"{name}.jsonl.gz")
+
+    def _read_index(self):
+        """Applies index lines written since the last read (also by other
+        processes)."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'):
+                    break  # Being written right now, read it next time
+                self._index_offset += len(raw_line)
+                try:
+                    entry = json.loads(raw_line)
+                    req_id, name = int(entry["id"]), entry["seg"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if name is None:
+                    self._index.pop(req_id, None)
+                else:
+                    self._index[req_id] = sys.intern(name)
+
+    def _read_segment(self, name):
+        records = {}
+        try:
+            with gzip.open(self._segment_path(name), 'rt',
+                           encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    records[int(record["id"])] = record["data"]  # Last one wins
+        except FileNotFoundError:
+            logging.error(f"Archive segment {name} is missing.")
+        except (EOFError, OSError, ValueError) as e:
+            # Torn member after a crash; keep what was readable
+            logging.error(f"Archive segment {name} is damaged: {e}")
+        self.segment_loads += 1
+        return records
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._read_index()
+
+    def _append(self, items):
+        by_segment = {}
+        for req_id, req_data in items:
+            by_segment.setdefault(segment_name(req_data), []).append(
+                (int(req_id), req_data))
+        for name, records in by_segment.items():
+            lines = "".join(
+                json.dumps({"id": req_id, "data": req_data},
+                           ensure_ascii=False,
+                           default=json_default) + '\n'
+                for req_id, req_data in records)
+            with open(self._segment_path(name), 'ab') as f:
+                f.write(gzip.compress(lines.encode('utf-8')))
+                f.flush()
+                os.fsync(f.fileno())
+            self._segments.pop(name, None)
+        # Index last: an id is only "archived" once its record is on disk
+        self._write_index([(req_id, name)
+                           for name, records in by_segment.items()
+                           for req_id, _ in records])
+
+    def _write_index(self, entries):
+        self._read_index()  # Stay in sync with other writers
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.writelines(
+                json.dumps({"id": req_id, "seg": name}) + '\n'
+                for req_id, name in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        self._read_index()
+
+    def _get(self, req_id):
+        name = self._index.get(req_id)
+        if name is None:
+            self._read_index()  # Maybe archived by another process
+            name = self._index.get(req_id)
+            if name is None:
+                return None
+        records = self._segments.get(name)
+        if records is None or req_id not in records:
+            records = self._read_segment(name)
+            self._segments[name] = records
+        self._segments.move_to_end(name)
+        while len(self._segments) > self.cache_segments:
+            self._segments.popitem(last=False)
+        return records.get(req_id)
+
+    def _segment_names(self, first_segment):
+        """Dated segments from `first_segment` on, plus "undated" if there is
+        no start."""
+        self._read_index()
+        return sorted({
+            name for name in self._index.values()
+            if name >= first_segment and (name != "undated" or not first_segment)
+        })
+
+    def _live_records(self, name):
+        """Records of a segment whose latest archived copy is in it (and that
+        weren't restored since)."""
+        return [(req_id, req_data)
+                for req_id, req_data in self._read_segment(name).items()
+                if self._index.get(req_id) == name]
+
+    def _records_since(self, first_segment):
+        return [record for name in self._segment_names(first_segment)
+                for record in self._live_records(name)]
+
+    async def load(self):
+        await self._run(self._load)
+        logging.info(
+            f"Archive index loaded: {len(self._index)} requests in {self.path}")
+
+    async def append(self, items):
+        """Archives (req_id, data) pairs. Returns once they are on disk."""
+        if items:
+            await self._run(self._append, list(items))
+            self.archived += len(items)
+
+    async def get(self, req_id):
+        """Returns an archived request (a fresh RequestRecord), or None."""
+        self.lookups += 1
+        req_data = await self._run(self._get, int(req_id))
+        return to_record(copy.deepcopy(req_data)) if req_data is not None else None
+
+    async def records_since(self, first_segment):
+        """Returns (req_id, data) of the requests archived in segments from
+        `first_segment` ("YYYY-MM-DD") on, without caching them."""
+        return await self._run(self._records_since, first_segment)
+
+    async def iter_segments(self, first_segment=""):
+        """Async-yields the (req_id, data) pairs of one segment at a time,
+        see _segment_names."""
+        for name in await self._run(self._segment_names, first_segment):
+            records = await self._run(self._live_records, name)
+            if records:
+                yield records
+
+    async def forget(self, req_id):
+        """Drops a request from the index (it went back to the working set)."""
+        await self._run(self._write_index, [(int(req_id), None)])
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "indexed": len(self._index),
+            "archived": self.archived,
+            "lookups": self.lookups,
+            "segment_loads": self.segment_loads,
+            "cached_segments": len(self._segments),
+        }
@@ -0,0 +1,236 @@
+# batch_intake.py
+import asyncio
+import codecs
+import json
+import logging
+
+from aiohttp import web
+
+from config import FORM_SECRET, BATCH_CHUNK_SIZE, BATCH_MAX_ITEM_BYTES, INGEST_MODE
+from bot_handlers import build_request_data, client_data_from_form, notify_new_request
+from fanout import fan_out
+from idempotency import idempotency_cache, idempotency_key
+from ingest import ingest_queue
+from stats import request_stats
+import utils
+
+
+class BatchParseError(ValueError):
+    pass
+
+
+async def iter_ndjson(stream):
+    """Yields one decoded object per non-empty line of an NDJSON body."""
+    async for raw_line in stream:
+        line = raw_line.strip()
+        if not line:
+            continue
+        if len(line) > BATCH_MAX_ITEM_BYTES:
+            raise BatchParseError("item too large")
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise BatchParseError(f"invalid JSON line: {e}") from None
+
+
+async def iter_json_array(stream, chunk_size=65536):
+    """Yields the elements of a top-level JSON array as they arrive.
+
+    Only the current element is buffered, never the whole body.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = stream.iter_chunked(chunk_size)
+    buf = ""
+    pos = 0
+    eof = False
+
+    async def more():
+        nonlocal buf, pos, eof
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+            pos = 0
+            eof = True
+            return
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+    async def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            await more()
+
+    await skip_ws()
+    if pos >= len(buf) or buf[pos] != "[":
+        raise BatchParseError("expected a JSON array")
+    pos += 1
+    await skip_ws()
+    if pos < len(buf) and buf[pos] == "]":
+        return
+    while True:
+        while True:
+            await skip_ws()
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError as e:
+                if eof or len(buf) - pos > BATCH_MAX_ITEM_BYTES:
+                    raise BatchParseError(f"invalid array item: {e}") from None
+                await more()
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(buf) and not eof:
+                await more()
+                continue
+            break
+        pos = end
+        yield item
+        await skip_ws()
+        if pos >= len(buf):
+            raise BatchParseError("unterminated JSON array")
+        if buf[pos] == "]":
+            return
+        if buf[pos] != ",":
+            raise BatchParseError(f"unexpected {buf[pos]!r} in JSON array")
+        pos += 1
+
+
+async def _process_chunk(bot, chunk):
+    """Creates the requests of one chunk, returns per-item result dicts."""
+    results = []
+    new_items = []  # (result dict, key, client_data)
+    seen_keys = {}  # key -> result of its first item in this chunk
+    repeats = []  # (result, first result) for repeats within the chunk
+    for index, raw_item in chunk:
+        client_data = client_data_from_form(raw_item)
+        if client_data is None:
+            results.append({
+                "index": index,
+                "status": "error",
+                "message": "Missing required fields"
+            })
+            continue
+        header_key = raw_item.get("idempotency_key")
+        key = idempotency_key(header_key, client_data)
+        if key in seen_keys:
+            result = {"index": index, "status": "duplicate"}
+            repeats.append((result, seen_keys[key]))
+            results.append(result)
+            continue
+        existing_id = await idempotency_cache.claim(key)
+        if existing_id is not None:
+            results.append({
+                "index": index,
+                "status": "duplicate",
+                "request_id": existing_id
+            })
+            continue
+        result = {"index": index, "status": "ok"}
+        seen_keys[key] = result
+        new_items.append((result, key, client_data))
+        results.append(result)
+
+    if not new_items:
+        return results
+
+    # One storage operation for the ids, one for the records
+    try:
+        first_id = await utils.allocate_request_ids(len(new_items))
+        records = []
+        for offset, (result, key, client_data) in enumerate(new_items):
+            req_id = first_id + offset
+            result["request_id"] = req_id
+            records.append((req_id, build_request_data(req_id, client_data)))
+        await utils.save_many_request_data(records)
+        await utils.flush_data()
+    except BaseException:
+        for _, key, _ in new_items:  # Claimed above, a retry may create them
+            await asyncio.shield(idempotency_cache.release(key))
+        raise
+    for result, first_result in repeats:
+        result["request_id"] = first_result["request_id"]
+    for _, req_data in records:
+        request_stats.record_created(req_data)
+    for (result, key, _), (req_id, _) in zip(new_items, records):
+        await idempotency_cache.put(key, req_id)
+
+    # Queue the notifications if possible, the rest go out through the
+    # (rate limited) fan-out right away
+    to_notify = records
+    if INGEST_MODE == "queue":
+        to_notify = [(req_id, req_data) for req_id, req_data in records
+                     if not ingest_queue.submit(req_id)]
+    notify_results = await fan_out(
+        to_notify, lambda record: notify_new_request(bot, *record))
+    for (req_id, _), outcome in zip(to_notify, notify_results):
+        if isinstance(outcome, BaseException):
+            logging.error("Failed to notify batch request #%s: %r", req_id,
+                          outcome, extra={"req_id": req_id})
+    logging.info("Batch chunk: created requests #%s-#%s", first_id,
+                 first_id + len(records) - 1)
+    return results
+
+
+async def handle_form_batch(request: web.Request):
+    """Bulk import: a JSON array or NDJSON body of form payloads.
+
+    Streams back one NDJSON result line per item in input order. Items are
+    processed in chunks of BATCH_CHUNK_SIZE, each getting a contiguous block
+    of request ids.
+    """
+    bot_instance = request.app['bot']
+    received_secret = request.headers.get("X-Form-Secret")
+    if not received_secret or received_secret != FORM_SECRET:
+        logging.warning("Batch submission rejected: Invalid/missing secret.")
+        return web.Response(status=403, text="Forbidden: Invalid Secret")
+
+    if request.content_type in ("application/x-ndjson", "application/jsonl"):
+        items = iter_ndjson(request.content)
+    else:
+        items = iter_json_array(request.content)
+
+    response = web.StreamResponse(
+        headers={"Content-Type": "application/x-ndjson; charset=utf-8"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    async def write_results(results):
+        await response.write("".join(
+            json.dumps(result, ensure_ascii=False) + "\n"
+            for result in results).encode("utf-8"))
+
+    chunk = []
+    index = 0
+    try:
+        async for raw_item in items:
+            chunk.append((index, raw_item))
+            index += 1
+            if len(chunk) >= BATCH_CHUNK_SIZE:
+                await write_results(await _process_chunk(bot_instance, chunk))
+                chunk = []
+        if chunk:
+            await write_results(await _process_chunk(bot_instance, chunk))
+            chunk = []
+    except BatchParseError as e:
+        logging.error("Batch submission stopped at item %s: %s", index, e)
+        if chunk:  # Items parsed before the error are still imported
+            await write_results(await _process_chunk(bot_instance, chunk))
+        await write_results([{
+            "index": index,
+            "status": "error",
+            "message": f"Invalid payload: {e}"
+        }])
+    except Exception:
+        logging.exception("Error handling batch submission:")
+        await write_results([{
+            "index": index,
+            "status": "error",
+            "message": "Internal server error"
+        }])
+    await response.write_eof()
+    return response
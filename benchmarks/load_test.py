@@ -0,0 +1,453 @@
+# benchmarks/load_test.py
+"""End-to-end load test of main.py against a local stand-in for the Bot API.
+
+Starts a fake Bot API server (configurable latency, 429 and failure rates),
+runs main.py in a temporary directory pointed at it (TELEGRAM_API_BASE), then
+submits forms to /formsubmit and walks every created request through
+claim -> updateStatus -> complete with synthetic webhook callback updates.
+
+Reports throughput and p50/p99 latency of form submissions (HTTP response)
+and callbacks (webhook POST until the bot answers the callback query),
+outbound API calls by method, and how much the data files were written.
+
+Usage:
+  python benchmarks/load_test.py [--requests 200] [--concurrency 20]
+      [--api-latency 0.05] [--rate-429 0.0] [--failure-rate 0.0]
+      [--env KEY=VALUE ...] [--json]
+      [--save-baseline FILE | --compare FILE [--tolerance 0.2]]
+
+The fake API has no per-chat limits, so the bot's outbound pacing is opened
+up (PACING_ENV); pass e.g. --env OUTBOUND_CHAT_RATE=1 to measure with
+Telegram's real limits instead (all synthetic traffic goes to the same
+managers, so throughput is then bounded by the per-chat rate).
+
+--compare exits with status 1 if throughput dropped, p99 latency, API calls
+or bytes written per request grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import MANAGERS, STATUS_WILL_COME  # noqa: E402
+
+BOT_TOKEN = "123456:LOADTEST"
+FORM_SECRET = "load-test-secret"
+PACING_ENV = {
+    "OUTBOUND_GLOBAL_RATE": "100000",
+    "OUTBOUND_CHAT_RATE": "100000",
+    "OUTBOUND_CHAT_BURST": "100000",
+}
+
+
+# --- Fake Bot API ---
+class FakeBotAPI:
+    """aiohttp stand-in for api.telegram.org.
+
+    Every call waits ~`latency` seconds; a `rate_429` share is answered with
+    a flood-control error and a `failure_rate` share with a server error.
+    """
+
+    def __init__(self, latency=0.05, rate_429=0.0, failure_rate=0.0,
+                 retry_after=1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.calls = {}  # method -> successful calls
+        self.injected_429 = 0
+        self.injected_failures = 0
+        self._message_ids = itertools.count(1)
+        self._answered = {}  # callback query id -> future
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def wait_answer(self, callback_id):
+        future = asyncio.get_running_loop().create_future()
+        self._answered[callback_id] = future
+        return future
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {
+                "id": int(params.get("chat_id", 0)),
+                "type": "private"
+            },
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        roll = random.random()
+        if roll < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description":
+                    f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {
+                        "retry_after": self.retry_after
+                    }
+                },
+                status=429)
+        if roll < self.rate_429 + self.failure_rate:
+            self.injected_failures += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 500,
+                    "description": "Internal Server Error"
+                },
+                status=500)
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Load Test",
+                      "username": "load_test_bot"}
+        elif method == "getwebhookinfo":
+            result = {"url": "", "has_custom_certificate": False,
+                      "pending_update_count": 0}
+        elif method in ("sendmessage", "editmessagetext",
+                        "editmessagereplymarkup"):
+            result = self._message(params)
+        else:  # setWebhook, deleteWebhook, answerCallbackQuery, ...
+            result = True
+        if method == "answercallbackquery":
+            future = self._answered.pop(params.get("callback_query_id"), None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+        return web.json_response({"ok": True, "result": result})
+
+
+# --- Driving the bot ---
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(latencies, elapsed):
+    return {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+class LoadTest:
+
+    def __init__(self, args, fake_api, bot_url):
+        self.args = args
+        self.fake_api = fake_api
+        self.bot_url = bot_url
+        self.manager_id = int(next(iter(MANAGERS)))
+        self._update_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self.form_latencies = []
+        self.callback_latencies = []
+        self.errors = {}
+
+    def _error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    async def submit_form(self, session, i):
+        payload = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "name": f"Load Client {i}",
+            "phone": f"+37529{i:07d}",
+            "messenger": f"@load{i}",
+            "details": "Выпускны, Дзень нараджэння",
+        }
+        started = time.perf_counter()
+        async with session.post(f"{self.bot_url}/formsubmit",
+                                json=payload,
+                                headers={"X-Form-Secret": FORM_SECRET}) as resp:
+            body = await resp.json(content_type=None)
+        if resp.status not in (200, 202):
+            self._error(f"formsubmit {resp.status}")
+            return None
+        self.form_latencies.append(time.perf_counter() - started)
+        return body["request_id"]
+
+    async def press(self, session, data):
+        callback_id = str(next(self._callback_ids))
+        update = {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": callback_id,
+                "from": {"id": self.manager_id, "is_bot": False,
+                         "first_name": "Load"},
+                "chat_instance": "load",
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": self.manager_id, "type": "private"},
+                    "text": "request",
+                },
+            },
+        }
+        answered = self.fake_api.wait_answer(callback_id)
+        started = time.perf_counter()
+        async with session.post(f"{self.bot_url}/webhook/{BOT_TOKEN}",
+                                json=update) as resp:
+            await resp.read()
+        try:
+            finished = await asyncio.wait_for(answered, self.args.timeout)
+        except asyncio.TimeoutError:
+            self._error(f"callback timeout ({data.split('|')[0]})")
+            return
+        self.callback_latencies.append(finished - started)
+
+    async def walk_request(self, session, i):
+        req_id = await self.submit_form(session, i)
+        if req_id is None:
+            return
+        await self.press(session, f"claim|{req_id}|{self.manager_id}")
+        await self.press(session, f"updateStatus|{req_id}|{STATUS_WILL_COME}")
+        await self.press(session, f"complete|{req_id}")
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(session, i):
+            async with semaphore:
+                try:
+                    await self.walk_request(session, i)
+                except Exception as e:
+                    self._error(type(e).__name__)
+
+        async with ClientSession() as session:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(session, i)
+                                   for i in range(self.args.requests)))
+            return time.perf_counter() - started
+
+
+# --- The bot process ---
+def start_bot(workdir, api_port, bot_port, extra_env):
+    env = dict(os.environ,
+               BOT_TOKEN=BOT_TOKEN,
+               FORM_SECRET=FORM_SECRET,
+               TELEGRAM_API_BASE=f"http://127.0.0.1:{api_port}",
+               PORT=str(bot_port),
+               ARCHIVE_AFTER_DAYS="0",
+               STATS_DIGEST_TIME="",
+               PYTHONUNBUFFERED="1",
+               **PACING_ENV)
+    env.update(extra_env)
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")],
+                            cwd=workdir,
+                            env=env,
+                            stdout=open(os.path.join(workdir, "bot.log"), "w"),
+                            stderr=subprocess.STDOUT)
+
+
+async def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("main.py exited during start-up, see bot.log")
+            try:
+                async with session.get(f"{url}/metrics") as resp:
+                    if resp.status == 200:
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("main.py did not start in time")
+
+
+def io_written(pid):
+    """Bytes the process wrote to storage (Linux), or None."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def data_file_bytes(workdir):
+    return sum(entry.stat().st_size
+               for entry in os.scandir(workdir)
+               if entry.is_file() and entry.name != "bot.log")
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run(args):
+    fake_api = FakeBotAPI(args.api_latency, args.rate_429, args.failure_rate)
+    runner = web.AppRunner(fake_api.app)
+    await runner.setup()
+    api_port, bot_port = free_port(), free_port()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    workdir = tempfile.mkdtemp(prefix="tgbot-load-")
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    process = start_bot(workdir, api_port, bot_port, extra_env)
+    bot_url = f"http://127.0.0.1:{bot_port}"
+    try:
+        await wait_until_up(bot_url, process)
+        written_before = io_written(process.pid)
+        fake_api.calls.clear()
+        test = LoadTest(args, fake_api, bot_url)
+        elapsed = await test.run()
+        written_after = io_written(process.pid)
+    finally:
+        # Waited for on a thread: the fake API on this loop has to answer the
+        # bot's shutdown calls (pending edits, delete_webhook)
+        process.send_signal(signal.SIGINT)
+        try:
+            exit_code = await asyncio.to_thread(process.wait, 30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            await asyncio.to_thread(process.wait)
+            exit_code = None
+        await runner.cleanup()
+    if exit_code != 0:
+        print(f"Bot did not shut down cleanly (exit code {exit_code}), "
+              f"see {workdir}/bot.log", file=sys.stderr)
+
+    api_calls = dict(sorted(fake_api.calls.items()))
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed": elapsed,
+        "forms": latency_summary(test.form_latencies, elapsed),
+        "callbacks": latency_summary(test.callback_latencies, elapsed),
+        "api_calls": api_calls,
+        "api_calls_per_request": sum(api_calls.values()) / args.requests,
+        "injected_429": fake_api.injected_429,
+        "injected_failures": fake_api.injected_failures,
+        "errors": test.errors,
+        "clean_shutdown": exit_code == 0,
+        # Only final after on_shutdown flushed and compacted the storage
+        "data_file_bytes": data_file_bytes(workdir) if exit_code == 0 else None,
+        "bytes_written_per_request":
+        (written_after - written_before) / args.requests
+        if written_before is not None else None,
+        "workdir": workdir,
+    }
+
+
+# --- Baselines ---
+# (path in the report, True if higher is better)
+REGRESSION_CHECKS = (
+    (("forms", "throughput"), True),
+    (("forms", "p99"), False),
+    (("callbacks", "throughput"), True),
+    (("callbacks", "p99"), False),
+    (("api_calls_per_request", ), False),
+    (("bytes_written_per_request", ), False),
+)
+
+
+def _lookup(report, path):
+    for key in path:
+        report = report.get(key) if isinstance(report, dict) else None
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Returns the list of regressions (empty if none)."""
+    regressions = []
+    for path, higher_is_better in REGRESSION_CHECKS:
+        current, before = _lookup(report, path), _lookup(baseline, path)
+        if not current or not before:
+            continue
+        change = (current - before) / before
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(
+                f"{'.'.join(path)}: {before:.4g} -> {current:.4g} ({change:+.0%})")
+    return regressions
+
+
+def print_report(report):
+    for name in ("forms", "callbacks"):
+        part = report[name]
+        p50 = part["p50"] * 1000 if part["p50"] is not None else float("nan")
+        p99 = part["p99"] * 1000 if part["p99"] is not None else float("nan")
+        print(f"{name:10} {part['count']:6} done  {part['throughput']:8.1f}/s  "
+              f"p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
+    print(f"API calls  {report['api_calls']} "
+          f"({report['api_calls_per_request']:.1f} per request)")
+    print(f"Injected   {report['injected_429']} x 429, "
+          f"{report['injected_failures']} failures; errors {report['errors']}")
+    written = report["bytes_written_per_request"]
+    files = f"{report['data_file_bytes']} bytes" if report["clean_shutdown"] \
+        else "not measured (no clean shutdown)"
+    print(f"Data files {files}, {written:.0f} bytes written per request"
+          if written is not None else f"Data files {files}")
+    print(f"Bot log    {report['workdir']}/bot.log")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--api-latency", type=float, default=0.05,
+                        help="seconds per fake Bot API call (+-50%%)")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="seconds to wait for a callback answer")
+    parser.add_argument("--env", action="append", default=[],
+                        help="KEY=VALUE passed to main.py (repeatable)")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} "
+              f"(tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
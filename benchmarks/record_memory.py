@@ -0,0 +1,66 @@
+# benchmarks/record_memory.py
+"""Memory of N requests held as plain dicts vs. RequestRecords.
+
+Usage: python benchmarks/record_memory.py [10000,100000,1000000]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import MANAGERS, STATUS_COMPLETED  # noqa: E402
+from records import RequestRecord  # noqa: E402
+
+
+def sample_request(i):
+    """A finished request as it is persisted (fresh strings, as after json.load)."""
+    ts = datetime(2025, 1, 1) + timedelta(minutes=i)
+    manager = list(MANAGERS.values())[i % len(MANAGERS)]
+    return {
+        "form_timestamp": ts.isoformat(),
+        "client_name": f"Client {i}",
+        "client_phone": f"+37529{i:07d}",
+        "client_messenger": f"@client{i}",
+        "raw_event_details": "Выпускны, Дзень нараджэння",
+        "status": "".join(STATUS_COMPLETED),
+        "claimed_by_name": "".join(manager["name"]),
+        "claimed_timestamp": (ts + timedelta(minutes=5)).isoformat(),
+        "last_updated_by_name": "".join(manager["name"]),
+        "last_updated_timestamp": (ts + timedelta(days=1)).isoformat(),
+        "messages": [{
+            "chat_id": int(manager_id),
+            "message_id": 1000 + i
+        } for manager_id in MANAGERS],
+        "version": 4,
+    }
+
+
+def measure(count, build):
+    gc.collect()
+    tracemalloc.start()
+    items = {str(i): build(sample_request(i)) for i in range(count)}
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    gc.collect()
+    return current
+
+
+def main():
+    sizes = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else
+                              "10000,100000,1000000").split(",")]
+    print(f"{'requests':>10} {'dict MB':>10} {'record MB':>10} {'B/req dict':>11} "
+          f"{'B/req rec':>10} {'saved':>6}")
+    for count in sizes:
+        as_dicts = measure(count, lambda d: d)
+        as_records = measure(count, RequestRecord.from_dict)
+        print(f"{count:>10} {as_dicts / 2**20:>10.1f} {as_records / 2**20:>10.1f} "
+              f"{as_dicts / count:>11.0f} {as_records / count:>10.0f} "
+              f"{1 - as_records / as_dicts:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# benchmarks/render_cost.py
+"""Per-callback render cost (message text + keyboard) without and with the
+render cache.
+
+"before" is format_request_message plus the keyboard built with validated
+pydantic objects on every callback, as the handlers did before the cache.
+Usage: python benchmarks/render_cost.py [callbacks]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+from config import STATUS_WILL_COME, STATUS_ALERTED, \
+                   STATUS_CANCELED_CLIENT, STATUS_COMPLETED  # noqa: E402
+from bot_handlers import build_status_update_keyboard  # noqa: E402
+from records import RequestRecord  # noqa: E402
+from render_cache import render_cache  # noqa: E402
+from utils import format_request_message  # noqa: E402
+
+
+def uncached_status_keyboard(req_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text=STATUS_WILL_COME,
+                callback_data=f"updateStatus|{req_id}|{STATUS_WILL_COME}"),
+            InlineKeyboardButton(
+                text=STATUS_ALERTED,
+                callback_data=f"updateStatus|{req_id}|{STATUS_ALERTED}")
+        ],
+        [
+            InlineKeyboardButton(
+                text=STATUS_CANCELED_CLIENT,
+                callback_data=f"updateStatus|{req_id}|{STATUS_CANCELED_CLIENT}")
+        ],
+        [
+            InlineKeyboardButton(text=STATUS_COMPLETED,
+                                 callback_data=f"complete|{req_id}")
+        ],
+    ])
+
+
+def sample_record(req_id):
+    return RequestRecord.from_dict({
+        "form_timestamp": "2026-10-17T10:00:00",
+        "client_name": f"Client {req_id}",
+        "client_phone": "+375291234567",
+        "client_messenger": "@client",
+        "raw_event_details": "Выпускны, Дзень нараджэння, Вяселле",
+        "status": STATUS_ALERTED,
+        "claimed_by_name": "Даша",
+        "claimed_timestamp": "2026-10-17T10:05:00",
+        "last_updated_by_name": "Юля",
+        "last_updated_timestamp": "2026-10-17T11:00:00",
+        "messages": [],
+        "version": 3,
+    })
+
+
+def main():
+    callbacks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # A callback re-renders one of a few recently active requests
+    records = [sample_record(req_id) for req_id in range(1, 51)]
+
+    def before(i):
+        record = records[i % len(records)]
+        format_request_message(i % 50 + 1, record, record.status,
+                               record.last_updated_by_name)
+        uncached_status_keyboard(i % 50 + 1)
+
+    def after(i):
+        record = records[i % len(records)]
+        render_cache.request_text(i % 50 + 1, record, record.status,
+                                  record.last_updated_by_name)
+        build_status_update_keyboard(i % 50 + 1)
+
+    def after_changed(i):
+        # Every callback saved a change: new version, only the header and
+        # keyboard come from the cache
+        record = records[i % len(records)]
+        record.version += 1
+        after(i)
+
+    assert render_cache.request_text(
+        1, records[0], records[0].status,
+        records[0].last_updated_by_name) == format_request_message(
+            1, records[0], records[0].status, records[0].last_updated_by_name)
+    assert build_status_update_keyboard(1).model_dump_json() == \
+        uncached_status_keyboard(1).model_dump_json()
+
+    for name, func in (("before", before), ("after (same version)", after),
+                       ("after (new version)", after_changed)):
+        counter = iter(range(10**9))
+        seconds = timeit.timeit(lambda: func(next(counter)), number=callbacks)
+        print(f"{name:>21}: {seconds / callbacks * 1e6:7.1f} µs per callback")
+    print(render_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,102 @@
+import asyncio
+import html
 import logging
 import json
 from datetime import datetime
 
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import CommandStart, Command
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, \
+                          InlineKeyboardButton
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.utils.markdown import hbold
-from aiogram.exceptions import TelegramAPIError  # Import specific exceptions if neede
 
 from config import MANAGERS, STATUS_NEW, STATUS_CLAIMED_PREFIX, STATUS_WILL_COME, \
-                   STATUS_CANCELED_CLIENT, STATUS_ALERTED, STATUS_COMPLETED
-from utils import format_request_message, get_next_request_id, save_request_data, get_request_data
+                   STATUS_CANCELED_CLIENT, STATUS_ALERTED, STATUS_COMPLETED, \
+                   ROUTING_ESCALATION_TIMEOUT
+from utils import get_next_request_id, save_request_data, get_request_data, \
+                  list_requests, request_ids, stats_report, VersionConflict
+from records import RequestRecord
+from request_index import STATUS_GROUPS, STATUS_GROUP_LABELS
+from locks import request_locks
+from fanout import fan_out
+from outbound import outbound_priority, PRIORITY_BROADCAST
+from message_updates import message_updater
+from render_cache import render_cache, KeyboardTemplate
+from stats import request_stats
+from routing import routing, escalations
+from logs import bind_log_context
+from tracing import tracer
 
 # Setup Router
 router = Router()
 
 
-# --- Keyboard Builders --- (Keep build_initial_claim_keyboard & build_status_update_keyboard as before)
-def build_initial_claim_keyboard(req_id):
-    buttons = []
-    manager_items = list(MANAGERS.items())
-    for i in range(0, len(manager_items), 2):
-        row = [
-            InlineKeyboardButton(text=f"Прыняць ({man_data['name'][0]})",
-                                 callback_data=f"claim|{req_id}|{man_id}") for
-            man_id, man_data in manager_items[i:min(i + 2, len(manager_items))]
-        ]
-        if row: buttons.append(row)
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+# --- Keyboard Builders --- (layouts are templates, built once per request id)
+CLAIM_SELF = "me"  # Claim parameter: the manager pressing the button
+
+
+def _claim_template(manager_items):
+    return KeyboardTemplate([[
+        (f"Прыняць ({man_data['name'][0]})", f"claim|{{req_id}}|{man_id}")
+        for man_id, man_data in manager_items[i:min(i + 2, len(manager_items))]
+    ] for i in range(0, len(manager_items), 2)])
+
+
+INITIAL_CLAIM_KEYBOARD = _claim_template(list(MANAGERS.items()))
+# For a group chat, where whoever presses takes the request
+SELF_CLAIM_KEYBOARD = KeyboardTemplate([[("Прыняць",
+                                          f"claim|{{req_id}}|{CLAIM_SELF}")]])
+_claim_keyboards = {tuple(MANAGERS): INITIAL_CLAIM_KEYBOARD}  # Managers -> template
+
+STATUS_UPDATE_KEYBOARD = KeyboardTemplate([
+    [(STATUS_WILL_COME, f"updateStatus|{{req_id}}|{STATUS_WILL_COME}"),
+     (STATUS_ALERTED, f"updateStatus|{{req_id}}|{STATUS_ALERTED}")],
+    [(STATUS_CANCELED_CLIENT,
+      f"updateStatus|{{req_id}}|{STATUS_CANCELED_CLIENT}")],
+    [(STATUS_COMPLETED, "complete|{req_id}")],
+])
+
+
+def build_initial_claim_keyboard(req_id, recipients=None):
+    """Claim buttons for the managers among `recipients` (default: all), or
+    a single self-claim button if there are none (a group chat)."""
+    if recipients is None:
+        return render_cache.keyboard(INITIAL_CLAIM_KEYBOARD, req_id)
+    managers = tuple(m for m in recipients if m in MANAGERS)
+    template = _claim_keyboards.get(managers)
+    if template is None:
+        template = _claim_template([(m, MANAGERS[m]) for m in managers]) \
+            if managers else SELF_CLAIM_KEYBOARD
+        _claim_keyboards[managers] = template
+    return render_cache.keyboard(template, req_id)
 
 
 def build_status_update_keyboard(req_id):
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                text=STATUS_WILL_COME,
-                callback_data=f"updateStatus|{req_id}|{STATUS_WILL_COME}"),
-            InlineKeyboardButton(
-                text=STATUS_ALERTED,
-                callback_data=f"updateStatus|{req_id}|{STATUS_ALERTED}")
-        ],
-        [
-            InlineKeyboardButton(
-                text=STATUS_CANCELED_CLIENT,
-                callback_data=f"updateStatus|{req_id}|{STATUS_CANCELED_CLIENT}"
-            )
-        ],
-        [
-            InlineKeyboardButton(text=STATUS_COMPLETED,
-                                 callback_data=f"complete|{req_id}")
-        ]
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-
-# --- Reusable Function for Creating and Notifying ---
-async def create_and_notify_new_request(bot: Bot, client_data: dict):
-    """Creates a new request, saves it, and notifies managers."""
-    req_id = await get_next_request_id()
-    now_iso = datetime.now().isoformat()
+    return render_cache.keyboard(STATUS_UPDATE_KEYBOARD, req_id)
+
+
+# --- Reusable Functions for Creating and Notifying ---
+REQUIRED_FORM_FIELDS = ("timestamp", "name", "phone", "details")
 
-    new_req_data = {
+
+def client_data_from_form(data):
+    """Picks the client fields out of a form payload, None if incomplete."""
+    if not isinstance(data, dict) or not all(k in data
+                                             for k in REQUIRED_FORM_FIELDS):
+        return None
+    return {
+        "timestamp": data.get("timestamp"),
+        "name": data.get("name"),
+        "phone": data.get("phone"),
+        "messenger": data.get("messenger", ""),
+        "details": data.get("details")
+    }
+
+
+def build_request_data(req_id, client_data: dict):
+    """Returns the record of a brand new request."""
+    now_iso = datetime.now().isoformat()
+    return RequestRecord.from_dict({
         "form_timestamp": client_data.get("timestamp",
                                           now_iso),  # Use provided or current
         "client_name": client_data.get("name", f"N/A {req_id}"),
@@ -73,35 +109,194 @@ async def create_and_notify_new_request(bot: Bot, client_data: dict):
         "last_updated_by_name": None,
         "last_updated_timestamp": None,
         "messages": []  # Stores {chat_id, message_id} for updates
-    }
+    })
+
+
+async def create_request(client_data: dict):
+    """Allocates an id for a new request and saves it (without notifying).
+
+    Inside a trace the request keeps its id as correlation id ("trace_id").
+    """
+    with tracer.span("next_id"):
+        req_id = await get_next_request_id()
+    tracer.tag(req_id=req_id)
+    new_req_data = build_request_data(req_id, client_data)
+    trace_id = tracer.current_trace_id()
+    if trace_id:
+        new_req_data["trace_id"] = trace_id
+    with tracer.span("save"):
+        await save_request_data(req_id, new_req_data)
+    request_stats.record_created(new_req_data)
+    logging.info("Request #%s created and saved.", req_id,
+                 extra={"req_id": req_id})
+    return req_id, new_req_data
+
+
+async def notify_new_request(bot: Bot, req_id, req_data: RequestRecord,
+                             recipients=None):
+    """Sends a saved request to `recipients` (chosen by the routing strategy
+    by default) and stores the sent messages.
+
+    If the strategy left managers out, they get the request once it has been
+    unclaimed for ROUTING_ESCALATION_TIMEOUT seconds.
+    """
+    # Outside a form submission (ingest queue, escalation) this starts a trace
+    # under the request's correlation id
+    with tracer.span("notify", trace_id=req_data.get("trace_id")):
+        tracer.tag(req_id=req_id)
+        if recipients is None:
+            recipients = await routing.recipients(req_id, req_data)
+        message_text = render_cache.request_text(req_id, req_data, STATUS_NEW)
+        keyboard = build_initial_claim_keyboard(req_id, recipients)
+
+        async def send_to_recipient(chat_id):
+            sent_msg = await bot.send_message(chat_id=chat_id,
+                                              text=message_text,
+                                              reply_markup=keyboard,
+                                              **routing.send_options(chat_id))
+            return {"chat_id": sent_msg.chat.id, "message_id": sent_msg.message_id}
+
+        with tracer.span("fan_out", recipients=len(recipients)):
+            results = await fan_out(recipients, send_to_recipient)
+        sent_messages_info = []
+        for chat_id, result in zip(recipients, results):
+            if isinstance(result, BaseException):
+                logging.error("Failed to send new request %s to chat %s: %r",
+                              req_id, chat_id, result, extra={"req_id": req_id})
+            else:
+                sent_messages_info.append(result)
+                message_updater.remember(result["chat_id"], result["message_id"],
+                                         message_text, keyboard)
+                logging.info("Sent new request %s notification to chat %s",
+                             req_id, chat_id, extra={"req_id": req_id})
+
+        # Re-read so a claim that raced with the sends isn't overwritten; the
+        # lock only covers this process, a claim saved by another worker
+        # meanwhile is a version conflict and the append is redone on top
+        with tracer.span("save_messages"):
+            async with request_locks.hold(req_id):
+                while True:
+                    stored = await get_request_data(req_id)
+                    if stored is not None:
+                        req_data = stored
+                    # Store sent message details (escalations add to the earlier ones)
+                    req_data.messages = req_data.messages + sent_messages_info
+                    try:
+                        await save_request_data(
+                            req_id, req_data,
+                            expected_version=req_data.version
+                            if stored is not None else None)
+                    except VersionConflict:
+                        logging.info("Request %s changed while notifying, "
+                                     "storing its messages again.", req_id,
+                                     extra={"req_id": req_id})
+                        continue
+                    break
+
+        notified = {str(chat_id) for chat_id, _ in req_data.message_ids()}
+        if routing.escalates and ROUTING_ESCALATION_TIMEOUT > 0 and \
+                not req_data.claimed_by_name and not notified.issuperset(MANAGERS):
+            schedule_escalation(bot, req_id)
+        return sent_messages_info
+
+
+def schedule_escalation(bot: Bot, req_id, delay=ROUTING_ESCALATION_TIMEOUT):
+    escalations.schedule(req_id, delay,
+                         lambda req_id: escalate_request(bot, req_id))
+
+
+async def escalate_request(bot: Bot, req_id):
+    """Sends a request that is still unclaimed to the managers who didn't
+    get it yet."""
+    req_data = await get_request_data(req_id)
+    if req_data is None or req_data.claimed_by_name or \
+            req_data.status != STATUS_NEW:
+        return
+    notified = {str(chat_id) for chat_id, _ in req_data.message_ids()}
+    remaining = [m for m in MANAGERS if m not in notified]
+    if remaining:
+        logging.info("Request #%s still unclaimed, escalating to %d managers.",
+                     req_id, len(remaining), extra={"req_id": req_id})
+        await notify_new_request(bot, req_id, req_data, remaining)
 
-    message_text = format_request_message(req_id, new_req_data, STATUS_NEW)
-    keyboard = build_initial_claim_keyboard(req_id)
 
-    sent_messages_info = []
-    for manager_id in MANAGERS.keys():
-        try:
-            sent_msg = await bot.send_message(chat_id=manager_id,
-                                              text=message_text,
-                                              reply_markup=keyboard)
-            sent_messages_info.append({
-                "chat_id": sent_msg.chat.id,
-                "message_id": sent_msg.message_id
-            })
-            logging.info(
-                f"Sent new request {req_id} notification to manager {manager_id}"
-            )
-        except Exception as e:
-            logging.error(
-                f"Failed to send new request {req_id} to manager {manager_id}: {e}"
-            )
-
-    new_req_data["messages"] = sent_messages_info  # Store sent message details
-    await save_request_data(req_id, new_req_data)
-    logging.info(f"Request #{req_id} created and saved.")
+async def schedule_pending_escalations(bot: Bot):
+    """Restarts the escalation timers of new requests (after a restart)."""
+    if not routing.escalates or ROUTING_ESCALATION_TIMEOUT <= 0:
+        return
+    pending = await request_ids(("status", "new"))
+    for req_id in pending:
+        schedule_escalation(bot, req_id)
+    if pending:
+        logging.info("Escalation timers restarted for %d new requests.",
+                     len(pending))
+
+
+async def create_and_notify_new_request(bot: Bot, client_data: dict):
+    """Creates a new request, saves it, and notifies managers."""
+    req_id, new_req_data = await create_request(client_data)
+    await notify_new_request(bot, req_id, new_req_data)
     return req_id
 
 
+# --- Informational Broadcasts ---
+_background_tasks = set()  # Keeps fire-and-forget tasks from being garbage collected
+
+
+def notify_other_managers(bot: Bot, except_user_id, text, managers=None):
+    """Sends `text` to every manager (or every one of `managers`) except
+    `except_user_id` in the background.
+
+    The messages go out with broadcast priority, behind callback answers and
+    edits of live requests.
+    """
+
+    async def _broadcast():
+        with outbound_priority(PRIORITY_BROADCAST):
+            recipients = [
+                m for m in (MANAGERS if managers is None else managers)
+                if m != except_user_id
+            ]
+            results = await fan_out(
+                recipients,
+                lambda manager_id: bot.send_message(chat_id=manager_id,
+                                                    text=text))
+        for manager_id, result in zip(recipients, results):
+            if isinstance(result, BaseException):
+                logging.error("Failed to notify manager %s: %r", manager_id,
+                              result)
+
+    task = asyncio.create_task(_broadcast())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def drain_broadcasts(timeout=30.0):
+    """Waits for the notify_other_managers() broadcasts still running."""
+    if not _background_tasks:
+        return
+    logging.info("Waiting for %d manager broadcasts.", len(_background_tasks))
+    done, pending = await asyncio.wait(list(_background_tasks), timeout=timeout)
+    if pending:
+        logging.warning("%d manager broadcasts still running after %ss.",
+                        len(pending), timeout)
+
+
+async def send_stats_digest(bot: Bot, days, end):
+    """Sends the statistics of `days` days up to `end` to every manager."""
+    text = await stats_report(days, end)
+    with outbound_priority(PRIORITY_BROADCAST):
+        recipients = list(MANAGERS)
+        results = await fan_out(
+            recipients,
+            lambda manager_id: bot.send_message(chat_id=manager_id, text=text))
+    for manager_id, result in zip(recipients, results):
+        if isinstance(result, BaseException):
+            logging.error("Failed to send stats digest to manager %s: %r",
+                          manager_id, result)
+
+
 # --- Command Handlers ---
 @router.message(CommandStart())
 async def handle_start(message: Message):
@@ -109,11 +304,11 @@ async def handle_start(message: Message):
     name = message.from_user.first_name or "Невядомы"
     if user_id in MANAGERS:
         await message.answer(f"Прывітанне, {hbold(name)}! Вы менеджэр.")
-        logging.info(f"Manager {name} ({user_id}) started.")
+        logging.info("Manager %s (%s) started.", name, user_id)
     else:
         await message.answer(
             f"Прывітанне, {name}! Для доступу звярніцеся да адміністратара.")
-        logging.info(f"Non-manager {name} ({user_id}) started.")
+        logging.info("Non-manager %s (%s) started.", name, user_id)
 
 
 @router.message(Command("new_request"))
@@ -139,30 +334,214 @@ async def handle_new_request_command(message: Message, bot: Bot):
         f"Тэставая заяўка #{req_id} створана і адпраўлена менеджэрам.")
 
 
-# --- Callback Query Handler --- (Keep as before, handles button clicks)
+# --- Request Lists --- (/open, /mine, /status, paged with "list|<query>|<cursor>")
+LIST_PAGE_SIZE = 10
+
+
+def _resolve_list_query(query, manager):
+    """Returns (index key, within key, title) of a list query, or None."""
+    kind, _, arg = query.partition(':')
+    if kind == "open" and not arg:
+        return ("open", ), None, "Адкрытыя заяўкі"
+    if kind == "day":
+        try:
+            day = datetime.strptime(arg, '%Y-%m-%d').date().isoformat()
+        except ValueError:
+            return None
+        return ("day", day), ("open", ), f"Адкрытыя заяўкі ад {day}"
+    if kind == "mine":
+        return ("open_manager", manager['name']), None, "Мае адкрытыя заяўкі"
+    if kind == "status" and arg in STATUS_GROUPS:
+        return ("status", arg), None, f"Заяўкі са статусам {STATUS_GROUP_LABELS[arg]}"
+    return None
+
+
+def _format_list_line(req_id, req_data):
+    line = f"#{req_id} · {req_data.status} · {html.escape(req_data.client_name or 'N/A')}"
+    if req_data.claimed_by_name:
+        line += f" · 🔑 {html.escape(req_data.claimed_by_name)}"
+    return line
+
+
+async def render_request_list(query, manager, before=None):
+    """Returns (text, keyboard) of one page of a list query."""
+    resolved = _resolve_list_query(query, manager)
+    if resolved is None:
+        return "Невядомы запыт.", None
+    key, within, title = resolved
+    page, cursor = await list_requests(key, before, LIST_PAGE_SIZE, within)
+    if not page:
+        return f"<b>{title}</b>\nНічога не знойдзена.", None
+    lines = [_format_list_line(req_id, req_data) for req_id, req_data in page]
+    text = f"<b>{title}</b>\n" + "\n".join(lines)
+    keyboard = None
+    if cursor is not None:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="Наступныя ▶",
+                                 callback_data=f"list|{query}|{cursor}")
+        ]])
+    return text, keyboard
+
+
+async def _answer_list(message: Message, query):
+    manager = MANAGERS.get(str(message.from_user.id))
+    if not manager:
+        await message.reply("Толькі для менеджэраў.")
+        return
+    text, keyboard = await render_request_list(query, manager)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.message(Command("open"))
+async def handle_open_command(message: Message, command: CommandObject):
+    """/open [YYYY-MM-DD]: open requests, optionally of one day."""
+    day = (command.args or "").strip()
+    await _answer_list(message, f"day:{day}" if day else "open")
+
+
+@router.message(Command("mine"))
+async def handle_mine_command(message: Message):
+    await _answer_list(message, "mine")
+
+
+@router.message(Command("status"))
+async def handle_status_command(message: Message, command: CommandObject):
+    """/status <group>: requests in one status group; without it, a picker."""
+    group = (command.args or "").strip().lower()
+    if group or str(message.from_user.id) not in MANAGERS:
+        await _answer_list(message, f"status:{group}")
+        return
+    await message.answer("Выберыце статус:", reply_markup=InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text=label,
+                                 callback_data=f"list|status:{group}|")
+        ] for group, label in STATUS_GROUP_LABELS.items()]))
+
+
+@router.message(Command("stats"))
+async def handle_stats_command(message: Message, command: CommandObject):
+    """/stats [days]: statistics of today, or of the last `days` days."""
+    if str(message.from_user.id) not in MANAGERS:
+        await message.reply("Толькі для менеджэраў.")
+        return
+    try:
+        days = int(command.args or 1)
+    except ValueError:
+        days = 0
+    if not 1 <= days <= request_stats.retain_days:
+        await message.reply(
+            f"Колькасць дзён: ад 1 да {request_stats.retain_days}.")
+        return
+    await message.answer(await stats_report(days))
+
+
+@router.callback_query(F.data.startswith("list|"))
+async def handle_list_callback(callback: CallbackQuery):
+    manager = MANAGERS.get(str(callback.from_user.id))
+    if not manager:
+        await callback.answer("Толькі для менеджэраў.", show_alert=True)
+        return
+    try:
+        _, query, cursor = callback.data.split('|')
+        before = int(cursor) if cursor else None
+    except ValueError:
+        await callback.answer("Невядомы запыт.", show_alert=True)
+        return
+    text, keyboard = await render_request_list(query, manager, before)
+    await callback.answer()
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+async def _apply_callback_action(req_id, req_data, action, param,
+                                 manager_performing_action):
+    """Applies a button action to `req_data` and saves it.
+
+    Must be called while holding the request's lock. Returns
+    (rejection, answer text, text for the other managers); rejection is an
+    alert text when nothing was changed.
+    """
+    current_status = req_data.status
+    version = req_data.version
+    now_iso = datetime.now().isoformat()
+
+    if action == "claim":
+        manager_to_assign = MANAGERS.get(param)  # param is assignedToManagerId
+        if not manager_to_assign:
+            return "Памылка: Менеджэр для прызначэння не знойдзен.", None, None
+        if req_data.claimed_by_name:
+            return f"Заяўка ўжо апрацоўваецца {req_data.claimed_by_name}.", None, None
+
+        req_data.claimed_by_name = manager_to_assign['name']
+        req_data.claimed_timestamp = now_iso
+        req_data.status = f"{STATUS_CLAIMED_PREFIX} {manager_to_assign['nameBy']}"
+        alert_answer_text = f"✅ Заяўка прынята {manager_to_assign['nameBy']}."
+        notify_text = f"ℹ️ Заяўка #{req_id} прынята {manager_performing_action['nameBy']} (прызначана {manager_to_assign['nameBy']})."
+        conflict_text = f"Заяўка #{req_id} ужо прынята іншым менеджэрам."
+
+    elif action == "updateStatus" or action == "complete":
+        new_status = STATUS_COMPLETED if action == "complete" else param
+        if current_status == STATUS_COMPLETED and action != 'complete':
+            return f"Заяўка #{req_id} ўжо завершана.", None, None
+
+        req_data.status = new_status
+        alert_answer_text = f"🏁 Заяўка #{req_id} завершана." if action == "complete" else f"Статус зменены на \"{new_status}\"."
+        notify_text = f"ℹ️ Статус заяўкі #{req_id} -> \"{new_status}\" ({manager_performing_action['nameBy']})."
+        conflict_text = f"Заяўка #{req_id} была зменена іншым менеджэрам, паспрабуйце яшчэ раз."
+
+    else:
+        return "Невядомае дзеянне.", None, None
+
+    req_data.last_updated_by_name = manager_performing_action['name']
+    req_data.last_updated_timestamp = now_iso
+    try:
+        await save_request_data(req_id, req_data, expected_version=version)
+    except VersionConflict:
+        logging.warning("Version conflict on request %s (%s), rejected.",
+                        req_id, action)
+        return conflict_text, None, None
+    request_stats.record_transition(current_status, req_data)
+    return None, alert_answer_text, notify_text
+
+
+# --- Callback Query Handler --- (handles button clicks)
 @router.callback_query(
     F.data.startswith("claim|") | F.data.startswith("updateStatus|")
     | F.data.startswith("complete|"))
 async def handle_request_callbacks(callback: CallbackQuery, bot: Bot):
     user_id = str(callback.from_user.id)
     manager_performing_action = MANAGERS.get(user_id)
+    if not manager_performing_action:  # E.g. someone else in a group chat
+        await callback.answer("Толькі для менеджэраў.", show_alert=True)
+        return
 
     # doPost already did the initial ack
 
     try:
         action, req_id_str, *params = callback.data.split('|')
         req_id = int(req_id_str)
+        bind_log_context(req_id=req_id)  # For the rest of this update
+        tracer.tag(req_id=req_id)
         param = params[0] if params else None
-
-        logging.info(
-            f"Processing callback: Action={action}, ReqID={req_id}, Param={param}, User={user_id}"
-        )
-
-        req_data = await get_request_data(req_id)
+        if param == CLAIM_SELF:
+            param = user_id
+
+        logging.info("Processing callback: Action=%s, ReqID=%s, Param=%s, User=%s",
+                     action, req_id, param, user_id)
+
+        # Read-modify-write under the request's lock; callbacks for other
+        # requests keep running concurrently
+        with tracer.span("apply", action=action):
+            async with request_locks.hold(req_id):
+                req_data = await get_request_data(req_id)
+                if req_data:
+                    # Joins the request's timeline (same correlation id)
+                    tracer.tag(trace_id=req_data.get("trace_id"))
+                    rejection, alert_answer_text, notify_text = await _apply_callback_action(
+                        req_id, req_data, action, param, manager_performing_action)
 
         if not req_data:
-            logging.warning(
-                f"Callback ignored: Request ID {req_id} not found in DB.")
+            logging.warning("Callback ignored: Request ID %s not found in DB.",
+                            req_id)
             await callback.answer(f"Заяўка #{req_id} не знойдзена!",
                                   show_alert=True)
             try:
@@ -173,91 +552,31 @@ async def handle_request_callbacks(callback: CallbackQuery, bot: Bot):
                 pass
             return
 
-        current_status = req_data.get('status')
-        now_iso = datetime.now().isoformat()
-        update_made = False
-        alert_answer_text = "Апрацавана."  # Default answer
+        if rejection:
+            await callback.answer(rejection, show_alert=True)
+            return
 
+        # Notify others after answering callback quickly
+        await callback.answer(alert_answer_text)
         if action == "claim":
-            manager_to_assign = MANAGERS.get(
-                param)  # param is assignedToManagerId
-            if not manager_to_assign:
-                await callback.answer(
-                    "Памылка: Менеджэр для прызначэння не знойдзен.",
-                    show_alert=True)
-                return
-            if req_data.get('claimed_by_name'):
-                await callback.answer(
-                    f"Заяўка ўжо апрацоўваецца {req_data.get('claimed_by_name')}.",
-                    show_alert=True)
-                return
-
-            req_data['claimed_by_name'] = manager_to_assign['name']
-            req_data['claimed_timestamp'] = now_iso
-            req_data[
-                'status'] = f"{STATUS_CLAIMED_PREFIX} {manager_to_assign['nameBy']}"
-            req_data['last_updated_by_name'] = manager_performing_action[
-                'name']
-            req_data['last_updated_timestamp'] = now_iso
-            await save_request_data(req_id, req_data)
-            update_made = True
-            alert_answer_text = f"✅ Заяўка прынята {manager_to_assign['nameBy']}."
-            # Notify others after answering callback quickly
-            await callback.answer(alert_answer_text)
-            notifyOtherManagers(
-                user_id,
-                f"ℹ️ Заяўка #{req_id} прынята {manager_performing_action['nameBy']} (прызначана {manager_to_assign['nameBy']})."
-            )
-
-        elif action == "updateStatus" or action == "complete":
-            new_status = STATUS_COMPLETED if action == "complete" else param
-            if current_status == STATUS_COMPLETED and action != 'complete':
-                await callback.answer(f"Заяўка #{req_id} ўжо завершана.",
-                                      show_alert=True)
-                return
-
-            req_data['status'] = new_status
-            req_data['last_updated_by_name'] = manager_performing_action[
-                'name']
-            req_data['last_updated_timestamp'] = now_iso
-            await save_request_data(req_id, req_data)
-            update_made = True
-            alert_answer_text = f"🏁 Заяўка #{req_id} завершана." if action == "complete" else f"Статус зменены на \"{new_status}\"."
-            # Notify others after answering callback quickly
-            await callback.answer(alert_answer_text)
-            notifyOtherManagers(
-                user_id,
-                f"ℹ️ Статус заяўкі #{req_id} -> \"{new_status}\" ({manager_performing_action['nameBy']})."
-            )
-
-        # Update all original messages if an update was made
-        if update_made:
-            new_text = format_request_message(req_id, req_data,
-                                              req_data['status'],
-                                              req_data['last_updated_by_name'])
-            new_keyboard = None if req_data[
-                'status'] == STATUS_COMPLETED else build_status_update_keyboard(
-                    req_id)
-
-            messages_to_update = req_data.get("messages", [])
-            for msg_info in messages_to_update:
-                try:
-                    await bot.edit_message_text(
-                        text=new_text,
-                        chat_id=msg_info["chat_id"],
-                        message_id=msg_info["message_id"],
-                        reply_markup=new_keyboard)
-                except TelegramAPIError as e:  # More specific exception
-                    logging.error(
-                        f"Failed to edit TG msg {msg_info['message_id']} in chat {msg_info['chat_id']} for req {req_id}: {e}"
-                    )
-                except Exception as e:
-                    logging.error(
-                        f"Generic err editing TG msg {msg_info['message_id']} / chat {msg_info['chat_id']} for req {req_id}: {e}"
-                    )
+            escalations.cancel(req_id)
+        # Only the managers the request was sent to hear about it
+        notify_other_managers(bot, user_id, notify_text, [
+            str(chat_id) for chat_id, _ in req_data.message_ids()
+            if str(chat_id) in MANAGERS
+        ])
+
+        # Update all original messages
+        new_text = render_cache.request_text(req_id, req_data, req_data.status,
+                                             req_data.last_updated_by_name)
+        new_keyboard = None if req_data.status == STATUS_COMPLETED \
+            else build_status_update_keyboard(req_id)
+
+        message_updater.schedule(bot, req_id, new_text, new_keyboard,
+                                 req_data.messages)
 
     except Exception as e:
-        logging.exception(f"Error processing callback: {callback.data}")
+        logging.exception("Error processing callback: %s", callback.data)
         try:
             await callback.answer("Адбылася памылка апрацоўкі!",
                                   show_alert=True)
@@ -9,6 +9,8 @@ load_dotenv()
 # Make sure these EXACT names (BOT_TOKEN, FORM_SECRET) are used in Railway Variables tab
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 FORM_SECRET = os.environ.get('FORM_SECRET')
+# Bot API server, e.g. a self-hosted one or the stand-in of benchmarks/load_test.py
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE') # Default: api.telegram.org
 
 # --- Manager Config ---
 MANAGERS = {
@@ -16,6 +18,22 @@ MANAGERS = {
     '8153757571': {'name': 'Юля', 'nameBy': 'Юляй'}
 }
 
+# --- Routing --- (who gets a new request, see routing.py)
+# "all" messages every manager, "round_robin" / "least_open" pick ROUTING_FANOUT managers
+# (in turn / with the fewest open requests), "shifts" the managers on duty now
+# (MANAGER_SHIFTS, least open first), "group" posts once to ROUTING_GROUP_CHAT_ID
+ROUTING_STRATEGY = os.environ.get('ROUTING_STRATEGY', 'all')
+ROUTING_FANOUT = int(os.environ.get('ROUTING_FANOUT', 2)) # Managers notified per request
+ROUTING_GROUP_CHAT_ID = os.environ.get('ROUTING_GROUP_CHAT_ID') # Group (or forum) chat id
+ROUTING_GROUP_THREAD_ID = int(os.environ.get('ROUTING_GROUP_THREAD_ID', 0)) or None # Forum topic
+# Unclaimed after this many seconds, the request goes to every manager not notified yet
+ROUTING_ESCALATION_TIMEOUT = float(os.environ.get('ROUTING_ESCALATION_TIMEOUT', 600)) # 0 disables
+# Manager id -> local ("HH:MM", "HH:MM") windows on duty (may cross midnight);
+# managers not listed are always on duty
+MANAGER_SHIFTS = {
+    # '675120396': [("09:00", "18:00")],
+}
+
 # --- Status Constants ---
 STATUS_NEW = "Новая"
 STATUS_CLAIMED_PREFIX = "Апрацоўваецца"
@@ -24,8 +42,40 @@ STATUS_CANCELED_CLIENT = "❌ Адмена"
 STATUS_ALERTED = "🔔 Апавешчаны"
 STATUS_COMPLETED = "🏁 Завершана"
 
-# --- Data Storage (Simple JSON file) ---
+# Requests in these states are never changed again (normally) and get archived
+TERMINAL_STATUSES = (STATUS_COMPLETED, STATUS_CANCELED_CLIENT)
+
+# --- Multi-process Mode ---
+# WEB_WORKERS > 1 starts that many worker processes sharing the port (SO_REUSEPORT)
+# and the SQLite database, so it requires STORAGE_BACKEND=sqlite
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', 0)) # Set by main.py for each worker
+# Each process reserves this many request ids at once and hands them out locally
+ID_LEASE_SIZE = int(os.environ.get('ID_LEASE_SIZE', 20 if WEB_WORKERS > 1 else 1))
+WEBHOOK_LEADER_LOCK_PATH = "webhook.lock" # Holder sets/deletes the webhook
+_WORKER_FILE_SUFFIX = f".{WORKER_INDEX}" if WEB_WORKERS > 1 else "" # Per-process files
+
+# --- Data Storage ---
+# "json" keeps everything in memory and in DATA_FILE_PATH, "sqlite" uses SQLITE_DB_PATH
+# (an existing DATA_FILE_PATH is migrated into the database on first start)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', "bot_data.sqlite3")
 DATA_FILE_PATH = "bot_data.json" # Data stored in this file relative to script
+# "full" rewrites DATA_FILE_PATH on every change, "journal" appends one record
+# per change to JOURNAL_FILE_PATH and periodically compacts into DATA_FILE_PATH
+STORAGE_MODE = os.environ.get('STORAGE_MODE', 'journal')
+JOURNAL_FILE_PATH = f"{DATA_FILE_PATH}.journal"
+JOURNAL_COMPACT_EVERY = int(os.environ.get('JOURNAL_COMPACT_EVERY', 1000)) # Records before snapshot
+# Journal mode snapshot: "binary" is SNAPSHOT_FILE_PATH (indexed and memory-mapped,
+# finished requests are decoded on first access), "json" is DATA_FILE_PATH.
+# An existing DATA_FILE_PATH is converted on the first compaction.
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'binary')
+SNAPSHOT_FILE_PATH = "bot_data.snap"
+# Write-behind: changes are batched and written by a background thread instead
+# of inside the handler; a batch is written after the delay or once it is full
+STORAGE_WRITE_BEHIND = os.environ.get('STORAGE_WRITE_BEHIND', '1') == '1'
+STORAGE_FLUSH_DELAY = float(os.environ.get('STORAGE_FLUSH_DELAY', 0.05)) # Seconds
+STORAGE_FLUSH_BATCH = int(os.environ.get('STORAGE_FLUSH_BATCH', 100)) # Changes
 
 # --- Webhook Settings ---
 # Try to get the URL automatically from Railway first
@@ -52,6 +102,11 @@ else:
 # Construct the final webhook URL
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}" # Obscure webhook path
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST and BOT_TOKEN else None
+# "background" acknowledges updates at once and processes them in a bounded pool,
+# "inline" keeps Telegram's request open until the update is handled
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'background')
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('WEBHOOK_MAX_IN_FLIGHT', 100)) # Updates processed at once
+WEBHOOK_DEDUP_SIZE = 10000 # Recent update_ids remembered to drop redeliveries
 
 # --- Web Server Settings ---
 # Railway injects the PORT variable. Default needed for local testing.
@@ -60,3 +115,80 @@ WEB_SERVER_PORT = int(os.environ.get('PORT', 8080)) # Use Railway's port or 8080
 
 # --- Form Submission Endpoint ---
 FORM_SUBMIT_PATH = "/formsubmit"
+# Bulk import (JSON array or NDJSON body), processed in chunks with one id block each
+FORM_BATCH_PATH = f"{FORM_SUBMIT_PATH}/batch"
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 100))
+BATCH_MAX_ITEM_BYTES = 65536 # Larger single items are rejected
+# "inline" notifies managers before responding, "queue" saves the request, answers
+# 202 right away and leaves the notification to INGEST_WORKERS background workers
+INGEST_MODE = os.environ.get('INGEST_MODE', 'inline')
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 500)) # Full queue answers 503
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+INGEST_QUEUE_PATH = f"ingest_queue{_WORKER_FILE_SUFFIX}.jsonl" # Unfinished notifications, replayed on start
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 5)) # Then left in the queue file until the next start
+INGEST_RETRY_DELAY = float(os.environ.get('INGEST_RETRY_DELAY', 1)) # Seconds before the first retry, doubled after each
+# Repeated submissions (same Idempotency-Key header, or same timestamp+phone+details)
+# return the original request id instead of creating a new request
+# Single process: IDEMPOTENCY_INDEX_PATH; with WEB_WORKERS > 1 a table in SQLITE_DB_PATH
+# (a client's retry can reach any worker)
+IDEMPOTENCY_INDEX_PATH = "idempotency_keys.jsonl"
+IDEMPOTENCY_CLAIM_TIMEOUT = 30 # Seconds before another worker takes over an unfinished key
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 50000))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 7 * 24 * 3600)) # Seconds
+
+# --- Export --- (GET, same X-Form-Secret header as the form endpoint)
+EXPORT_PATH = "/export"
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 500)) # Requests read and written per step
+
+# --- Archive ---
+# Terminal requests not updated for ARCHIVE_AFTER_DAYS move out of the working set
+# into gzip segments (one per day of their last update) under ARCHIVE_DIR
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 7)) # 0 disables archiving
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', 3600)) # Seconds between runs
+ARCHIVE_BATCH_SIZE = 1000 # Requests moved per storage round trip
+ARCHIVE_CACHE_SEGMENTS = 4 # Decoded segments kept in memory for lookups
+
+# --- Statistics ---
+# Daily counters (new / claimed / finished requests, claim latency) kept for STATS_RETAIN_DAYS
+STATS_RETAIN_DAYS = int(os.environ.get('STATS_RETAIN_DAYS', 30))
+STATS_DIGEST_TIME = os.environ.get('STATS_DIGEST_TIME', '') # Local "HH:MM" of the daily digest (e.g. "09:00"), empty (default) disables
+STATS_DIGEST_DAYS = int(os.environ.get('STATS_DIGEST_DAYS', 1)) # Days (before today) a digest covers
+
+# --- Metrics --- (Prometheus text format)
+METRICS_PATH = "/metrics"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # If set, scrapes need "Authorization: Bearer <token>"
+EVENT_LOOP_LAG_INTERVAL = 1.0 # Seconds between event loop lag samples
+
+# --- Logging --- (records are written by a background thread, see logs.py)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json') # 'json' (one object per line) or 'text'
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000)) # Records waiting to be written, more are dropped
+LOG_SAMPLE_LIMIT = int(os.environ.get('LOG_SAMPLE_LIMIT', 20)) # Records of one kind per window below ERROR, 0 = all
+LOG_SAMPLE_WINDOW = float(os.environ.get('LOG_SAMPLE_WINDOW', 10)) # Seconds
+
+# --- Tracing --- (per-request span timelines, see tracing.py)
+TRACE_FILE_PATH = os.environ.get('TRACE_FILE_PATH', 'traces.jsonl') # Empty disables tracing
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 10 * 1024 * 1024)) # File size before rotating
+TRACE_BACKUPS = int(os.environ.get('TRACE_BACKUPS', 5)) # Rotated files kept
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.1)) # Share of fast, error-free traces kept
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', 1.0)) # Traces this long are always kept
+
+# --- Concurrency ---
+REQUEST_LOCK_STRIPES = 64 # Locks shared by all requests (by id modulo stripes)
+
+# --- Telegram Fan-out ---
+FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 8)) # Parallel API calls per fan-out
+FANOUT_TIMEOUT = float(os.environ.get('FANOUT_TIMEOUT', 10)) # Seconds per attempt at Telegram, rate limit waits excluded
+# Status edits of one request within this window are merged into one edit per message
+EDIT_COALESCE_WINDOW = float(os.environ.get('EDIT_COALESCE_WINDOW', 0.3)) # Seconds
+EDIT_HASH_CACHE_SIZE = 10000 # Messages whose last rendered content is remembered
+
+# --- Rendering ---
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', 2000)) # Texts / keyboards kept
+
+# --- Outbound Rate Limits --- (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 25)) / WEB_WORKERS # Per process
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', 1)) # Calls per second per chat
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', 3)) # Short bursts per chat
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', 3)) # Retries after a 429
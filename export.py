@@ -0,0 +1,127 @@
+# export.py
+import csv
+import io
+import json
+import logging
+from datetime import date, timedelta
+
+from aiohttp import web
+
+from config import FORM_SECRET
+from records import json_default
+from request_index import STATUS_GROUP_LABELS
+import utils
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+CSV_COLUMNS = ("id", "form_timestamp", "client_name", "client_phone",
+               "client_messenger", "raw_event_details", "status",
+               "claimed_by_name", "claimed_timestamp", "last_updated_by_name",
+               "last_updated_timestamp", "version", "archived")
+
+
+class ExportParamError(ValueError):
+    pass
+
+
+def parse_export_params(query):
+    """Returns (format, filters for utils.export_requests) of the query
+    string. `from` and `to` are inclusive "YYYY-MM-DD" form dates."""
+    export_format = query.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        raise ExportParamError(
+            f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    filters = {}
+    try:
+        if query.get("from"):
+            filters["since"] = date.fromisoformat(query["from"]).isoformat()
+        if query.get("to"):
+            filters["until"] = (date.fromisoformat(query["to"]) +
+                                timedelta(days=1)).isoformat()
+    except ValueError:
+        raise ExportParamError("from / to must be YYYY-MM-DD dates") from None
+    status_group = query.get("status")
+    if status_group:
+        if status_group not in STATUS_GROUP_LABELS:
+            raise ExportParamError(
+                f"status must be one of {', '.join(STATUS_GROUP_LABELS)}")
+        filters["status_group"] = status_group
+    if query.get("manager"):
+        filters["manager"] = query["manager"]
+    return export_format, filters
+
+
+def format_csv(rows, header=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    for req_id, req_data, archived in rows:
+        writer.writerow([
+            req_id, *(req_data.get(column)
+                      for column in CSV_COLUMNS[1:-1]), int(archived)
+        ])
+    return buffer.getvalue()
+
+
+def format_ndjson(rows):
+    return "".join(
+        json.dumps({
+            "id": req_id,
+            "archived": archived,
+            "data": req_data
+        },
+                   ensure_ascii=False,
+                   default=json_default) + "\n"
+        for req_id, req_data, archived in rows)
+
+
+async def handle_export(request: web.Request):
+    """Streams the request history as CSV or NDJSON.
+
+    Query: format=csv|ndjson, from / to (form dates, inclusive), status (a
+    status group), manager (claimed by). Requests are read and written in
+    chunks of EXPORT_CHUNK_SIZE, so memory use doesn't grow with the history.
+    """
+    received_secret = request.headers.get("X-Form-Secret")
+    if not received_secret or received_secret != FORM_SECRET:
+        logging.warning(f"Export rejected: Invalid/missing secret.")
+        return web.Response(status=403, text="Forbidden: Invalid Secret")
+    try:
+        export_format, filters = parse_export_params(request.query)
+    except ExportParamError as e:
+        return web.json_response({
+            "status": "error",
+            "message": str(e)
+        },
+                                 status=400)
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type":
+            EXPORT_FORMATS[export_format],
+            "Content-Disposition":
+            f'attachment; filename="requests.{export_format}"',
+        })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    exported = 0
+    try:
+        if export_format == "csv":
+            await response.write(format_csv([], header=True).encode("utf-8"))
+        async for rows in utils.export_requests(**filters):
+            text = format_csv(rows) if export_format == "csv" \
+                else format_ndjson(rows)
+            await response.write(text.encode("utf-8"))
+            exported += len(rows)
+    except Exception:
+        # Headers are out already; dropping the connection leaves the chunked
+        # body unterminated, so the client sees the export as incomplete
+        logging.exception(f"Export failed after {exported} requests:")
+        raise
+    await response.write_eof()
+    logging.info(f"Exported {exported} requests ({export_format}, {filters})")
+    return response
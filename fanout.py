@@ -0,0 +1,28 @@
+# fanout.py
+import asyncio
+
+from config import FANOUT_CONCURRENCY, FANOUT_TIMEOUT
+from outbound import attempt_timeout
+
+
+async def fan_out(targets,
+                  call,
+                  concurrency=FANOUT_CONCURRENCY,
+                  timeout=FANOUT_TIMEOUT):
+    """Runs `call(target)` for every target, at most `concurrency` at a time.
+
+    Returns a list with one entry per target, in the same order: the call's
+    result, or the exception it raised (asyncio.TimeoutError if an attempt at
+    Telegram took longer than `timeout` seconds; time queued by the outbound
+    scheduler and 429 retry pauses don't count). One failing target never
+    affects others.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _one(target):
+        async with semaphore:
+            with attempt_timeout(timeout):
+                return await call(target)
+
+    return await asyncio.gather(*(_one(target) for target in targets),
+                                return_exceptions=True)
@@ -0,0 +1,317 @@
+# idempotency.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import IDEMPOTENCY_INDEX_PATH, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL, \
+                   IDEMPOTENCY_CLAIM_TIMEOUT, SQLITE_DB_PATH, WEB_WORKERS
+
+
+def idempotency_key(header_value, client_data):
+    """Uses the Idempotency-Key header, or a hash of the submitted content."""
+    if header_value:
+        return f"h:{header_value.strip()}"
+    content = "\x1f".join(
+        str(client_data.get(field) or "")
+        for field in ("timestamp", "phone", "details"))
+    return f"c:{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+
+
+class SharedIdempotencyKeys:
+    """Submission keys in a table of the SQLite database, shared by all
+    worker processes (a retry can land on any of them).
+
+    A worker claims a key by inserting it without a request id and fills the
+    id in once the request exists; the others wait for that. A claim left
+    unfinished for IDEMPOTENCY_CLAIM_TIMEOUT seconds (a crashed worker) can
+    be taken over. Queries run on a thread of their own.
+    """
+
+    def __init__(self, path=SQLITE_DB_PATH, ttl=IDEMPOTENCY_TTL,
+                 claim_timeout=IDEMPOTENCY_CLAIM_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="idempotency")
+        self._claims = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+                "key TEXT PRIMARY KEY, req_id INTEGER, created REAL NOT NULL)")
+        return self._conn
+
+    def _get(self, key):
+        row = self._connect().execute(
+            "SELECT req_id FROM idempotency_keys "
+            "WHERE key = ? AND req_id IS NOT NULL AND created > ?",
+            (key, time.time() - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def _try_claim(self, key):
+        """Returns ("claimed", None), ("done", req_id) or ("busy", None)."""
+        conn = self._connect()
+        now = time.time()
+        self._claims += 1
+        if self._claims % 1000 == 0:
+            conn.execute("DELETE FROM idempotency_keys WHERE created <= ?",
+                         (now - self.ttl, ))
+        if conn.execute(
+                "INSERT OR IGNORE INTO idempotency_keys (key, req_id, created) "
+                "VALUES (?, NULL, ?)", (key, now)).rowcount:
+            return "claimed", None
+        row = conn.execute(
+            "SELECT req_id, created FROM idempotency_keys WHERE key = ?",
+            (key, )).fetchone()
+        if row is None:  # Deleted meanwhile (released or expired)
+            return "busy", None
+        req_id, created = row
+        expired = now - created >= (self.ttl if req_id is not None else
+                                    self.claim_timeout)
+        if not expired:
+            return ("done", req_id) if req_id is not None else ("busy", None)
+        # Take over an expired key or an abandoned claim (only one worker wins)
+        if conn.execute(
+                "UPDATE idempotency_keys SET req_id = NULL, created = ? "
+                "WHERE key = ? AND created = ?", (now, key, created)).rowcount:
+            return "claimed", None
+        return "busy", None
+
+    def _complete(self, key, req_id):
+        self._connect().execute(
+            "INSERT INTO idempotency_keys (key, req_id, created) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET req_id = excluded.req_id, "
+            "created = excluded.created", (key, req_id, time.time()))
+
+    def _release(self, key):
+        self._connect().execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND req_id IS NULL",
+            (key, ))
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def get(self, key):
+        return await self._run(self._get, key)
+
+    async def claim(self, key, poll_interval=0.05):
+        """Returns None once this worker owns `key` (it must complete() or
+        release() it), or the request id another worker created for it."""
+        while True:
+            state, req_id = await self._run(self._try_claim, key)
+            if state == "claimed":
+                return None
+            if state == "done":
+                return req_id
+            await asyncio.sleep(poll_interval)
+
+    async def complete(self, key, req_id):
+        await self._run(self._complete, key, req_id)
+
+    async def release(self, key):
+        await self._run(self._release, key)
+
+    def close(self):
+        self._executor.submit(self._close).result()
+        self._executor.shutdown(wait=True)
+
+
+class IdempotencyCache:
+    """Remembers which request id a submission key produced.
+
+    Entries live in a bounded LRU for IDEMPOTENCY_TTL seconds and are
+    appended to IDEMPOTENCY_INDEX_PATH, so retries are recognised across
+    restarts too. Concurrent submissions with the same key wait for the
+    first one instead of creating a second request.
+
+    With `shared` (SharedIdempotencyKeys, used when WEB_WORKERS > 1) the
+    keys are kept in the database instead of the file, and the LRU only
+    saves lookups of keys this worker has seen.
+    """
+
+    def __init__(self,
+                 path=IDEMPOTENCY_INDEX_PATH,
+                 max_entries=IDEMPOTENCY_MAX_ENTRIES,
+                 ttl=IDEMPOTENCY_TTL,
+                 shared=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # key -> (req_id, created wall time)
+        self._in_flight = {}  # key -> future of the first submission
+        self._file = None
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Reads the persisted index, dropping expired entries, and compacts it."""
+        self._entries.clear()
+        if self.shared is not None:
+            return
+        now = time.time()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        key, req_id, created = record["k"], record["id"], record["ts"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # Torn last line after a crash
+                    if now - created < self.ttl:
+                        self._entries[key] = (req_id, created)
+                        self._entries.move_to_end(key)
+            self._evict()
+            logging.info(
+                f"Loaded {len(self._entries)} idempotency keys from {self.path}")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(
+                json.dumps({"k": key, "id": req_id, "ts": created}) + '\n'
+                for key, (req_id, created) in self._entries.items())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.shared is not None:
+            self.shared.close()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns the request id stored for `key`, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        req_id, created = entry
+        if time.time() - created >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return req_id
+
+    def _remember(self, key, req_id):
+        created = time.time()
+        self._entries[key] = (req_id, created)
+        self._entries.move_to_end(key)
+        self._evict()
+        return created
+
+    async def fetch(self, key):
+        """Like get(), but also asks the shared store."""
+        req_id = self.get(key)
+        if req_id is None and self.shared is not None:
+            req_id = await self.shared.get(key)
+            if req_id is not None:
+                self._remember(key, req_id)
+        return req_id
+
+    async def claim(self, key):
+        """Returns the request id stored for `key`, or None if the caller is
+        to create the request (and put() or release() the key). Counts the
+        hit or miss (for callers not using get_or_create)."""
+        req_id = self.get(key)
+        if req_id is None and self.shared is not None:
+            req_id = await self.shared.claim(key)
+            if req_id is not None:
+                self._remember(key, req_id)
+        if req_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return req_id
+
+    async def release(self, key):
+        """Gives up a claim whose request wasn't created."""
+        if self.shared is not None:
+            await self.shared.release(key)
+
+    async def put(self, key, req_id):
+        created = self._remember(key, req_id)
+        if self.shared is not None:
+            await self.shared.complete(key, req_id)
+        elif self._file is not None:
+            self._file.write(
+                json.dumps({"k": key, "id": req_id, "ts": created}) + '\n')
+            self._file.flush()
+
+    async def get_or_create(self, key, create):
+        """Returns (req_id, duplicate). Calls `create()` only for new keys.
+
+        If `create()` raises, nothing is stored and the next submission with
+        the same key tries again.
+        """
+        req_id = self.get(key)
+        if req_id is None and key in self._in_flight:
+            req_id = await asyncio.shield(self._in_flight[key])
+        if req_id is not None:
+            self.hits += 1
+            return req_id, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            if self.shared is not None:
+                # Another worker may have created it, or be creating it
+                req_id = await self.shared.claim(key)
+                if req_id is not None:
+                    self._remember(key, req_id)
+                    self.hits += 1
+                    future.set_result(req_id)
+                    return req_id, True
+            self.misses += 1
+            try:
+                req_id = await create()
+            except BaseException:
+                await asyncio.shield(self.release(key))
+                raise
+            await self.put(key, req_id)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved, waiters get it via await
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._in_flight[key]
+        future.set_result(req_id)
+        return req_id, False
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+idempotency_cache = IdempotencyCache(
+    shared=SharedIdempotencyKeys() if WEB_WORKERS > 1 else None)
@@ -0,0 +1,161 @@
+# ingest.py
+import asyncio
+import json
+import logging
+import os
+
+from aiogram import Bot
+
+from config import INGEST_QUEUE_PATH, INGEST_QUEUE_SIZE, INGEST_WORKERS, \
+                   INGEST_MAX_ATTEMPTS, INGEST_RETRY_DELAY
+from utils import get_request_data
+
+
+class IngestQueue:
+    """Bounded queue of saved requests waiting for their manager notification.
+
+    Every enqueue and completion is appended to INGEST_QUEUE_PATH
+    ({"enq": id} / {"done": id} lines), so requests that were accepted but
+    not yet notified are picked up again after a restart. A failed
+    notification is retried with backoff; one that keeps failing is not
+    marked done, so it is retried again after the next restart.
+    """
+
+    def __init__(self,
+                 path=INGEST_QUEUE_PATH,
+                 maxsize=INGEST_QUEUE_SIZE,
+                 workers=INGEST_WORKERS,
+                 max_attempts=INGEST_MAX_ATTEMPTS,
+                 retry_delay=INGEST_RETRY_DELAY):
+        self.path = path
+        self.maxsize = maxsize
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = None
+        self._workers = []
+        self._file = None
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0  # Failed attempts
+        self.given_up = 0
+
+    def full(self):
+        return self._queue is None or self._queue.full()
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _load_pending(self):
+        """Replays the queue file and rewrites it with only unfinished ids."""
+        pending = []
+        if os.path.exists(self.path):
+            done = set()
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line after a crash
+                    if "enq" in record:
+                        pending.append(record["enq"])
+                    elif "done" in record:
+                        done.add(record["done"])
+            pending = [req_id for req_id in pending if req_id not in done]
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps({"enq": req_id}) + '\n'
+                         for req_id in pending)
+        return pending
+
+    def _log(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def start(self, bot: Bot, notify):
+        """Starts the workers; `notify(bot, req_id, req_data)` does the work."""
+        pending = self._load_pending()
+        # Never drop recovered items, even if there are more than maxsize
+        self._queue = asyncio.Queue(maxsize=max(self.maxsize, len(pending)))
+        for req_id in pending:
+            self._queue.put_nowait(req_id)
+        if pending:
+            logging.warning(
+                f"Recovered {len(pending)} queued requests from {self.path}")
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._workers = [
+            asyncio.create_task(self._worker(bot, notify),
+                                name=f"ingest-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+
+    def submit(self, req_id):
+        """Queues a saved request. Returns False if the queue is full."""
+        if self.full():
+            self.rejected += 1
+            return False
+        self._log({"enq": req_id})
+        self._queue.put_nowait(req_id)
+        self.accepted += 1
+        return True
+
+    async def stop(self, timeout=10.0):
+        """Waits (up to `timeout` seconds) for queued work, then stops.
+
+        Anything still queued stays in the queue file for the next start.
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Stopping with {self._queue.qsize()} requests still queued.")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._file.close()
+        self._file = None
+        self._queue = None
+
+    async def _worker(self, bot: Bot, notify):
+        while True:
+            req_id = await self._queue.get()
+            try:
+                notified = await self._notify(bot, notify, req_id)
+            finally:
+                self._queue.task_done()
+            if notified:
+                self._log({"done": req_id})
+
+    async def _notify(self, bot: Bot, notify, req_id):
+        """Notifies one queued request, retrying with backoff. Returns False
+        if every attempt failed (the entry then stays pending)."""
+        delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                req_data = await get_request_data(req_id)
+                if req_data is None:
+                    logging.error(f"Queued request #{req_id} not found.")
+                else:
+                    await notify(bot, req_id, req_data)
+                self.processed += 1
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                logging.exception(
+                    f"Error notifying queued request #{req_id} "
+                    f"(attempt {attempt} of {self.max_attempts})")
+            if attempt < self.max_attempts:
+                await asyncio.sleep(delay)
+                delay *= 2
+        self.given_up += 1
+        logging.error(f"Giving up on queued request #{req_id} until the next "
+                      f"start, it stays in {self.path}.")
+        return False
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,125 @@
+# journal.py
+import json
+import logging
+import os
+
+from records import json_default
+
+
+class Journal:
+    """Append-only log of data mutations, one JSON record per line.
+
+    Records look like {"op": "put", "id": "12", "data": {...}} or
+    {"op": "counter", "value": 12}. The journal is replayed on top of the
+    last snapshot on load and truncated after each compaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records_since_snapshot = 0
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def append(self, record):
+        """Appends one record and flushes it to the OS."""
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Appends several records with a single write."""
+        f = self._open()
+        f.write(''.join(
+            json.dumps(record,
+                       ensure_ascii=False,
+                       separators=(',', ':'),
+                       default=json_default) +
+            '\n' for record in records))
+        f.flush()
+        self.records_since_snapshot += len(records)
+
+    def replay(self, data, deleted=None):
+        """Applies all journal records to `data`. Returns number applied.
+
+        Ids of deleted requests are also added to the set `deleted`, if given
+        (for requests that live in a snapshot rather than in `data`).
+
+        A torn (partially written) last line from a crash is dropped and cut
+        off the file so new records start on a clean line. Corrupt lines
+        elsewhere are logged and skipped.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        good_size = 0
+        with open(self.path, 'rb') as f:
+            lines = f.readlines()
+        for i, raw_line in enumerate(lines):
+            is_last = i == len(lines) - 1
+            try:
+                if not raw_line.endswith(b'\n'):
+                    raise ValueError("incomplete line")
+                record = json.loads(raw_line)
+                _apply_record(data, record)
+                if deleted is not None and record["op"] == "delete":
+                    deleted.add(int(record["id"]))
+            except (ValueError, TypeError, KeyError) as e:
+                if is_last:
+                    logging.warning(
+                        f"Dropping torn last record of {self.path}: {e}")
+                    break
+                logging.error(
+                    f"Skipping corrupt record {i + 1} of {self.path}: {e}")
+            else:
+                applied += 1
+            good_size += len(raw_line)
+        if good_size < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_size)
+        self.records_since_snapshot = applied
+        return applied
+
+    def compact(self, data, snapshot_path):
+        """Writes `data` as a new snapshot and empties the journal.
+
+        The snapshot is written to a temp file, fsynced and renamed over the
+        old one, so a crash leaves either the old or the new snapshot intact.
+        The journal is only truncated after the rename succeeded.
+        """
+        tmp_path = f"{snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data,
+                      f,
+                      ensure_ascii=False,
+                      separators=(',', ':'),
+                      default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_path)
+        self.reset()
+
+    def reset(self):
+        """Empties the journal (after a snapshot including it was written)."""
+        self.close()
+        with open(self.path, 'w', encoding='utf-8'):
+            pass  # Truncate
+        self.records_since_snapshot = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _apply_record(data, record):
+    op = record["op"]
+    if op == "put":
+        data["requests"][str(record["id"])] = record["data"]
+    elif op == "delete":
+        data["requests"].pop(str(record["id"]), None)
+    elif op == "counter":
+        data["counter"] = int(record["value"])
+    else:
+        raise ValueError(f"unknown op {op!r}")
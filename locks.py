@@ -0,0 +1,57 @@
+# locks.py
+import asyncio
+import contextlib
+import time
+
+from config import REQUEST_LOCK_STRIPES
+
+
+class StripedLock:
+    """A fixed set of asyncio locks; a key always maps to the same stripe.
+
+    Work on different requests rarely shares a stripe, so it runs
+    concurrently, while work on the same request is serialized. Memory stays
+    constant no matter how many requests exist.
+    """
+
+    def __init__(self, stripes=REQUEST_LOCK_STRIPES):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        # Metrics
+        self.acquired = 0
+        self.contended = 0  # Acquisitions that had to wait
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _stripe(self, key):
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            index = hash(key)
+        return self._locks[index % len(self._locks)]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        lock = self._stripe(key)
+        if lock.locked():
+            self.contended += 1
+        started = time.monotonic()
+        await lock.acquire()
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+request_locks = StripedLock()
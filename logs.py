@@ -0,0 +1,260 @@
+# logs.py
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import re
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_LIMIT, \
+                   LOG_SAMPLE_WINDOW
+
+# Fields (req_id, update_id) added to every record logged in the current task
+_context = contextvars.ContextVar("log_context", default={})
+
+# Phone-like numbers: optional +, digits with spaces, dashes or brackets
+_PHONE_PATTERN = re.compile(r"(?<![\w.:/-])\+?\(?\d[\d\s()-]{7,}\d(?![\w.:/])")
+_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+_SEPARATORS = set(" ()-")
+# Loggers without client data, whose numbers runs aren't phones (an access
+# line's "200 123456" is a status and a size)
+_UNREDACTED_LOGGERS = frozenset(("aiohttp.access", ))
+
+
+def _mask_phone(match):
+    text = match.group()
+    digits = [c for c in text if c.isdigit()]
+    if len(digits) < 9 or _DATE_PATTERN.match(text):
+        return text
+    # Bare digit runs up to 10 long are Telegram ids, not phones
+    if text[0] != "+" and len(digits) <= 10 and not _SEPARATORS & set(text):
+        return text
+    return "***" + "".join(digits[-2:])
+
+
+def redact(text):
+    """Masks client phone numbers (all but the last two digits)."""
+    return _PHONE_PATTERN.sub(_mask_phone, text)
+
+
+def _redact_record(record, text):
+    return text if record.name in _UNREDACTED_LOGGERS else redact(text)
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Adds `fields` to every record logged inside the block."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Adds `fields` until the enclosing log_context() block ends."""
+    _context.set({**_context.get(), **fields})
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Dispatcher outer middleware tagging the records of an update with
+    its update_id (handlers add req_id with bind_log_context)."""
+
+    async def __call__(self, handler, event, data):
+        with log_context(update_id=getattr(event, "update_id", None)):
+            return await handler(event, data)
+
+
+@web.middleware
+async def http_log_context_middleware(request, handler):
+    """aiohttp middleware giving each HTTP request its own log context (a
+    keep-alive connection serves several requests from one task)."""
+    with log_context():
+        return await handler(request)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most `limit` records of one kind (logger, level and
+    message template) per `window` seconds; ERROR and above always pass.
+
+    The first record of a kind let through after some were dropped carries
+    `suppressed`, their number. Messages built with f-strings are a new kind
+    each time, so repetitive lines should log with %-style arguments.
+    """
+
+    def __init__(self, limit=LOG_SAMPLE_LIMIT, window=LOG_SAMPLE_WINDOW,
+                 max_kinds=1000):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.max_kinds = max_kinds
+        self._counts = {}  # kind -> [passed, suppressed] in this window
+        self._carried = {}  # kind -> suppressed in the previous window
+        self._window_end = 0.0
+        self.suppressed = 0
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        if now >= self._window_end:
+            self._carried = {
+                kind: counts[1]
+                for kind, counts in self._counts.items() if counts[1]
+            }
+            self._counts.clear()
+            self._window_end = now + self.window
+        kind = (record.name, record.levelno, record.msg)
+        counts = self._counts.get(kind)
+        if counts is None:
+            if len(self._counts) >= self.max_kinds:
+                return True
+            counts = self._counts[kind] = [0, 0]
+        if counts[0] >= self.limit:
+            counts[1] += 1
+            self.suppressed += 1
+            return False
+        counts[0] += 1
+        if self._carried:
+            suppressed = self._carried.pop(kind, 0)
+            if suppressed:
+                record.suppressed = suppressed
+        return True
+
+
+class _ContextFilter(logging.Filter):
+    """Copies the log context onto the record (it has to happen in the
+    logging task, the writer thread doesn't see it)."""
+
+    def filter(self, record):
+        context = _context.get()
+        if context:
+            record.context = context
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """Puts records on the queue unformatted: the message, arguments and
+    traceback are formatted by the writer thread. Arguments are read then,
+    so log values, not objects that keep changing. When the queue is full
+    the record is dropped and counted."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _record_fields(record):
+    fields = dict(getattr(record, "context", {}))
+    for name in ("req_id", "update_id"):  # Also accepted as extra={...}
+        value = getattr(record, name, None)
+        if value is not None:
+            fields[name] = value
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, the context
+    fields and the number of similar records suppressed before it."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": _redact_record(record, record.getMessage()),
+        }
+        entry.update(_record_fields(record))
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exception"] = _redact_record(
+                record, self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic `time - LEVEL - message` line with the context fields
+    appended and phone numbers masked."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        fields = _record_fields(record)
+        if fields:
+            text += " [" + " ".join(f"{k}={v}" for k, v in fields.items()) + "]"
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" ({suppressed} similar suppressed)"
+        return text
+
+    def format(self, record):
+        return _redact_record(record, super().format(record))
+
+
+class LogSetup:
+    """The root logger's queue handler and the thread writing its records."""
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.sampler = SamplingFilter()
+
+    def start(self, level=LOG_LEVEL, log_format=LOG_FORMAT,
+              queue_size=LOG_QUEUE_SIZE):
+        """Routes the root logger through a queue to a writer thread (stderr).
+        Safe to call again, e.g. in a spawned worker."""
+        if self.listener is not None:
+            return
+        stream = logging.StreamHandler()
+        stream.setFormatter(
+            JsonFormatter() if log_format == "json" else TextFormatter())
+        log_queue = queue.Queue(queue_size)
+        self.handler = LazyQueueHandler(log_queue)
+        self.handler.addFilter(self.sampler)
+        self.handler.addFilter(_ContextFilter())
+        root = logging.getLogger()
+        root.handlers[:] = [self.handler]
+        root.setLevel(level)
+        self.listener = QueueListener(log_queue, stream)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Writes out the queued records and stops the writer thread."""
+        if self.listener is None:
+            return
+        listener, self.listener = self.listener, None
+        try:
+            listener.stop()
+        except queue.Full:  # No room for the stop marker, the thread is a daemon
+            pass
+
+    def stats(self):
+        return {
+            "dropped": self.handler.dropped if self.handler else 0,
+            "suppressed": self.sampler.suppressed,
+        }
+
+
+log_setup = LogSetup()
@@ -1,22 +1,48 @@
 # main.py
 import asyncio
 import logging
+from datetime import datetime, timedelta
+import multiprocessing
 import os
 import json
+import signal
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
 from config import BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEB_SERVER_HOST, WEB_SERVER_PORT, \
-                   FORM_SUBMIT_PATH, FORM_SECRET
-from bot_handlers import router as main_router, create_and_notify_new_request
+                   FORM_SUBMIT_PATH, FORM_SECRET, INGEST_MODE, FORM_BATCH_PATH, WEBHOOK_MODE, \
+                   WEB_WORKERS, WORKER_INDEX, STORAGE_BACKEND, ARCHIVE_AFTER_DAYS, \
+                   ARCHIVE_INTERVAL, STATS_DIGEST_TIME, STATS_DIGEST_DAYS, EXPORT_PATH, \
+                   METRICS_PATH, TELEGRAM_API_BASE
+from bot_handlers import router as main_router, create_and_notify_new_request, \
+                         create_request, notify_new_request, client_data_from_form, \
+                         send_stats_digest, schedule_pending_escalations, \
+                         drain_broadcasts
 # Import utils to ensure data loading happens on start if needed by handlers
 import utils
+from outbound import scheduler as outbound_scheduler
+from message_updates import message_updater
+from ingest import ingest_queue
+from idempotency import idempotency_cache, idempotency_key
+from batch_intake import handle_form_batch
+from export import handle_export
+from webhook_pool import PooledRequestHandler
+from replicas import webhook_leader
+from startup import startup_report
+from routing import escalations
+from metrics import registry as metrics_registry, http_metrics_middleware, \
+                    UpdateMetricsMiddleware, ApiCallMetrics, monitor_event_loop_lag, \
+                    handle_metrics, count_error
+from app_metrics import collect_requests, collect_components, collect_webhook
+from logs import log_setup, LogContextMiddleware, http_log_context_middleware
+from tracing import tracer, tracing_middleware, UpdateTracingMiddleware, ApiCallTracing
 
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+log_setup.start()
 
 
 async def handle_form_submit(request: web.Request):
@@ -24,13 +50,15 @@ async def handle_form_submit(request: web.Request):
     received_secret = request.headers.get("X-Form-Secret")
     # Use the FORM_SECRET loaded from config (which gets from env var)
     if not received_secret or received_secret != FORM_SECRET:
-        logging.warning(f"Form submission rejected: Invalid/missing secret.")
+        logging.warning("Form submission rejected: Invalid/missing secret.")
         return web.Response(status=403, text="Forbidden: Invalid Secret")
     try:
         data = await request.json()
-        logging.info(f"Received form submission data: {data}")
-        if not all(k in data
-                   for k in ["timestamp", "name", "phone", "details"]):
+        # Field names only: the payload holds the client's personal data
+        logging.debug("Received form submission with fields %s",
+                      sorted(data) if isinstance(data, dict) else type(data))
+        client_data = client_data_from_form(data)
+        if client_data is None:
             logging.error("Form submission rejected: Missing fields.")
             return web.json_response(
                 {
@@ -38,14 +66,45 @@ async def handle_form_submit(request: web.Request):
                     "message": "Missing required fields"
                 },
                 status=400)
-        client_data = {
-            "timestamp": data.get("timestamp"),
-            "name": data.get("name"),
-            "phone": data.get("phone"),
-            "messenger": data.get("messenger", ""),
-            "details": data.get("details")
-        }
-        req_id = await create_and_notify_new_request(bot_instance, client_data)
+        key = idempotency_key(request.headers.get("Idempotency-Key"),
+                              client_data)
+        if INGEST_MODE == "queue" and ingest_queue.full() and \
+                await idempotency_cache.fetch(key) is None:
+            logging.warning("Form submission rejected: ingest queue full.")
+            return web.json_response(
+                {
+                    "status": "error",
+                    "message": "Too many submissions, retry later"
+                },
+                status=503,
+                headers={"Retry-After": "5"})
+
+        async def create():
+            if INGEST_MODE != "queue":
+                return await create_and_notify_new_request(
+                    bot_instance, client_data)
+            req_id, req_data = await create_request(client_data)
+            await utils.flush_data()  # Accepted requests must survive a restart
+            if not ingest_queue.submit(req_id):
+                # Queue filled up meanwhile, the request is saved already
+                await notify_new_request(bot_instance, req_id, req_data)
+            return req_id
+
+        req_id, duplicate = await idempotency_cache.get_or_create(key, create)
+        if duplicate:
+            logging.info("Duplicate form submission, returning request #%s",
+                         req_id)
+            return web.json_response({
+                "status": "ok",
+                "request_id": req_id,
+                "duplicate": True
+            })
+        if INGEST_MODE == "queue":
+            return web.json_response({
+                "status": "accepted",
+                "request_id": req_id
+            },
+                                     status=202)
         return web.json_response({"status": "ok", "request_id": req_id})
     except json.JSONDecodeError:
         logging.error("Form submission failed: Invalid JSON.")
@@ -55,6 +114,7 @@ async def handle_form_submit(request: web.Request):
                 "message": "Invalid JSON payload"
             }, status=400)
     except Exception as e:
+        count_error("form_submit", e)
         logging.exception("Error handling form submission:")
         return web.json_response(
             {
@@ -64,9 +124,59 @@ async def handle_form_submit(request: web.Request):
             status=500)
 
 
-async def on_startup(bot: Bot):
+_archive_task = None
+
+
+async def archive_periodically():
+    """Moves finished requests to the archive every ARCHIVE_INTERVAL seconds."""
+    while True:
+        try:
+            await utils.archive_old_requests()
+        except Exception:
+            logging.exception("Error archiving requests:")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+_digest_task = None
+_lag_task = None
+
+
+async def send_digest_daily(bot: Bot, at):
+    """Sends the stats digest to the managers every day at `at` (a time)."""
+    while True:
+        now = datetime.now()
+        next_run = datetime.combine(now.date(), at)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await send_stats_digest(bot, STATS_DIGEST_DAYS,
+                                    next_run.date() - timedelta(days=1))
+        except Exception:
+            logging.exception("Error sending the stats digest:")
+
+
+async def on_startup(bot: Bot, digest_time=None):
+    global _archive_task, _digest_task, _lag_task
     # Ensure data is loaded at least once on startup
-    utils._load_data()
+    with startup_report.phase("load"):
+        await utils.init_storage()
+        idempotency_cache.load()
+    outbound_scheduler.start()
+    _lag_task = asyncio.create_task(monitor_event_loop_lag())
+    if INGEST_MODE == "queue":
+        ingest_queue.start(bot, notify_new_request)
+
+    # With several workers only one of them manages the webhook
+    if not webhook_leader.try_acquire():
+        logging.info("Worker %s: webhook is managed by another worker.",
+                     WORKER_INDEX)
+        return
+    if ARCHIVE_AFTER_DAYS > 0:  # One archiver for all workers
+        _archive_task = asyncio.create_task(archive_periodically())
+    if digest_time is not None:
+        _digest_task = asyncio.create_task(send_digest_daily(bot, digest_time))
+    await schedule_pending_escalations(bot)
 
     if not WEBHOOK_URL:
         logging.error(
@@ -74,29 +184,45 @@ async def on_startup(bot: Bot):
         )
         return
 
-    logging.info(
-        f"Attempting to set webhook for bot {bot.id} to {WEBHOOK_URL}")
+    logging.info("Attempting to set webhook for bot %s to %s", bot.id,
+                 WEBHOOK_URL)
     try:
-        success = await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+        with startup_report.phase("webhook setup"):
+            success = await bot.set_webhook(WEBHOOK_URL,
+                                            drop_pending_updates=True)
         if success:
             logging.info("Webhook set successfully.")
             webhook_info = await bot.get_webhook_info()
-            logging.info(f"Current webhook info: {webhook_info}")
+            logging.info("Current webhook info: %s", webhook_info)
         else:
-            logging.error(f"Failed to set webhook to {WEBHOOK_URL}.")
+            logging.error("Failed to set webhook to %s.", WEBHOOK_URL)
     except Exception as e:
-        logging.exception(f"Error setting webhook ({WEBHOOK_URL}): {e}")
+        logging.exception("Error setting webhook (%s): %s", WEBHOOK_URL, e)
 
 
-async def on_shutdown(bot: Bot):
+async def on_shutdown(bot: Bot, webhook_handler=None):
     logging.warning("Shutting down.. Attempting to delete webhook.")
+    if isinstance(webhook_handler, PooledRequestHandler):
+        await webhook_handler.drain()  # Finish updates before the session closes
+    await ingest_queue.stop()  # Finish (or persist) queued notifications
+    for task in (_archive_task, _digest_task, _lag_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if webhook_leader.held:
+        try:
+            await bot.delete_webhook()
+            logging.info("Webhook deleted.")
+        except Exception as e:
+            logging.exception("Error deleting webhook: %s", e)
+        webhook_leader.release()
+    await escalations.stop()
+    await drain_broadcasts()  # They go out through the outbound scheduler
+    await message_updater.drain()  # Send coalesced edits still waiting
+    await outbound_scheduler.stop()
     # Save data one last time on shutdown
-    utils._save_data()
-    try:
-        await bot.delete_webhook()
-        logging.info("Webhook deleted.")
-    except Exception as e:
-        logging.exception(f"Error deleting webhook: {e}")
+    await utils.close_storage()
+    idempotency_cache.close()
     await bot.session.close()
     logging.warning("Bot session closed.")
 
@@ -113,28 +239,123 @@ async def main():
         logging.critical(
             "WEBHOOK_URL could not be determined from config. Exiting.")
         return
+    try:
+        digest_time = datetime.strptime(STATS_DIGEST_TIME, '%H:%M').time() \
+            if STATS_DIGEST_TIME else None
+    except ValueError:
+        logging.critical(
+            f"STATS_DIGEST_TIME {STATS_DIGEST_TIME!r} is not a 'HH:MM' time. Exiting.")
+        return
+
+    tracer.start()
 
     # Initialize Bot
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    session = AiohttpSession(api=TelegramAPIServer.from_base(
+        TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None
+    bot = Bot(token=BOT_TOKEN,
+              session=session,
+              default=DefaultBotProperties(parse_mode="HTML"))
+    bot.session.middleware(ApiCallTracing())  # Span includes the rate limit wait
+    # Pace all outbound API calls (rate limits, priorities, 429 retries)
+    bot.session.middleware(outbound_scheduler)
+    bot.session.middleware(ApiCallMetrics())  # Inside the scheduler: call time only
+    bot.session.middleware(ApiCallTracing("telegram"))  # Each attempt
 
     dp = Dispatcher()
+    dp.update.outer_middleware(LogContextMiddleware())  # update_id on log records
+    dp.update.outer_middleware(UpdateTracingMiddleware())
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
     dp.include_router(main_router)
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
-    app = web.Application()
+    # Logs the startup timing report after the first response
+    app = web.Application(middlewares=[
+        http_log_context_middleware,
+        tracing_middleware({FORM_SUBMIT_PATH: "form_submit"}),
+        startup_report.middleware,
+        http_metrics_middleware({WEBHOOK_PATH: "/webhook"}),  # No token in labels
+    ])
     # Store bot instance for handlers that need it (like form submit)
     app['bot'] = bot
 
-    webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    if WEBHOOK_MODE == "background":
+        webhook_requests_handler = PooledRequestHandler(dispatcher=dp, bot=bot)
+    else:
+        webhook_requests_handler = SimpleRequestHandler(
+            dispatcher=dp, bot=bot, handle_in_background=False)
+    dp["webhook_handler"] = webhook_requests_handler
+    dp["digest_time"] = digest_time
     webhook_requests_handler.register(app, path=WEBHOOK_PATH)
     app.router.add_post(FORM_SUBMIT_PATH, handle_form_submit)
+    app.router.add_post(FORM_BATCH_PATH, handle_form_batch)
+    app.router.add_get(EXPORT_PATH, handle_export)
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    metrics_registry.add_collector(collect_requests)
+    metrics_registry.add_collector(collect_components)
+    if isinstance(webhook_requests_handler, PooledRequestHandler):
+        metrics_registry.add_collector(collect_webhook(webhook_requests_handler))
     setup_application(app, dp, bot=bot)
 
-    # Use PORT from environment variable provided by Render/Railway
-    logging.info(f"Starting web server on {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
-    await web._run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    # SIGTERM (Railway stop, run_workers) and SIGINT end the server cleanly:
+    # on_shutdown drains the queues and flushes storage before exiting
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
 
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()  # Runs on_startup
+    try:
+        # Use PORT from environment variable provided by Render/Railway
+        site = web.TCPSite(runner,
+                           host=WEB_SERVER_HOST,
+                           port=WEB_SERVER_PORT,
+                           reuse_port=WEB_WORKERS > 1)
+        await site.start()
+        logging.info("Web server running on %s:%s (worker %s)",
+                     WEB_SERVER_HOST, WEB_SERVER_PORT, WORKER_INDEX)
+        await stop.wait()
+        logging.warning("Stop signal received.")
+    finally:
+        await runner.cleanup()  # Runs on_shutdown
 
-if __name__ == "__main__":
+
+def _run_worker():
     asyncio.run(main())
+
+
+def run_workers():
+    """Runs WEB_WORKERS processes, each a full bot serving the same port."""
+    if STORAGE_BACKEND != "sqlite":
+        logging.critical(
+            "WEB_WORKERS > 1 needs STORAGE_BACKEND=sqlite (the JSON files are single-process). Exiting."
+        )
+        return
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for index in range(WEB_WORKERS):
+        os.environ["WORKER_INDEX"] = str(index)  # Inherited by the new process
+        process = context.Process(target=_run_worker, name=f"worker-{index}")
+        process.start()
+        workers.append(process)
+
+    def stop_workers(signum, frame):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: the worker runs on_shutdown and exits
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for process in workers:
+        process.join()
+        if process.exitcode:
+            logging.error("%s exited with code %s", process.name,
+                          process.exitcode)
+
+
+if __name__ == "__main__":
+    if WEB_WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())
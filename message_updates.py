@@ -0,0 +1,136 @@
+# message_updates.py
+import asyncio
+import contextlib
+import logging
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+
+from config import EDIT_COALESCE_WINDOW, EDIT_HASH_CACHE_SIZE, WEB_WORKERS
+from fanout import fan_out
+from tracing import tracer
+
+
+def _render_hash(text, keyboard):
+    markup = keyboard.model_dump_json(exclude_none=True) if keyboard else ""
+    return hash((text, markup))
+
+
+class RequestMessageUpdater:
+    """Brings the manager messages of a request up to date with few API calls.
+
+    Updates for one request arriving within EDIT_COALESCE_WINDOW seconds are
+    merged into a single trailing edit with the latest text, and messages
+    whose last rendered text and keyboard are identical are not edited at all.
+
+    The rendered hashes are per process, so with `skip_current` off (several
+    workers, where another one may have edited the message since) every
+    edit is sent and Telegram's "message is not modified" does the skipping.
+    """
+
+    def __init__(self,
+                 window=EDIT_COALESCE_WINDOW,
+                 max_tracked=EDIT_HASH_CACHE_SIZE,
+                 skip_current=WEB_WORKERS == 1):
+        self.window = window
+        self.max_tracked = max_tracked if skip_current else 0
+        self.skip_current = skip_current
+        self._hashes = OrderedDict()  # (chat_id, message_id) -> render hash
+        self._pending = {}  # req_id -> latest (bot, text, keyboard, messages)
+        self._tasks = {}  # req_id -> task doing the trailing edit
+        self._flush_now = asyncio.Event()
+        # Metrics
+        self.edits_sent = 0
+        self.edits_skipped = 0
+        self.updates_coalesced = 0
+
+    def remember(self, chat_id, message_id, text, keyboard):
+        """Records what a message currently shows (e.g. right after sending)."""
+        if not self.skip_current:
+            return
+        key = (str(chat_id), message_id)
+        self._hashes[key] = _render_hash(text, keyboard)
+        self._hashes.move_to_end(key)
+        while len(self._hashes) > self.max_tracked:
+            self._hashes.popitem(last=False)
+
+    def is_current(self, chat_id, message_id, text, keyboard):
+        if not self.skip_current:
+            return False
+        key = (str(chat_id), message_id)
+        return self._hashes.get(key) == _render_hash(text, keyboard)
+
+    def schedule(self, bot: Bot, req_id, text, keyboard, messages):
+        """Queues an edit of all `messages` of a request to `text`/`keyboard`.
+
+        Returns the task that performs the (possibly shared) trailing edit.
+        """
+        if req_id in self._pending:
+            self.updates_coalesced += 1
+        self._pending[req_id] = (bot, text, keyboard, list(messages))
+        task = self._tasks.get(req_id)
+        if task is None:
+            task = asyncio.create_task(self._edit_after_window(req_id))
+            self._tasks[req_id] = task
+        return task
+
+    async def drain(self):
+        """Sends all pending edits without waiting for their window."""
+        self._flush_now.set()
+        try:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        finally:
+            self._flush_now.clear()
+
+    async def _edit_after_window(self, req_id):
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._flush_now.wait(), self.window)
+        finally:
+            self._tasks.pop(req_id, None)
+        await self._apply(req_id)
+
+    async def _apply(self, req_id):
+        pending = self._pending.pop(req_id, None)
+        if pending is None:
+            return
+        bot, text, keyboard, messages = pending
+        to_edit = [
+            msg_info for msg_info in messages if not self.is_current(
+                msg_info["chat_id"], msg_info["message_id"], text, keyboard)
+        ]
+        self.edits_skipped += len(messages) - len(to_edit)
+
+        async def edit_message(msg_info):
+            await bot.edit_message_text(text=text,
+                                        chat_id=msg_info["chat_id"],
+                                        message_id=msg_info["message_id"],
+                                        reply_markup=keyboard)
+
+        # Runs after the window, usually as a continuation of the callback's trace
+        with tracer.span("edit_messages", messages=len(to_edit)):
+            tracer.tag(req_id=req_id)
+            results = await fan_out(to_edit, edit_message)
+        for msg_info, result in zip(to_edit, results):
+            if result is None:
+                self.edits_sent += 1
+            elif isinstance(result, TelegramBadRequest) and \
+                    "message is not modified" in str(result):
+                self.edits_skipped += 1  # Already shows this, just remember it
+            elif isinstance(result, TelegramAPIError):  # More specific exception
+                logging.error("Failed to edit TG msg %s in chat %s for req %s: %s",
+                              msg_info['message_id'], msg_info['chat_id'],
+                              req_id, result, extra={"req_id": req_id})
+                continue
+            else:
+                logging.error(
+                    "Generic err editing TG msg %s / chat %s for req %s: %r",
+                    msg_info['message_id'], msg_info['chat_id'], req_id,
+                    result, extra={"req_id": req_id})
+                continue
+            self.remember(msg_info["chat_id"], msg_info["message_id"], text,
+                          keyboard)
+
+
+message_updater = RequestMessageUpdater()
@@ -0,0 +1,274 @@
+# metrics.py
+import asyncio
+import inspect
+import logging
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+from config import METRICS_TOKEN, EVENT_LOOP_LAG_INTERVAL
+
+# Seconds; from a cache hit (~µs) to a slow Telegram call
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> value(s)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+            for labels, value in self._series.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self._series[labels] = value
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """Cumulative bucket counts, sum and count per label set; `observe()` is
+    a bisect and three additions."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # [count per bucket (+Inf last), sum, count]
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1),
+                                             0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        for labels, (counts, total, count) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")),
+                                           counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+                )
+            label_text = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Registry:
+    """Metrics plus collectors: functions (or coroutine functions) called on
+    every scrape that return metrics computed from the existing stats() of
+    other modules."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    async def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                metrics = collect()
+                if inspect.isawaitable(metrics):
+                    metrics = await metrics
+                for metric in metrics:
+                    lines.extend(metric.render())
+            except Exception:
+                logging.exception("Metrics collector failed:")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Hot Path Instruments ---
+HTTP_SECONDS = registry.register(
+    Histogram("tgbot_http_request_seconds", "Incoming HTTP requests by route.",
+              ("route", "status")))
+UPDATE_SECONDS = registry.register(
+    Histogram("tgbot_update_seconds", "Telegram update handling by type.",
+              ("type", )))
+API_CALL_SECONDS = registry.register(
+    Histogram("tgbot_api_call_seconds",
+              "Telegram Bot API calls by method (each attempt).",
+              ("method", )))
+STORAGE_WRITE_SECONDS = registry.register(
+    Histogram("tgbot_storage_write_seconds",
+              "Batched storage writes, including the wait for the storage thread."
+              ))
+STORAGE_LOAD_SECONDS = registry.register(
+    Histogram("tgbot_storage_load_seconds", "Storage start-up load.",
+              buckets=(0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)))
+RENDER_SECONDS = registry.register(
+    Histogram("tgbot_render_seconds", "Request message rendering.",
+              ("cache", )))
+ERRORS = registry.register(
+    Counter("tgbot_errors_total", "Exceptions by place and type.",
+            ("where", "exception")))
+LOOP_LAG_SECONDS = registry.register(
+    Histogram("tgbot_event_loop_lag_seconds",
+              "How late the event loop ran a timer.",
+              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                       2.5)))
+
+
+def count_error(where, exc):
+    ERRORS.inc(where, type(exc).__name__)
+
+
+# --- Middlewares ---
+def http_metrics_middleware(route_names=None):
+    """aiohttp middleware timing every request by route. `route_names` maps
+    paths to labels (to keep secrets like the webhook token out)."""
+    route_names = route_names or {}
+
+    @web.middleware
+    async def middleware(request, handler):
+        resource = request.match_info.route.resource
+        path = resource.canonical if resource is not None else "unmatched"
+        route = route_names.get(path, path)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        except Exception as e:
+            count_error(f"http:{route}", e)
+            raise
+        finally:
+            HTTP_SECONDS.observe(time.perf_counter() - started, route,
+                                 status)
+
+    return middleware
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Dispatcher outer middleware timing update handling by update type."""
+
+    async def __call__(self, handler, event, data):
+        update_type = getattr(event, "event_type", None) or "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            count_error(f"update:{update_type}", e)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, update_type)
+
+
+class ApiCallMetrics(BaseRequestMiddleware):
+    """Session middleware timing Bot API calls (register it after the
+    outbound scheduler, so queueing isn't counted)."""
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            count_error(f"api:{method_name}", e)
+            raise
+        finally:
+            API_CALL_SECONDS.observe(time.perf_counter() - started,
+                                     method_name)
+
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """Sleeps `interval` seconds at a time and records how much later than
+    asked the loop woke it up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - interval))
+
+
+async def handle_metrics(request: web.Request):
+    if METRICS_TOKEN and request.headers.get(
+            "Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=403, text="Forbidden")
+    return web.Response(
+        body=(await registry.render()).encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
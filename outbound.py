@@ -0,0 +1,292 @@
+# outbound.py
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, SendMessage, EditMessageText, \
+                            EditMessageReplyMarkup
+
+from config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, \
+                   OUTBOUND_MAX_RETRIES
+
+# --- Priority Classes --- (lower value goes first)
+PRIORITY_CALLBACK = 0  # Callback answers, the user is staring at a spinner
+PRIORITY_LIVE = 1  # New request notifications and edits of live requests
+PRIORITY_BROADCAST = 2  # Informational messages to other managers
+PRIORITY_NAMES = {
+    PRIORITY_CALLBACK: "callback",
+    PRIORITY_LIVE: "live",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Only these methods go through the queue, everything else is sent directly
+_METHOD_PRIORITIES = {
+    AnswerCallbackQuery: PRIORITY_CALLBACK,
+    EditMessageText: PRIORITY_LIVE,
+    EditMessageReplyMarkup: PRIORITY_LIVE,
+    SendMessage: PRIORITY_LIVE,
+}
+
+_priority_override = contextvars.ContextVar("outbound_priority", default=None)
+_attempt_timeout = contextvars.ContextVar("outbound_attempt_timeout",
+                                          default=None)
+
+
+@contextlib.contextmanager
+def outbound_priority(priority):
+    """Sends all API calls made inside the block with the given priority."""
+    token = _priority_override.set(priority)
+    try:
+        yield
+    finally:
+        _priority_override.reset(token)
+
+
+@contextlib.contextmanager
+def attempt_timeout(seconds):
+    """Limits each attempt at Telegram made inside the block to `seconds`.
+
+    Only the request itself counts: the wait for a rate limit slot and the
+    pauses before 429 retries don't, so a long retry_after can't cancel a
+    call that would have gone through.
+    """
+    token = _attempt_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _attempt_timeout.reset(token)
+
+
+async def _attempt(make_request, bot, method):
+    timeout = _attempt_timeout.get()
+    if timeout is None:
+        return await make_request(bot, method)
+    return await asyncio.wait_for(make_request(bot, method), timeout)
+
+
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Hands out no tokens for `seconds` (used after a 429)."""
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+
+class _Job:
+    __slots__ = ("priority", "chat_id", "future", "enqueued")
+
+    def __init__(self, priority, chat_id, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Session middleware that paces outbound Telegram API calls.
+
+    Calls wait in per-priority queues until both the global and the per-chat
+    token bucket allow them; the call itself still runs in the caller's task.
+    A TelegramRetryAfter pauses the affected bucket and the call is retried
+    up to OUTBOUND_MAX_RETRIES times. Until `start()` is called every request
+    goes straight through.
+    """
+
+    def __init__(self,
+                 global_rate=OUTBOUND_GLOBAL_RATE,
+                 chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST,
+                 max_retries=OUTBOUND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Metrics
+        self.sent = {priority: 0 for priority in PRIORITY_NAMES}
+        self.retried = 0
+        self.wait_total = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.wait_max = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(
+                self._dispatch(), name="outbound-scheduler")
+
+    async def stop(self, timeout=5.0):
+        """Lets queued calls go out (up to `timeout` seconds), then stops."""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue_depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        for queue in self._queues.values():  # Anything left goes out unpaced
+            while queue:
+                job = queue.popleft()
+                if not job.future.done():
+                    job.future.set_result(None)
+
+    # --- Metrics ---
+    def queue_depth(self, priority=None):
+        if priority is not None:
+            return len(self._queues[priority])
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        """Returns queue depth and wait times per priority class."""
+        result = {"retried": self.retried}
+        for priority, name in PRIORITY_NAMES.items():
+            sent = self.sent[priority]
+            result[name] = {
+                "queued": len(self._queues[priority]),
+                "sent": sent,
+                "wait_avg": self.wait_total[priority] / sent if sent else 0.0,
+                "wait_max": self.wait_max[priority],
+            }
+        return result
+
+    # --- Middleware ---
+    async def __call__(self, make_request, bot, method):
+        priority = _METHOD_PRIORITIES.get(type(method))
+        if self._task is None or priority is None:
+            return await _attempt(make_request, bot, method)
+        override = _priority_override.get()
+        if override is not None:
+            priority = override
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None:
+            chat_id = str(chat_id)  # Manager ids are configured as strings
+
+        attempt = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            try:
+                return await _attempt(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retried += 1
+                # Honor Telegram's hint, backing off further on repeated 429s
+                pause = e.retry_after * attempt
+                logging.warning(
+                    "Flood control on %s (chat %s), retry %d/%d in %ss",
+                    type(method).__name__, chat_id, attempt, self.max_retries,
+                    pause)
+                bucket = self._chats.get(chat_id) if chat_id else self._global
+                (bucket or self._global).pause(pause)
+                self._wakeup.set()
+
+    async def _acquire(self, priority, chat_id):
+        job = _Job(priority, chat_id, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(job)
+        self._wakeup.set()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            with contextlib.suppress(ValueError):
+                self._queues[priority].remove(job)
+            raise
+        waited = time.monotonic() - job.enqueued
+        self.sent[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        """Returns (job, 0) for the next sendable job or (None, seconds to wait)."""
+        wait = None
+        for priority in sorted(self._queues):
+            blocked_chats = set()
+            for job in self._queues[priority]:
+                if job.chat_id is None:
+                    return job, 0.0
+                if job.chat_id in blocked_chats:
+                    continue  # Keep order within a chat
+                delay = self._chat_bucket(job.chat_id).delay(now)
+                if delay == 0:
+                    return job, 0.0
+                blocked_chats.add(job.chat_id)
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _sleep(self, seconds):
+        self._wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+
+    async def _dispatch(self):
+        while True:
+            if not self.queue_depth():
+                await self._sleep(None)
+                continue
+            now = time.monotonic()
+            delay = self._global.delay(now)
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+            job, delay = self._pick(now)
+            if job is None:
+                await self._sleep(delay)
+                continue
+            self._queues[job.priority].remove(job)
+            self._global.consume(now)
+            if job.chat_id is not None:
+                self._chat_bucket(job.chat_id).consume(now)
+            if not job.future.done():
+                job.future.set_result(None)
+            # Drop idle chat buckets so the dict doesn't grow forever
+            if len(self._chats) > 1000:
+                self._chats = {
+                    chat_id: bucket
+                    for chat_id, bucket in self._chats.items()
+                    if now - bucket.updated < 60 or bucket.paused_until > now
+                }
+
+
+scheduler = OutboundScheduler()
@@ -0,0 +1,241 @@
+# records.py
+import sys
+from array import array
+from enum import IntEnum
+
+from config import STATUS_NEW, STATUS_WILL_COME, STATUS_CANCELED_CLIENT, \
+                   STATUS_ALERTED, STATUS_COMPLETED
+
+
+class StatusCode(IntEnum):
+    NEW = 0
+    WILL_COME = 1
+    CANCELED_CLIENT = 2
+    ALERTED = 3
+    COMPLETED = 4
+
+
+STATUS_TEXTS = {
+    StatusCode.NEW: STATUS_NEW,
+    StatusCode.WILL_COME: STATUS_WILL_COME,
+    StatusCode.CANCELED_CLIENT: STATUS_CANCELED_CLIENT,
+    StatusCode.ALERTED: STATUS_ALERTED,
+    StatusCode.COMPLETED: STATUS_COMPLETED,
+}
+_STATUS_CODES = {text: code for code, text in STATUS_TEXTS.items()}
+
+# Persisted keys held in plain slots, in the order they are written
+_FIELDS = ("form_timestamp", "client_name", "client_phone", "client_messenger",
+           "raw_event_details", "claimed_by_name", "claimed_timestamp",
+           "last_updated_by_name", "last_updated_timestamp")
+# Few distinct values, shared between records
+_INTERNED_FIELDS = frozenset(("claimed_by_name", "last_updated_by_name"))
+_KEY_ORDER = (*_FIELDS[:5], "status", *_FIELDS[5:], "messages", "version")
+_KEY_BITS = {key: 1 << i for i, key in enumerate(_KEY_ORDER)}
+_DEFAULTS = {"status": STATUS_NEW, "messages": [], "version": 0}  # Others: None
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class RequestRecord:
+    """Compact in-memory form of a request.
+
+    Known statuses are stored as a StatusCode (others, like the per-manager
+    "claimed" texts, as one interned string), manager messages as flat
+    (chat_id, message_id) pairs in an array, and unknown keys in `extra`.
+    `from_dict(d).to_dict() == d` for every persisted request.
+
+    Supports the dict-style access the older code uses (`record["status"]`,
+    `record.get("messages", [])`) next to attributes.
+    """
+
+    __slots__ = (*_FIELDS, "_status", "_messages", "version", "_present",
+                 "extra")
+
+    def __init__(self):
+        for field in _FIELDS:
+            setattr(self, field, None)
+        self._status = StatusCode.NEW
+        self._messages = array('q')
+        self.version = 0
+        self._present = 0  # Bit per key of _KEY_ORDER present in the dict form
+        self.extra = None  # Keys this model doesn't know, kept as they are
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls()
+        present = 0
+        extra = None
+        for key, value in data.items():
+            bit = _KEY_BITS.get(key)
+            if bit is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+                continue
+            present |= bit
+            if key == "status":
+                record.status = value
+            elif key == "messages":
+                record.messages = value
+            elif key == "version":
+                record.version = value
+            elif key in _INTERNED_FIELDS:
+                setattr(record, key, _intern(value))
+            else:
+                setattr(record, key, value)
+        record._present = present
+        record.extra = extra
+        return record
+
+    def to_dict(self):
+        data = {}
+        present = self._present
+        for key in _KEY_ORDER:
+            value = self[key]
+            # Keys that were never there and still hold the default stay absent
+            if not present & _KEY_BITS[key] and value == _DEFAULTS.get(key):
+                continue
+            data[key] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def copy(self):
+        record = RequestRecord.__new__(RequestRecord)
+        for field in _FIELDS:
+            setattr(record, field, getattr(self, field))
+        record._status = self._status
+        messages = self._messages
+        record._messages = array('q', messages) if type(
+            messages) is array else [dict(m) for m in messages]
+        record.version = self.version
+        record._present = self._present
+        record.extra = dict(self.extra) if self.extra else None
+        return record
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __eq__(self, other):
+        if isinstance(other, RequestRecord):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __repr__(self):
+        return f"RequestRecord({self.to_dict()!r})"
+
+    # --- Status ---
+    @property
+    def status(self):
+        status = self._status
+        return STATUS_TEXTS[status] if type(status) is StatusCode else status
+
+    @status.setter
+    def status(self, value):
+        code = _STATUS_CODES.get(value)
+        self._status = code if code is not None else _intern(value)
+        self._present |= _KEY_BITS["status"]
+
+    @property
+    def status_code(self):
+        """The StatusCode, or None for statuses outside the fixed set."""
+        status = self._status
+        return status if type(status) is StatusCode else None
+
+    # --- Manager messages ---
+    @property
+    def messages(self):
+        """[{"chat_id": ..., "message_id": ...}, ...] (a new list)."""
+        if type(self._messages) is not array:
+            return [dict(m) for m in self._messages]
+        pairs = self._messages
+        return [{
+            "chat_id": pairs[i],
+            "message_id": pairs[i + 1]
+        } for i in range(0, len(pairs), 2)]
+
+    @messages.setter
+    def messages(self, value):
+        pairs = array('q')
+        for message in value or ():
+            chat_id, message_id = message.get("chat_id"), message.get(
+                "message_id")
+            if len(message) != 2 or type(chat_id) is not int or \
+                    type(message_id) is not int:
+                # Not the usual shape, keep it verbatim
+                self._messages = [dict(m) for m in value]
+                break
+            pairs.append(chat_id)
+            pairs.append(message_id)
+        else:
+            self._messages = pairs
+        self._present |= _KEY_BITS["messages"]
+
+    def message_ids(self):
+        """Yields (chat_id, message_id) of the manager messages."""
+        if type(self._messages) is not array:
+            for message in self._messages:
+                yield message.get("chat_id"), message.get("message_id")
+            return
+        pairs = self._messages
+        for i in range(0, len(pairs), 2):
+            yield pairs[i], pairs[i + 1]
+
+    # --- Dict-style access ---
+    def __getitem__(self, key):
+        if key == "status":
+            return self.status
+        if key == "messages":
+            return self.messages
+        if key == "version":
+            return self.version
+        if key in _KEY_BITS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _KEY_BITS:
+            setattr(self, key, _intern(value) if key in _INTERNED_FIELDS else value)
+            self._present |= _KEY_BITS[key]
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in _KEY_BITS:
+            return bool(self._present & _KEY_BITS[key]) or \
+                self[key] is not None
+        return bool(self.extra) and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        if value is None and key not in self:
+            return default
+        return value
+
+
+def to_record(data):
+    """Returns `data` as a RequestRecord (records are returned as they are)."""
+    if isinstance(data, RequestRecord):
+        return data
+    return RequestRecord.from_dict(data)
+
+
+def json_default(obj):
+    """`default=` hook so json.dump(s) can write records."""
+    if isinstance(obj, RequestRecord):
+        return obj.to_dict()
+    raise TypeError(
+        f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,130 @@
+# render_cache.py
+import time
+from collections import OrderedDict
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import RENDER_CACHE_SIZE
+from metrics import RENDER_SECONDS
+from records import to_record
+from utils import format_request_header, format_request_status
+
+
+class KeyboardTemplate:
+    """A keyboard layout with the request id left open.
+
+    `rows` holds (button text, callback data format) pairs, e.g.
+    ("🏁", "complete|{req_id}"). Buttons are built without pydantic
+    validation, the layout was checked once when the template was made.
+    """
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows if row]
+        # Build once with validation so a broken layout fails at import time
+        self._build(0, InlineKeyboardButton)
+
+    def _build(self, req_id, button=InlineKeyboardButton.model_construct):
+        return InlineKeyboardMarkup.model_construct(inline_keyboard=[[
+            button(text=text, callback_data=data.format(req_id=req_id))
+            for text, data in row
+        ] for row in self.rows])
+
+    def build(self, req_id):
+        return self._build(req_id)
+
+
+class _LRU(OrderedDict):
+
+    def __init__(self, max_entries):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+
+    def lookup(self, key):
+        value = self.get(key)
+        if value is not None:
+            self.move_to_end(key)
+        return value
+
+
+class RenderCache:
+    """Bounded caches of request texts and keyboards.
+
+    Texts are keyed by (request id, record version, view), where the view is
+    the (target_status, processed_by_name) pair a message is rendered for;
+    a saved change bumps the version, so stale entries are never served.
+    The client part of the text (name, phone, events, form time) is kept
+    per request and reused across versions. Keyboards depend on the layout
+    and the id only.
+    """
+
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self._texts = _LRU(max_entries)
+        self._headers = _LRU(max_entries)  # req_id -> (source fields, text)
+        self._keyboards = _LRU(max_entries)
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.keyboard_hits = 0
+        self.keyboard_misses = 0
+
+    def request_text(self, req_id, req_data, target_status=None,
+                     processed_by_name=None):
+        """format_request_message(), cached."""
+        started = time.perf_counter()
+        record = to_record(req_data)
+        key = (req_id, record.version, target_status, processed_by_name)
+        text = self._texts.lookup(key)
+        if text is not None:
+            self.hits += 1
+            RENDER_SECONDS.observe(time.perf_counter() - started, "hit")
+            return text
+        self.misses += 1
+        text = self._header(req_id, record) + format_request_status(
+            record, target_status, processed_by_name)
+        self._texts.put(key, text)
+        RENDER_SECONDS.observe(time.perf_counter() - started, "miss")
+        return text
+
+    def _header(self, req_id, record):
+        source = (record.client_name, record.client_phone,
+                  record.client_messenger, record.raw_event_details,
+                  record.form_timestamp)
+        cached = self._headers.lookup(req_id)
+        if cached is not None and cached[0] == source:
+            return cached[1]
+        header = format_request_header(req_id, record)
+        self._headers.put(req_id, (source, header))
+        return header
+
+    def keyboard(self, template: KeyboardTemplate, req_id):
+        key = (id(template), req_id)
+        markup = self._keyboards.lookup(key)
+        if markup is not None:
+            self.keyboard_hits += 1
+            return markup
+        self.keyboard_misses += 1
+        markup = template.build(req_id)
+        self._keyboards.put(key, markup)
+        return markup
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        keyboard_lookups = self.keyboard_hits + self.keyboard_misses
+        return {
+            "texts": len(self._texts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "keyboards": len(self._keyboards),
+            "keyboard_hit_rate":
+            self.keyboard_hits / keyboard_lookups if keyboard_lookups else 0.0,
+        }
+
+
+render_cache = RenderCache()
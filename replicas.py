@@ -0,0 +1,56 @@
+# replicas.py
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows (local development only)
+    fcntl = None
+
+from config import WEBHOOK_LEADER_LOCK_PATH
+
+
+class LeaderLock:
+    """Exclusive, non-blocking file lock marking one process as the leader.
+
+    The OS releases the lock when the holding process exits, so a crashed
+    leader never blocks the next start.
+    """
+
+    def __init__(self, path=WEBHOOK_LEADER_LOCK_PATH):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def try_acquire(self):
+        """Returns True if this process is (now) the leader."""
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            self._fd = -1
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        logging.info(f"Process {os.getpid()} holds {self.path}.")
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self._fd >= 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
+
+
+webhook_leader = LeaderLock()
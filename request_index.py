@@ -0,0 +1,133 @@
+# request_index.py
+from bisect import bisect_left, insort
+
+from config import STATUS_NEW, STATUS_CLAIMED_PREFIX, TERMINAL_STATUSES
+from records import STATUS_TEXTS
+
+_GROUP_BY_STATUS = {text: code.name.lower() for code, text in STATUS_TEXTS.items()}
+STATUS_GROUPS = (*_GROUP_BY_STATUS.values(), "claimed")
+STATUS_GROUP_LABELS = {
+    **{group: text for text, group in _GROUP_BY_STATUS.items()},
+    "claimed": STATUS_CLAIMED_PREFIX,
+}
+
+
+def status_group(status):
+    """Groups statuses for queries: a StatusCode name, "claimed" for any
+    manager's claimed status, or "other"."""
+    group = _GROUP_BY_STATUS.get(status)
+    if group is not None:
+        return group
+    if status and status.startswith(STATUS_CLAIMED_PREFIX):
+        return "claimed"
+    return "other"
+
+
+def _index_keys(req_data):
+    status = req_data.get("status") or STATUS_NEW
+    is_open = status not in TERMINAL_STATUSES
+    keys = [("status", status_group(status))]
+    manager = req_data.get("claimed_by_name")
+    if manager:
+        keys.append(("manager", manager))
+        if is_open:
+            keys.append(("open_manager", manager))
+    form_timestamp = req_data.get("form_timestamp")
+    if form_timestamp:
+        keys.append(("day", str(form_timestamp)[:10]))
+    if is_open:
+        keys.append(("open", ))
+    return tuple(keys)
+
+
+class RequestIndex:
+    """In-memory secondary indexes over the stored requests.
+
+    Each key (("open",), ("status", group), ("manager", name),
+    ("open_manager", name), ("day", "YYYY-MM-DD")) maps to a sorted list of
+    request ids. `update()` is called on every save and only touches the
+    keys that changed, queries walk the lists from the newest id, so both
+    cost O(changed keys) / O(page) rather than O(history).
+    """
+
+    def __init__(self):
+        self._ids = {}  # key -> sorted list of request ids
+        self._keys = {}  # req_id -> keys it is listed under
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self._ids.clear()
+        self._keys.clear()
+
+    def update(self, req_id, req_data):
+        """(Re)indexes a request, a RequestRecord or any dict with its
+        status, claimed_by_name and form_timestamp."""
+        req_id = int(req_id)
+        new_keys = _index_keys(req_data)
+        old_keys = self._keys.get(req_id, ())
+        if new_keys == old_keys:
+            return
+        for key in old_keys:
+            if key not in new_keys:
+                self._discard(key, req_id)
+        for key in new_keys:
+            if key not in old_keys:
+                insort(self._ids.setdefault(key, []), req_id)
+        self._keys[req_id] = new_keys
+
+    def remove(self, req_id):
+        req_id = int(req_id)
+        for key in self._keys.pop(req_id, ()):
+            self._discard(key, req_id)
+
+    def _discard(self, key, req_id):
+        ids = self._ids.get(key)
+        if not ids:
+            return
+        position = bisect_left(ids, req_id)
+        if position < len(ids) and ids[position] == req_id:
+            del ids[position]
+        if not ids:
+            del self._ids[key]
+
+    def ids(self, key):
+        """All ids under `key`, oldest first (a copy)."""
+        return list(self._ids.get(key, ()))
+
+    def count(self, key):
+        return len(self._ids.get(key, ()))
+
+    def ids_between(self, kind, low=None, high=None):
+        """Set of the ids under every (kind, value) key with low <= value
+        < high (either bound optional), e.g. a range of days."""
+        found = set()
+        for key, ids in self._ids.items():
+            if key[0] == kind and (low is None or key[1] >= low) and \
+                    (high is None or key[1] < high):
+                found.update(ids)
+        return found
+
+    def page(self, key, before=None, limit=10, within=None):
+        """Returns (ids, next cursor): up to `limit` ids under `key`, newest
+        first, below `before`. With `within`, only ids also under that key.
+        The cursor is None on the last page."""
+        ids = self._ids.get(key, [])
+        end = bisect_left(ids, before) if before is not None else len(ids)
+        found = []
+        position = end
+        while position > 0 and len(found) <= limit:  # One extra: is there more?
+            position -= 1
+            req_id = ids[position]
+            if within is None or within in self._keys[req_id]:
+                found.append(req_id)
+        if len(found) > limit:
+            return found[:limit], found[limit - 1]
+        return found, None
+
+    def stats(self):
+        return {"requests": len(self._keys), "keys": len(self._ids)}
+
+
+request_index = RequestIndex()
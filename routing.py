@@ -0,0 +1,189 @@
+# routing.py
+import asyncio
+import logging
+from datetime import datetime
+from itertools import count
+
+from config import MANAGERS, MANAGER_SHIFTS, ROUTING_STRATEGY, ROUTING_FANOUT, \
+                   ROUTING_GROUP_CHAT_ID, ROUTING_GROUP_THREAD_ID
+from utils import count_requests
+
+
+async def open_request_counts(manager_ids):
+    """Live counts of open requests claimed by each manager, {id: count}
+    (from the shared database with several workers)."""
+    counts = await count_requests(
+        [("open_manager", MANAGERS[manager_id]['name'])
+         for manager_id in manager_ids])
+    return dict(zip(manager_ids, counts))
+
+
+def on_duty(manager_id, now=None):
+    shifts = MANAGER_SHIFTS.get(manager_id)
+    if not shifts:
+        return True
+    current = (now or datetime.now()).strftime('%H:%M')
+    for start, end in shifts:
+        if start <= end and start <= current < end:
+            return True
+        if start > end and (current >= start or current < end):  # Over midnight
+            return True
+    return False
+
+
+class RoutingStrategy:
+    """Picks the chats a new request is sent to.
+
+    `recipients()` (a coroutine) returns manager ids (or the group chat id)
+    for a new request, every manager unless a strategy overrides it;
+    `escalates` tells whether managers left out should get the request if it
+    stays unclaimed.
+    """
+
+    name = None
+    escalates = True
+
+    async def recipients(self, req_id, req_data):
+        return list(MANAGERS)
+
+    def send_options(self, chat_id):
+        """Extra bot.send_message() arguments for a recipient."""
+        return {}
+
+
+class AllManagers(RoutingStrategy):
+    name = "all"
+    escalates = False
+
+
+class RoundRobin(RoutingStrategy):
+    name = "round_robin"
+
+    def __init__(self, fanout=ROUTING_FANOUT):
+        self.fanout = fanout
+        self._turn = count()
+
+    async def recipients(self, req_id, req_data):
+        manager_ids = list(MANAGERS)
+        first = next(self._turn) % len(manager_ids)
+        return [manager_ids[(first + i) % len(manager_ids)]
+                for i in range(min(self.fanout, len(manager_ids)))]
+
+
+class LeastOpen(RoutingStrategy):
+    """The managers with the fewest open requests (ties go round robin)."""
+
+    name = "least_open"
+
+    def __init__(self, fanout=ROUTING_FANOUT):
+        self.fanout = fanout
+        self._turn = count()
+
+    async def _pick(self, manager_ids):
+        if not manager_ids:
+            return []
+        turn = next(self._turn)
+        rotated = [manager_ids[(turn + i) % len(manager_ids)]
+                   for i in range(len(manager_ids))]
+        counts = await open_request_counts(rotated)
+        return sorted(rotated, key=counts.get)[:self.fanout]
+
+    async def recipients(self, req_id, req_data):
+        return await self._pick(list(MANAGERS))
+
+
+class Shifts(LeastOpen):
+    """The managers on duty (least open first, at most `fanout`); everyone
+    if nobody is on duty."""
+
+    name = "shifts"
+
+    async def recipients(self, req_id, req_data):
+        now = datetime.now()
+        return await self._pick([m for m in MANAGERS if on_duty(m, now)]) or \
+            list(MANAGERS)
+
+
+class SharedGroup(RoutingStrategy):
+    """One message in a group chat (or forum topic) any manager can claim."""
+
+    name = "group"
+
+    def __init__(self, chat_id=ROUTING_GROUP_CHAT_ID,
+                 thread_id=ROUTING_GROUP_THREAD_ID):
+        if not chat_id:
+            raise ValueError("ROUTING_STRATEGY=group needs ROUTING_GROUP_CHAT_ID")
+        self.chat_id = str(chat_id)
+        self.thread_id = thread_id
+
+    async def recipients(self, req_id, req_data):
+        return [self.chat_id]
+
+    def send_options(self, chat_id):
+        if str(chat_id) == self.chat_id and self.thread_id:
+            return {"message_thread_id": self.thread_id}
+        return {}
+
+
+ROUTING_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (AllManagers, RoundRobin, LeastOpen, Shifts, SharedGroup)
+}
+
+
+def create_routing(name):
+    """Returns a strategy instance for a ROUTING_STRATEGIES name."""
+    try:
+        return ROUTING_STRATEGIES[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown ROUTING_STRATEGY {name!r}, expected one of {sorted(ROUTING_STRATEGIES)}"
+        ) from None
+
+
+class EscalationTimers:
+    """One pending timer per request; firing starts `callback(req_id)`."""
+
+    def __init__(self):
+        self._handles = {}  # req_id -> asyncio.TimerHandle
+        self._tasks = set()
+        # Metrics
+        self.scheduled = 0
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._handles)
+
+    def schedule(self, req_id, delay, callback):
+        self.cancel(req_id)
+        loop = asyncio.get_running_loop()
+        self._handles[req_id] = loop.call_later(delay, self._fire, req_id,
+                                                callback)
+        self.scheduled += 1
+
+    def _fire(self, req_id, callback):
+        self._handles.pop(req_id, None)
+        self.fired += 1
+        task = asyncio.create_task(callback(req_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Escalation failed: {task.exception()!r}")
+
+    def cancel(self, req_id):
+        handle = self._handles.pop(req_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    async def stop(self):
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+routing = create_routing(ROUTING_STRATEGY)
+escalations = EscalationTimers()
@@ -0,0 +1,176 @@
+# snapshot.py
+import json
+import mmap
+import os
+import struct
+from itertools import islice, repeat
+
+from records import json_default
+
+# File layout: header, one compact JSON document per request, the index
+# (fixed-size entries sorted by request id, so lookups are a binary search
+# over the mapped file and nothing is decoded up front), then the summaries:
+# the SUMMARY_FIELDS values of each request in index order, enough to index
+# requests and count stats without decoding them, as JSON arrays of up to
+# _SUMMARY_CHUNK requests one per line (a reader thread lets go of the GIL
+# between lines).
+MAGIC = b"TGBSNAP2"
+_MAGIC_V1 = b"TGBSNAP1"  # Without summaries, still read
+# magic, counter, request count, index offset, summaries offset
+_HEADER = struct.Struct("<8sqQQQ")
+_HEADER_V1 = struct.Struct("<8sqQQ")
+_ENTRY = struct.Struct("<qQIB")  # request id, offset, length, flags
+FLAG_TERMINAL = 1  # Request is finished, not decoded on load
+SUMMARY_FIELDS = ("status", "claimed_by_name", "form_timestamp",
+                  "claimed_timestamp", "last_updated_timestamp",
+                  "last_updated_by_name")
+_SUMMARY_CHUNK = 4096
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a binary snapshot file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotError(f"{path} is too short")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(_MAGIC_V1)] == _MAGIC_V1:
+            magic, self.counter, self.count, self._index_offset = \
+                _HEADER_V1.unpack_from(self._mm, 0)
+            magic, self._summaries_offset = MAGIC, None
+            index_end = size
+        else:
+            magic, self.counter, self.count, self._index_offset, \
+                self._summaries_offset = _HEADER.unpack_from(self._mm, 0)
+            index_end = self._summaries_offset
+        if magic != MAGIC or index_end > size or \
+                self._index_offset + self.count * _ENTRY.size != index_end:
+            self._mm.close()
+            raise SnapshotError(f"{path} is not a valid snapshot")
+
+    def __len__(self):
+        return self.count
+
+    def entries(self, start=0):
+        """Yields (req_id, offset, length, flags) in id order, from the
+        `start`-th one."""
+        return _ENTRY.iter_unpack(
+            self._mm[self._index_offset + start * _ENTRY.size:
+                     self._index_offset + self.count * _ENTRY.size])
+
+    def _entry(self, position):
+        return _ENTRY.unpack_from(self._mm,
+                                  self._index_offset + position * _ENTRY.size)
+
+    def _find(self, req_id):
+        position = self.position_after(req_id - 1)
+        if position < self.count:
+            entry = self._entry(position)
+            if entry[0] == req_id:
+                return entry
+        return None
+
+    def position_after(self, req_id):
+        """Position in entries() of the first request with an id above
+        `req_id`."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] <= req_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, req_id):
+        return self._find(req_id) is not None
+
+    def summaries(self, start=0):
+        """Iterates over the SUMMARY_FIELDS values of every request in
+        entries(start) order; None for a file written before they were added.
+        Only the lines from `start` on are parsed."""
+        if self._summaries_offset is None:
+            return None
+        lines = self._mm[self._summaries_offset:].splitlines()
+        first, skip = divmod(start, _SUMMARY_CHUNK)
+        summaries = (summary for line in lines[first:]
+                     for summary in json.loads(line))
+        return islice(summaries, skip, None)
+
+    def decode(self, offset, length):
+        return json.loads(self._mm[offset:offset + length])
+
+    def get(self, req_id):
+        """Decodes one request, or returns None if it isn't in the snapshot."""
+        entry = self._find(req_id)
+        if entry is None:
+            return None
+        return self.decode(entry[1], entry[2])
+
+    def raw(self, offset, length):
+        return self._mm[offset:offset + length]
+
+    def close(self):
+        self._mm.close()
+
+
+def write_snapshot(path, counter, requests, is_terminal, base=None,
+                   dropped=()):
+    """Writes a snapshot of `requests` (id str -> request) plus every record of
+    `base` not in `requests` or `dropped`, which is copied without decoding.
+
+    Written to a temp file, fsynced and renamed, like the JSON snapshot.
+    """
+    records = {int(req_id): req_data for req_id, req_data in requests.items()}
+    carried = {}
+    if base is not None:
+        base_summaries = base.summaries() or repeat(None)
+        for (req_id, offset, length, flags), summary in zip(
+                base.entries(), base_summaries):
+            if req_id not in records and req_id not in dropped:
+                carried[req_id] = (offset, length, flags, summary)
+    index = []
+    summaries = []
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"\0" * _HEADER.size)
+        offset = _HEADER.size
+        for req_id in sorted(records.keys() | carried.keys()):
+            req_data = records.get(req_id)
+            if req_data is not None:
+                blob = json.dumps(req_data,
+                                  ensure_ascii=False,
+                                  separators=(',', ':'),
+                                  default=json_default).encode('utf-8')
+                flags = FLAG_TERMINAL if is_terminal(req_data) else 0
+                summary = None
+            else:
+                base_offset, length, flags, summary = carried[req_id]
+                blob = base.raw(base_offset, length)
+            if summary is None:  # From a version 1 base: decoded once
+                source = req_data if req_data is not None else json.loads(blob)
+                summary = [source.get(name) for name in SUMMARY_FIELDS]
+            f.write(blob)
+            index.append(_ENTRY.pack(req_id, offset, len(blob), flags))
+            summaries.append(summary)
+            offset += len(blob)
+        f.write(b"".join(index))
+        summaries_offset = offset + len(index) * _ENTRY.size
+        for start in range(0, len(summaries), _SUMMARY_CHUNK):
+            f.write(json.dumps(summaries[start:start + _SUMMARY_CHUNK],
+                               ensure_ascii=False,
+                               separators=(',', ':'),
+                               default=json_default).encode('utf-8') + b"\n")
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, counter, len(index), offset,
+                             summaries_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,42 @@
+# startup.py
+import contextlib
+import logging
+import time
+
+from aiohttp import web
+
+
+class StartupReport:
+    """Times the phases of a cold start and logs them once the first
+    request has been served."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}  # name -> seconds
+        self.first_request = None  # Seconds from start to first response
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - phase_start
+
+    def request_served(self):
+        if self.first_request is not None:
+            return
+        self.first_request = time.monotonic() - self.started
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms"
+                           for name, seconds in self.phases.items())
+        logging.info(f"Startup: {phases}; first request served after "
+                     f"{self.first_request * 1000:.0f} ms")
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        response = await handler(request)
+        self.request_served()
+        return response
+
+
+startup_report = StartupReport()
@@ -0,0 +1,263 @@
+# stats.py
+from bisect import bisect_left
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from config import MANAGERS, STATUS_COMPLETED, STATUS_CANCELED_CLIENT, \
+                   STATS_RETAIN_DAYS
+from request_index import request_index, status_group, STATUS_GROUPS, \
+                          STATUS_GROUP_LABELS
+
+# Upper bounds (seconds) of the claim latency buckets, one more bucket above
+LATENCY_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600,
+                   24 * 3600)
+
+
+def _day(timestamp):
+    return timestamp[:10] if isinstance(timestamp, str) and \
+        len(timestamp) >= 10 else None
+
+
+def _seconds_between(start, end):
+    try:
+        return (datetime.fromisoformat(end) -
+                datetime.fromisoformat(start)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} хв"
+    if seconds < 24 * 3600:
+        return f"{seconds / 3600:.1f} г"
+    return f"{seconds / 86400:.1f} дз"
+
+
+class LatencyHistogram:
+    """Counts per LATENCY_BUCKETS bucket plus sum, so means and approximate
+    quantiles come without keeping the samples."""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        seconds = max(0.0, seconds)
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None if empty or
+        above the last bound)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class DayStats:
+    """Events of one day: new requests, and claims / completions /
+    cancellations by manager with the claim latency."""
+
+    __slots__ = ("created", "claimed", "completed", "canceled", "latency",
+                 "manager_latency")
+
+    def __init__(self):
+        self.created = 0
+        self.claimed = Counter()
+        self.completed = Counter()
+        self.canceled = Counter()
+        self.latency = LatencyHistogram()
+        self.manager_latency = {}  # manager name -> LatencyHistogram
+
+    def merge(self, other):
+        self.created += other.created
+        self.claimed.update(other.claimed)
+        self.completed.update(other.completed)
+        self.canceled.update(other.canceled)
+        self.latency.merge(other.latency)
+        for manager, histogram in other.manager_latency.items():
+            self.manager_latency.setdefault(manager,
+                                            LatencyHistogram()).merge(histogram)
+
+    def observe_claim(self, manager, req_data):
+        self.claimed[manager] += 1
+        latency = _seconds_between(req_data.get("form_timestamp"),
+                                   req_data.get("claimed_timestamp"))
+        if latency is not None:
+            self.latency.observe(latency)
+            self.manager_latency.setdefault(manager,
+                                            LatencyHistogram()).observe(latency)
+
+
+class RequestStats:
+    """Daily counters updated on every request transition.
+
+    Reports merge the counters of the days they cover, so they cost
+    O(days × managers) whatever the history size. Days older than
+    `retain_days` are dropped. `rebuild()` recomputes everything from stored
+    requests: a request then counts as created on its form day, claimed on
+    its claim day and finished on the day of its last update.
+    """
+
+    def __init__(self, retain_days=STATS_RETAIN_DAYS):
+        self.retain_days = retain_days
+        self._days = {}  # "YYYY-MM-DD" -> DayStats
+
+    def _first_day(self):
+        return (date.today() - timedelta(days=self.retain_days - 1)).isoformat()
+
+    def _on(self, day):
+        day = day or date.today().isoformat()
+        stats = self._days.get(day)
+        if stats is None:
+            stats = self._days[day] = DayStats()
+            first_day = self._first_day()
+            for old_day in [d for d in self._days if d < first_day]:
+                del self._days[old_day]
+        return stats
+
+    def record_created(self, req_data):
+        self._on(_day(req_data.get("form_timestamp"))).created += 1
+
+    def record_transition(self, old_status, req_data):
+        """Counts a saved status change (`req_data` is the new state)."""
+        new_status = req_data.get("status")
+        if new_status == old_status:
+            return
+        if status_group(new_status) == "claimed":
+            if status_group(old_status) != "claimed":
+                self._on(_day(req_data.get("claimed_timestamp"))).observe_claim(
+                    req_data.get("claimed_by_name"), req_data)
+            return
+        manager = req_data.get("last_updated_by_name")
+        day = _day(req_data.get("last_updated_timestamp"))
+        if new_status == STATUS_COMPLETED:
+            self._on(day).completed[manager] += 1
+        elif new_status == STATUS_CANCELED_CLIENT:
+            self._on(day).canceled[manager] += 1
+
+    def rebuild(self, requests):
+        """Recomputes the counters from (req_id, data) pairs."""
+        self._days.clear()
+        first_day = self._first_day()
+
+        def on(timestamp):
+            day = _day(timestamp)
+            return self._on(day) if day and day >= first_day else None
+
+        for _, req_data in requests:
+            stats = on(req_data.get("form_timestamp"))
+            if stats is not None:
+                stats.created += 1
+            if req_data.get("claimed_by_name"):
+                stats = on(req_data.get("claimed_timestamp"))
+                if stats is not None:
+                    stats.observe_claim(req_data.get("claimed_by_name"),
+                                        req_data)
+            status = req_data.get("status")
+            if status in (STATUS_COMPLETED, STATUS_CANCELED_CLIENT):
+                stats = on(req_data.get("last_updated_timestamp"))
+                if stats is not None:
+                    counter = stats.completed if status == STATUS_COMPLETED \
+                        else stats.canceled
+                    counter[req_data.get("last_updated_by_name")] += 1
+
+    def summary(self, days=1, end=None):
+        """DayStats of the `days` days up to `end` (a date, default today)."""
+        end = end or date.today()
+        total = DayStats()
+        for offset in range(days):
+            stats = self._days.get((end - timedelta(days=offset)).isoformat())
+            if stats is not None:
+                total.merge(stats)
+        return total
+
+
+def period_summary(requests, days=1, end=None,
+                   retain_days=STATS_RETAIN_DAYS):
+    """DayStats of `days` days up to `end` computed from (req_id, data)
+    pairs, the requests with an event in that period (see rebuild())."""
+    stats = RequestStats(retain_days)
+    stats.rebuild(requests)
+    return stats.summary(days, end)
+
+
+def report_count_keys():
+    """The request_index keys format_report() shows the counts of."""
+    managers = sorted({man_data['name'] for man_data in MANAGERS.values()})
+    return [("open", ), *(("open_manager", manager) for manager in managers),
+            *(("status", group) for group in STATUS_GROUPS)]
+
+
+def format_report(days=1, end=None, summary=None, counts=None):
+    """The /stats and digest text: events of the period plus what is open
+    now. `summary` defaults to request_stats', `counts` ({key: count} of
+    report_count_keys()) to request_index's."""
+    end = end or date.today()
+    if summary is None:
+        summary = request_stats.summary(days, end)
+    if counts is None:
+        counts = {key: request_index.count(key) for key in report_count_keys()}
+    if days == 1:
+        period = end.isoformat()
+    else:
+        period = f"{(end - timedelta(days=days - 1)).isoformat()} — {end.isoformat()}"
+    latency = summary.latency
+    lines = [
+        f"<b>Статыстыка за {period}</b>",
+        f"Новых заявак: {summary.created}",
+        f"Прынята: {sum(summary.claimed.values())}, "
+        f"завершана: {sum(summary.completed.values())}, "
+        f"скасавана: {sum(summary.canceled.values())}",
+        f"Час да прыняцця: сярэдні {format_duration(latency.mean())}, "
+        f"50% ≤ {format_duration(latency.quantile(0.5))}, "
+        f"90% ≤ {format_duration(latency.quantile(0.9))}",
+    ]
+    managers = sorted(
+        (set(summary.claimed) | set(summary.completed)) - {None})
+    if managers:
+        lines.append("\n<b>Па менеджэрах:</b>")
+    for manager in managers:
+        claimed, completed = summary.claimed[manager], summary.completed[manager]
+        rate = f" ({completed / claimed:.0%})" if claimed else ""
+        histogram = summary.manager_latency.get(manager)
+        lines.append(
+            f"• {manager}: прынята {claimed}, завершана {completed}{rate}, "
+            f"сярэдні час {format_duration(histogram.mean() if histogram else None)}"
+        )
+    lines.append(f"\n<b>Зараз адкрыта: {counts[('open', )]}</b>")
+    for manager in sorted({man_data['name'] for man_data in MANAGERS.values()}):
+        count = counts[("open_manager", manager)]
+        if count:
+            lines.append(f"• 🔑 {manager}: {count}")
+    lines.append("<b>Па статусах:</b>")
+    for group in STATUS_GROUPS:
+        count = counts[("status", group)]
+        if count:
+            lines.append(f"• {STATUS_GROUP_LABELS[group]}: {count}")
+    return "\n".join(lines)
+
+
+request_stats = RequestStats()
@@ -0,0 +1,996 @@
+# storage.py
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import repeat
+
+from config import DATA_FILE_PATH, STORAGE_MODE, JOURNAL_FILE_PATH, \
+                   JOURNAL_COMPACT_EVERY, SQLITE_DB_PATH, STORAGE_WRITE_BEHIND, \
+                   SNAPSHOT_FORMAT, SNAPSHOT_FILE_PATH, TERMINAL_STATUSES, \
+                   STATUS_NEW, STATUS_CLAIMED_PREFIX
+from journal import Journal
+from snapshot import Snapshot, SnapshotError, FLAG_TERMINAL, SUMMARY_FIELDS, \
+                     write_snapshot
+from records import RequestRecord, to_record, json_default
+from request_index import STATUS_GROUP_LABELS
+from write_behind import WriteBehind
+
+
+class VersionConflict(Exception):
+    """Raised when a request changed since the caller read it.
+
+    Every save increments the request's "version"; a save with
+    `expected_version` only succeeds if the stored version still matches.
+    """
+
+    def __init__(self, req_id, expected_version, current_version):
+        super().__init__(
+            f"Request {req_id} is at version {current_version}, expected {expected_version}"
+        )
+        self.req_id = req_id
+        self.expected_version = expected_version
+        self.current_version = current_version
+
+
+# --- JSON File Backend (default) ---
+class JsonStorage:
+    """Keeps requests in memory and persists them to DATA_FILE_PATH.
+
+    In "journal" mode every change is appended to JOURNAL_FILE_PATH and the
+    data file is only rewritten on compaction; in "full" mode the whole file
+    is rewritten on every change. With write-behind enabled those writes are
+    batched and done on a worker thread.
+
+    With SNAPSHOT_FORMAT "binary" (journal mode) the snapshot is the indexed
+    SNAPSHOT_FILE_PATH instead (see snapshot.py): loading decodes only the
+    open requests, finished ones are decoded from the mapped file when first
+    accessed, so start time and memory follow the open requests.
+
+    Requests are held as RequestRecords (see records.py). Stored records are
+    never handed out or mutated in place (get/put copy them), so a worker
+    thread can serialize them while the loop runs.
+    """
+
+    def __init__(self,
+                 path=DATA_FILE_PATH,
+                 mode=STORAGE_MODE,
+                 write_behind=STORAGE_WRITE_BEHIND,
+                 snapshot_format=SNAPSHOT_FORMAT,
+                 snapshot_path=SNAPSHOT_FILE_PATH):
+        self.path = path
+        self.data = None
+        self.journal = Journal(JOURNAL_FILE_PATH) if mode == "journal" else None
+        self.snapshot_path = snapshot_path \
+            if mode == "journal" and snapshot_format == "binary" else None
+        self._snapshot = None  # Snapshot holding requests not decoded yet
+        self._dropped = set()  # Ids deleted since the snapshot was written
+        self.write_behind = None
+        if write_behind:
+            self._executor = ThreadPoolExecutor(max_workers=1,
+                                                thread_name_prefix="json-store")
+            self.write_behind = WriteBehind(self._prepare_batch,
+                                            self._write_batch,
+                                            self._executor,
+                                            on_written=self._after_write)
+
+    def load(self):
+        """Loads data from the JSON file, initializes if not found/corrupt."""
+        if self.data is not None:
+            return self.data
+
+        if self.snapshot_path is not None and os.path.exists(
+                self.snapshot_path):
+            try:
+                self.data = self._open_snapshot()
+            except (SnapshotError, OSError) as e:
+                logging.error(
+                    f"Error loading snapshot {self.snapshot_path}: {e}. Initializing empty data."
+                )
+                self.data = {"requests": {}, "counter": 0}
+        elif not os.path.exists(self.path):
+            logging.warning(
+                f"Data file '{self.path}' not found. Initializing empty data.")
+            self.data = {"requests": {}, "counter": 0}
+            if self.journal is not None:
+                self.journal.replay(self.data)  # Journal may exist without snapshot
+            _to_records(self.data["requests"])
+            self.save()  # Create the file
+            return self.data
+        else:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+                    # Ensure basic structure exists after loading
+                    if "requests" not in self.data: self.data["requests"] = {}
+                    if "counter" not in self.data: self.data["counter"] = 0
+                    logging.info(f"Data loaded successfully from {self.path}")
+            except (json.JSONDecodeError, IOError, TypeError) as e:
+                logging.error(
+                    f"Error loading data from {self.path}: {e}. Initializing empty data."
+                )
+                self.data = {"requests": {}, "counter": 0}
+        if self.journal is not None:
+            applied = self.journal.replay(self.data, self._dropped)
+            if applied:
+                logging.info(
+                    f"Replayed {applied} journal records from {self.journal.path}"
+                )
+        _to_records(self.data["requests"])
+        return self.data
+
+    def _open_snapshot(self):
+        snapshot = Snapshot(self.snapshot_path)
+        requests = {}
+        for req_id, offset, length, flags in snapshot.entries():
+            if not flags & FLAG_TERMINAL:
+                requests[str(req_id)] = RequestRecord.from_dict(
+                    snapshot.decode(offset, length))
+        self._snapshot = snapshot
+        logging.info(
+            f"Snapshot {self.snapshot_path} loaded: {len(requests)} open requests decoded, "
+            f"{len(snapshot) - len(requests)} deferred")
+        return {"requests": requests, "counter": snapshot.counter}
+
+    def _stored(self, req_id_str, materialize=True):
+        """Returns the stored dict of a request, decoding it from the
+        snapshot (and keeping it in memory if `materialize`) if needed."""
+        requests = self.load()["requests"]
+        req_data = requests.get(req_id_str)
+        if req_data is None and self._snapshot is not None and \
+                int(req_id_str) not in self._dropped:
+            req_data = self._snapshot.get(int(req_id_str))
+            if req_data is not None:
+                req_data = RequestRecord.from_dict(req_data)
+            if req_data is not None and materialize:
+                requests[req_id_str] = req_data
+        return req_data
+
+    def _store(self, req_id_str, data_dict):
+        self.load()["requests"][req_id_str] = data_dict
+        self._dropped.discard(int(req_id_str))
+
+    def _iter_requests(self):
+        """Yields (req_id_str, stored dict) of all requests, decoding
+        snapshot-only ones without keeping them."""
+        requests = self.load()["requests"]
+        yield from list(requests.items())
+        if self._snapshot is not None:
+            for req_id, offset, length, _ in self._snapshot.entries():
+                if str(req_id) not in requests and req_id not in self._dropped:
+                    yield str(req_id), RequestRecord.from_dict(
+                        self._snapshot.decode(offset, length))
+
+    def save(self):
+        """Saves the current data to the JSON file.
+
+        In journal mode this writes a compacted snapshot and empties the journal.
+        """
+        if self.data is None:
+            logging.warning("Attempted to save data, but cache is None.")
+            return
+        if self.journal is not None:
+            try:
+                if self.snapshot_path is not None:
+                    source = self._snapshot_source()
+                    self._after_write(None, self._write_binary(source))
+                else:
+                    self.journal.compact(self.data, self.path)
+            except IOError as e:
+                logging.error(f"Error compacting data into {self.path}: {e}")
+            return
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.data,
+                          f,
+                          indent=2,
+                          ensure_ascii=False,
+                          default=json_default)  # Use indent=2 for readability
+        except IOError as e:
+            logging.error(f"Error saving data to {self.path}: {e}")
+
+    def _snapshot_source(self):
+        """Runs on the loop: what a binary snapshot has to contain."""
+        return {
+            # Shallow copy is enough, stored request dicts are never mutated
+            "requests": dict(self.data["requests"]),
+            "counter": self.data["counter"],
+            "base": self._snapshot,
+            "dropped": set(self._dropped),
+        }
+
+    def _write_binary(self, source):
+        """Writes a binary snapshot and empties the journal. Returns
+        (source, new Snapshot)."""
+        write_snapshot(self.snapshot_path,
+                       source["counter"],
+                       source["requests"],
+                       lambda req_data: req_data.get("status") in TERMINAL_STATUSES,
+                       base=source["base"],
+                       dropped=source["dropped"])
+        self.journal.reset()
+        if os.path.exists(self.path):  # Converted from the JSON snapshot
+            os.replace(self.path, f"{self.path}.converted")
+        return source, Snapshot(self.snapshot_path)
+
+    def _after_write(self, _records, result):
+        """Runs on the loop: switches to a newly written binary snapshot."""
+        if result is None:
+            return
+        source, snapshot = result
+        # The old one is unmapped once the last reader (a thread of
+        # find_archivable) lets go of it
+        self._snapshot = snapshot
+        # Finished requests unchanged since the snapshot go back to being
+        # decoded on demand
+        requests = self.data["requests"]
+        for req_id_str, req_data in source["requests"].items():
+            if requests.get(req_id_str) is req_data and \
+                    req_data.get("status") in TERMINAL_STATUSES:
+                del requests[req_id_str]
+        self._dropped = {
+            req_id for req_id in self._dropped if req_id in snapshot
+        }
+
+    def _record_change(self, record):
+        """Persists a single mutation: a journal append, or a full rewrite."""
+        self._record_changes([record])
+
+    def _record_changes(self, records):
+        """Persists several mutations with one journal append / rewrite."""
+        if self.write_behind is not None:
+            for record in records:
+                self.write_behind.add(record)
+            return
+        if self.journal is None:
+            self.save()
+            return
+        try:
+            self.journal.append_many(records)
+        except IOError as e:
+            logging.error(f"Error appending to {self.journal.path}: {e}")
+            return
+        if self.journal.records_since_snapshot >= JOURNAL_COMPACT_EVERY:
+            self.save()
+
+    def _prepare_batch(self, records):
+        """Runs on the loop: picks what the worker thread has to write."""
+        snapshot = None
+        if self.journal is None or (self.journal.records_since_snapshot +
+                                    len(records) >= JOURNAL_COMPACT_EVERY):
+            if self.snapshot_path is not None:
+                snapshot = self._snapshot_source()
+            else:
+                # Shallow copy is enough, stored request dicts are never mutated
+                snapshot = {
+                    "requests": dict(self.data["requests"]),
+                    "counter": self.data["counter"]
+                }
+        return records, snapshot
+
+    def _write_batch(self, prepared):
+        """Runs on the worker thread."""
+        records, snapshot = prepared
+        if self.journal is not None:
+            self.journal.append_many(records)
+            if snapshot is not None:
+                if self.snapshot_path is not None:
+                    return self._write_binary(snapshot)
+                self.journal.compact(snapshot, self.path)
+            return None
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot,
+                      f,
+                      indent=2,
+                      ensure_ascii=False,
+                      default=json_default)
+        os.replace(tmp_path, self.path)
+        return None
+
+    async def start(self):
+        self.load()
+
+    async def flush(self):
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+
+    async def close(self):
+        if self.write_behind is not None:
+            await self.write_behind.close()
+            self._executor.shutdown(wait=True)
+        self.save()
+        if self.journal is not None:
+            self.journal.close()
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    async def get(self, req_id):
+        return copy.deepcopy(self._stored(str(req_id)))
+
+    async def put(self, req_id, data_dict, expected_version=None):
+        req_id_str = str(req_id)
+        current = self._stored(req_id_str)
+        current_version = current.get("version", 0) if current else 0
+        if expected_version is not None and expected_version != current_version:
+            raise VersionConflict(req_id, expected_version, current_version)
+        data_dict["version"] = current_version + 1
+        data_dict = to_record(copy.deepcopy(data_dict))
+        self._store(req_id_str, data_dict)
+        self._record_change({"op": "put", "id": req_id_str, "data": data_dict})
+
+    async def put_many(self, items):
+        """Saves several (req_id, data_dict) pairs at once."""
+        records = []
+        for req_id, data_dict in items:
+            req_id_str = str(req_id)
+            current = self._stored(req_id_str)
+            data_dict["version"] = (current.get("version", 0) if current else 0) + 1
+            data_dict = to_record(copy.deepcopy(data_dict))
+            self._store(req_id_str, data_dict)
+            records.append({"op": "put", "id": req_id_str, "data": data_dict})
+        if records:
+            self._record_changes(records)
+
+    async def restore(self, req_id, data_dict):
+        """Stores a request exactly as given (keeping its version), unless
+        the id already exists."""
+        req_id_str = str(req_id)
+        if self._stored(req_id_str) is not None:
+            return
+        data_dict = to_record(copy.deepcopy(data_dict))
+        self._store(req_id_str, data_dict)
+        self._record_change({"op": "put", "id": req_id_str, "data": data_dict})
+
+    async def find_archivable(self, statuses, updated_before, limit,
+                              after_id=0):
+        """Returns up to `limit` (req_id, data) pairs with ids above
+        `after_id`, in id order, in one of `statuses` last updated before the
+        ISO timestamp `updated_before`.
+
+        Snapshot-only requests are picked from the snapshot's summaries on a
+        thread; only the chosen ones are decoded.
+        """
+        requests = self.load()["requests"]
+        found = sorted(((int(req_id_str), req_data)
+                        for req_id_str, req_data in requests.items()
+                        if int(req_id_str) > after_id and
+                        _archivable(req_data, statuses, updated_before)),
+                       key=lambda item: item[0])[:limit]
+        if self._snapshot is not None:
+            skip = {int(req_id_str) for req_id_str in requests} | self._dropped
+            req_ids = await asyncio.to_thread(_snapshot_archivable,
+                                              self._snapshot, statuses,
+                                              updated_before, limit, after_id,
+                                              skip)
+            for req_id in req_ids:  # Re-read: may have changed meanwhile
+                req_data = self._stored(str(req_id), materialize=False)
+                if req_data is not None and \
+                        _archivable(req_data, statuses, updated_before):
+                    found.append((req_id, req_data))
+            found = sorted(found, key=lambda item: item[0])[:limit]
+        return [(req_id, copy.deepcopy(req_data)) for req_id, req_data in found]
+
+    async def delete_many(self, items):
+        """Deletes (req_id, version) pairs whose version is still current.
+
+        Returns the ids actually deleted.
+        """
+        requests = self.load()["requests"]
+        deleted = []
+        for req_id, version in items:
+            req_id_str = str(req_id)
+            current = self._stored(req_id_str, materialize=False)
+            if current is not None and current.get("version", 0) == version:
+                requests.pop(req_id_str, None)
+                if self._snapshot is not None:
+                    self._dropped.add(int(req_id))
+                deleted.append(req_id)
+        if deleted:
+            self._record_changes([{"op": "delete", "id": str(req_id)}
+                                  for req_id in deleted])
+        return deleted
+
+    async def index_entries(self):
+        """Returns (req_id, {field: value}) of every request, with at least
+        the fields request_index.py and stats.py need.
+
+        Snapshot-only requests come from the snapshot's summaries, read on a
+        thread. Only called at start-up, before anything is saved, so the
+        snapshot isn't replaced meanwhile.
+        """
+        requests = self.load()["requests"]
+        entries = [(int(req_id_str), req_data)
+                   for req_id_str, req_data in requests.items()]
+        if self._snapshot is not None:
+            skip = {req_id for req_id, _ in entries} | self._dropped
+            entries += await asyncio.to_thread(_snapshot_entries,
+                                               self._snapshot, skip)
+        return entries
+
+    async def scan(self, chunk_size, ids=None, **filters):
+        """Async-yields lists of up to `chunk_size` (req_id, RequestRecord)
+        matching `filters` (see matches_filters), in id order.
+
+        `ids` limits the scan to those candidates (e.g. from request_index),
+        else every request is read. The ids are taken when the scan starts;
+        records are decoded one chunk at a time and must not be modified.
+        """
+        if ids is None:
+            requests = self.load()["requests"]
+            ids = {int(req_id_str) for req_id_str in requests}
+            if self._snapshot is not None:
+                ids.update(req_id for req_id, *_ in self._snapshot.entries()
+                           if req_id not in self._dropped)
+        chunk = []
+        for req_id in sorted(ids):
+            req_data = self._stored(str(req_id), materialize=False)
+            if req_data is None or not matches_filters(req_data, **filters):
+                continue
+            chunk.append((req_id, req_data))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def all_requests(self):
+        """Returns {req_id_str: data} of every request (decodes everything)."""
+        return dict(self._iter_requests())
+
+    async def allocate_ids(self, count):
+        """Reserves `count` consecutive ids, returns the first one."""
+        data_store = self.load()
+        try:
+            current_id = int(data_store.get("counter", 0))
+        except (ValueError, TypeError):  # Handle if counter is corrupt
+            logging.warning(
+                f"Counter in {self.path} was not an integer. Resetting to 0.")
+            current_id = 0
+        last_id = current_id + count
+        data_store["counter"] = last_id
+        self._record_change({"op": "counter", "value": last_id})
+        return current_id + 1
+
+    async def next_id(self):
+        return await self.allocate_ids(1)
+
+
+def _snapshot_entries(snapshot, skip):
+    """index_entries() of the requests in `snapshot` but not in `skip`."""
+    summaries = snapshot.summaries()
+    if summaries is None:  # Written before summaries, until the next compaction
+        return [(req_id, snapshot.decode(offset, length))
+                for req_id, offset, length, _ in snapshot.entries()
+                if req_id not in skip]
+    return [(req_id, dict(zip(SUMMARY_FIELDS, summary)))
+            for (req_id, *_), summary in zip(snapshot.entries(), summaries)
+            if req_id not in skip]
+
+
+def _snapshot_archivable(snapshot, statuses, updated_before, limit, after_id,
+                         skip):
+    """Ids of up to `limit` requests in `snapshot` with ids above `after_id`
+    but not in `skip` that find_archivable() should return."""
+    start = snapshot.position_after(after_id)
+    summaries = snapshot.summaries(start)
+    found = []
+    for (req_id, offset, length, _), summary in zip(snapshot.entries(start),
+                                                    summaries or repeat(None)):
+        if req_id in skip:
+            continue
+        if summary is None:  # Written before summaries
+            req_data = snapshot.decode(offset, length)
+        else:
+            req_data = dict(zip(SUMMARY_FIELDS, summary))
+        if _archivable(req_data, statuses, updated_before):
+            found.append(req_id)
+            if len(found) >= limit:
+                break
+    return found
+
+
+def _archivable(req_data, statuses, updated_before):
+    return req_data.get("status") in statuses and \
+        (req_data.get("last_updated_timestamp") or "") < updated_before
+
+
+def matches_filters(req_data,
+                    since=None,
+                    until=None,
+                    status=None,
+                    status_prefix=None,
+                    manager=None):
+    """Request filters shared by the backends' scan(): form_timestamp in
+    [since, until) (ISO strings), exact status or status prefix, claiming
+    manager."""
+    form_timestamp = req_data.get("form_timestamp") or ""
+    if since is not None and form_timestamp < since:
+        return False
+    if until is not None and form_timestamp >= until:
+        return False
+    if status is not None and req_data.get("status") != status:
+        return False
+    if status_prefix is not None and \
+            not (req_data.get("status") or "").startswith(status_prefix):
+        return False
+    if manager is not None and req_data.get("claimed_by_name") != manager:
+        return False
+    return True
+
+
+def _to_records(requests):
+    """Replaces the plain dicts in `requests` (as loaded) by RequestRecords."""
+    for req_id_str, req_data in requests.items():
+        if type(req_data) is dict:
+            requests[req_id_str] = RequestRecord.from_dict(req_data)
+
+
+# --- SQLite Backend ---
+# Fields copied out of the request dict into indexed columns
+SQLITE_INDEXED_FIELDS = ("status", "claimed_by_name", "form_timestamp",
+                         "claimed_timestamp", "last_updated_timestamp")
+# request_index.py's "open" as SQL. The partial indexes below are only used
+# for queries repeating this exact text, so the statuses are inlined
+_OPEN_SQL = "(status IS NULL OR status NOT IN ({}))".format(", ".join(
+    "'{}'".format(status.replace("'", "''")) for status in TERMINAL_STATUSES))
+
+_SQLITE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    {', '.join(f'{name} TEXT' for name in SQLITE_INDEXED_FIELDS)},
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO sequences (name, value) VALUES ('request_id', 0);
+{''.join(f'CREATE INDEX IF NOT EXISTS idx_requests_{name} ON requests({name});'
+         for name in SQLITE_INDEXED_FIELDS)}
+CREATE INDEX IF NOT EXISTS idx_requests_open ON requests(id) WHERE {_OPEN_SQL};
+CREATE INDEX IF NOT EXISTS idx_requests_open_manager
+    ON requests(claimed_by_name, id) WHERE {_OPEN_SQL};
+"""
+
+
+class SqliteStorage:
+    """Stores requests in an SQLite database (WAL mode).
+
+    The connection lives on a single worker thread, so every query runs off
+    the event loop and calls are serialized without extra locking. With
+    write-behind enabled, upserts are grouped into one transaction per batch;
+    reading a request that still has a queued write flushes first.
+
+    The request version lives in its own column and is checked and bumped
+    inside the UPDATE, so version checks also hold between processes.
+
+    `index_page()`, `index_counts()` and `index_ids()` answer request_index.py
+    queries from the indexed columns, for processes that don't see each
+    other's saves (several workers).
+    """
+
+    def __init__(self,
+                 path=SQLITE_DB_PATH,
+                 json_path=DATA_FILE_PATH,
+                 write_behind=STORAGE_WRITE_BEHIND):
+        self.path = path
+        self.json_path = json_path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="sqlite")
+        self._pending = {}  # req_id -> row queued for writing
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehind(lambda rows: rows,
+                                            self._put_many,
+                                            self._executor,
+                                            on_written=self._forget_written)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self.path,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Another worker process may be setting up or migrating the DB
+        self._conn.execute("PRAGMA busy_timeout=60000")
+        self._conn.executescript(_SQLITE_SCHEMA)
+        columns = {
+            row[1]
+            for row in self._conn.execute("PRAGMA table_info(requests)")
+        }
+        if "version" not in columns:  # Databases created before versioning
+            try:
+                self._conn.execute(
+                    "ALTER TABLE requests "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass  # Added by another worker process meanwhile
+        self._migrate_from_json()
+        # Afterwards writers only hold the lock for a short batch
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        logging.info(f"SQLite storage opened at {self.path}")
+        return self._conn
+
+    def _migrate_from_json(self):
+        """One-shot import of an existing JSON data file (or binary snapshot)
+        into an empty DB.
+
+        The files are renamed to `<name>.migrated` afterwards so the
+        import never runs twice.
+        """
+        sources = (self.json_path, SNAPSHOT_FILE_PATH)
+        if not any(os.path.exists(path) for path in sources):
+            return
+        # Hold the write lock for the whole import, so that with several
+        # worker processes exactly one of them migrates
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if not any(os.path.exists(path) for path in sources):
+                return  # Another worker migrated it meanwhile
+            (row_count, ) = self._conn.execute(
+                "SELECT COUNT(*) FROM requests").fetchone()
+            if row_count:
+                logging.warning(
+                    f"Not migrating {self.json_path}: {self.path} already has data."
+                )
+                return
+            json_storage = JsonStorage(self.json_path, write_behind=False)
+            data = json_storage.load()
+            requests = json_storage.all_requests()
+            try:
+                counter = int(data.get("counter", 0))
+            except (ValueError, TypeError):
+                counter = 0
+            rows = []
+            for req_id_str, req_data in requests.items():
+                rows.append(_to_row(int(req_id_str), req_data))
+                counter = max(counter, int(req_id_str))
+            self._conn.executemany(_UPSERT_SQL, rows)
+            self._conn.execute(
+                "UPDATE sequences SET value = ? WHERE name = 'request_id'",
+                (counter, ))
+        for path in (*sources, JOURNAL_FILE_PATH):
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+        logging.warning(
+            f"Migrated {len(rows)} requests from {self.json_path} to {self.path}"
+        )
+
+    def _get(self, req_id):
+        row = self._connect().execute(
+            "SELECT data, version FROM requests WHERE id = ?",
+            (int(req_id), )).fetchone()
+        if row is None:
+            return None
+        return _from_row(*row)
+
+    def _put(self, row):
+        (version, ) = self._connect().execute(
+            f"{_UPSERT_SQL} RETURNING version", row).fetchone()
+        return version
+
+    def _put_checked(self, row, expected_version):
+        conn = self._connect()
+        req_id, values = row[0], row[1:]
+        if conn.execute(_CHECKED_UPDATE_SQL,
+                        (*values, req_id, expected_version)).rowcount:
+            return
+        if expected_version == 0 and conn.execute(
+                _INSERT_NEW_SQL, row).rowcount:
+            return
+        current = conn.execute("SELECT version FROM requests WHERE id = ?",
+                               (req_id, )).fetchone()
+        raise VersionConflict(req_id, expected_version,
+                              current[0] if current else 0)
+
+    def _put_many(self, rows):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_UPSERT_SQL, rows)
+
+    def _restore(self, row, version):
+        self._connect().execute(_RESTORE_SQL, (*row, version))
+
+    def _find_archivable(self, statuses, updated_before, limit, after_id):
+        rows = self._connect().execute(
+            f"SELECT id, data, version FROM requests "
+            f"WHERE id > ? AND status IN ({', '.join('?' for _ in statuses)}) "
+            f"AND COALESCE(last_updated_timestamp, '') < ? ORDER BY id LIMIT ?",
+            (after_id, *statuses, updated_before, limit)).fetchall()
+        return [(req_id, _from_row(data, version))
+                for req_id, data, version in rows]
+
+    def _scan(self, after_id, limit, where, params):
+        rows = self._connect().execute(
+            f"SELECT id, data, version FROM requests WHERE id > ?{where} "
+            f"ORDER BY id LIMIT ?", (after_id, *params, limit)).fetchall()
+        return [(req_id, _from_row(data, version))
+                for req_id, data, version in rows]
+
+    def _delete_many(self, items):
+        conn = self._connect()
+        deleted = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for req_id, version in items:
+                if conn.execute(
+                        "DELETE FROM requests WHERE id = ? AND version = ?",
+                    (int(req_id), version)).rowcount:
+                    deleted.append(req_id)
+        return deleted
+
+    def _index_page(self, where, params, before, limit):
+        rows = self._connect().execute(
+            f"SELECT id, data, version FROM requests WHERE id < ?{where} "
+            f"ORDER BY id DESC LIMIT ?", (before, *params, limit)).fetchall()
+        return [(req_id, _from_row(data, version))
+                for req_id, data, version in rows]
+
+    def _index_counts(self, conditions):
+        conn = self._connect()
+        return [
+            conn.execute(f"SELECT COUNT(*) FROM requests WHERE 1{where}",
+                         params).fetchone()[0]
+            for where, params in conditions
+        ]
+
+    def _index_ids(self, where, params):
+        return [
+            req_id for (req_id, ) in self._connect().execute(
+                f"SELECT id FROM requests WHERE 1{where} ORDER BY id", params)
+        ]
+
+    def _index_entries(self, where="", params=()):
+        rows = self._connect().execute(
+            f"SELECT id, {', '.join(SQLITE_INDEXED_FIELDS)}, "
+            f"json_extract(data, '$.last_updated_by_name') FROM requests{where}",
+            params).fetchall()
+        return [(row[0], dict(zip(_SUMMARY_FIELDS, row[1:]))) for row in rows]
+
+    def _forget_written(self, rows, _result):
+        for row in rows:
+            if self._pending.get(row[0]) is row:
+                del self._pending[row[0]]
+
+    def _allocate_ids(self, count):
+        (last_id, ) = self._connect().execute(
+            "UPDATE sequences SET value = value + ? WHERE name = 'request_id' "
+            "RETURNING value", (count, )).fetchone()
+        return last_id - count + 1
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def start(self):
+        await self._run(self._connect)
+
+    async def flush(self):
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+
+    async def close(self):
+        if self.write_behind is not None:
+            await self.write_behind.close()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    async def get(self, req_id):
+        if int(req_id) in self._pending:
+            await self.flush()  # Version must come from the database
+        return await self._run(self._get, req_id)
+
+    async def put(self, req_id, data_dict, expected_version=None):
+        # Serialize on the loop so later in-place edits of the dict can't race
+        row = _to_row(int(req_id), data_dict)
+        if expected_version is not None:
+            if row[0] in self._pending:
+                await self.flush()  # Queued write must not land after this one
+            await self._run(self._put_checked, row, expected_version)
+            data_dict["version"] = expected_version + 1
+            return
+        # Like JsonStorage: the caller's copy gets the version the upsert
+        # writes (exact unless another process saved the request meanwhile)
+        data_dict["version"] = data_dict.get("version", 0) + 1
+        if self.write_behind is not None:
+            self._pending[row[0]] = row
+            self.write_behind.add(row)
+            return
+        data_dict["version"] = await self._run(self._put, row)
+
+    async def put_many(self, items):
+        rows = []
+        for req_id, data_dict in items:
+            rows.append(_to_row(int(req_id), data_dict))
+            data_dict["version"] = data_dict.get("version", 0) + 1
+        if self.write_behind is not None:
+            for row in rows:
+                self._pending[row[0]] = row
+                self.write_behind.add(row)
+            return
+        if rows:
+            await self._run(self._put_many, rows)
+
+    async def restore(self, req_id, data_dict):
+        row = _to_row(int(req_id), data_dict)
+        await self._run(self._restore, row, data_dict.get("version", 0))
+
+    async def find_archivable(self, statuses, updated_before, limit,
+                              after_id=0):
+        await self.flush()
+        return await self._run(self._find_archivable, tuple(statuses),
+                               updated_before, limit, after_id)
+
+    async def delete_many(self, items):
+        await self.flush()
+        return await self._run(self._delete_many, list(items))
+
+    async def scan(self, chunk_size, **filters):
+        """Async-yields lists of up to `chunk_size` (req_id, RequestRecord)
+        matching `filters` (see matches_filters), in id order, one query per
+        chunk (filters run on the indexed columns)."""
+        await self.flush()
+        where, params = _sql_filters(**filters)
+        after_id = 0
+        while True:
+            chunk = await self._run(self._scan, after_id, chunk_size, where,
+                                    params)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after_id = chunk[-1][0]
+
+    async def index_entries(self):
+        await self.flush()
+        return await self._run(self._index_entries)
+
+    async def stats_entries(self, since):
+        """index_entries() of the requests created, claimed or last updated
+        on or after `since` (ISO), found through the timestamp indexes."""
+        await self.flush()
+        return await self._run(
+            self._index_entries,
+            " WHERE form_timestamp >= ? OR claimed_timestamp >= ? "
+            "OR last_updated_timestamp >= ?", (since, since, since))
+
+    async def index_page(self, key, before=None, limit=10, within=None):
+        """RequestIndex.page() with the records: ([(req_id, RequestRecord)],
+        next cursor), one query reading only the page."""
+        await self.flush()
+        where, params = _sql_index_key(key)
+        if within is not None:
+            within_where, within_params = _sql_index_key(within)
+            where, params = where + within_where, params + within_params
+        page = await self._run(self._index_page, where, params,
+                               before if before is not None else 2**63 - 1,
+                               limit + 1)  # One extra: is there more?
+        if len(page) > limit:
+            return page[:limit], page[limit - 1][0]
+        return page, None
+
+    async def index_counts(self, keys):
+        """RequestIndex.count() of each of `keys`, in one storage call."""
+        await self.flush()
+        return await self._run(self._index_counts,
+                               [_sql_index_key(key) for key in keys])
+
+    async def index_ids(self, key):
+        """RequestIndex.ids(): all ids under `key`, oldest first."""
+        await self.flush()
+        return await self._run(self._index_ids, *_sql_index_key(key))
+
+    async def allocate_ids(self, count):
+        return await self._run(self._allocate_ids, count)
+
+    async def next_id(self):
+        return await self.allocate_ids(1)
+
+
+_SQLITE_VALUE_COLUMNS = (*SQLITE_INDEXED_FIELDS, "data")
+_SUMMARY_FIELDS = (*SQLITE_INDEXED_FIELDS, "last_updated_by_name")
+_INSERT_NEW_SQL = (
+    f"INSERT OR IGNORE INTO requests (id, {', '.join(_SQLITE_VALUE_COLUMNS)}, version) "
+    f"VALUES (?, {', '.join('?' for _ in _SQLITE_VALUE_COLUMNS)}, 1)")
+_RESTORE_SQL = (
+    f"INSERT OR IGNORE INTO requests (id, {', '.join(_SQLITE_VALUE_COLUMNS)}, version) "
+    f"VALUES (?, {', '.join('?' for _ in _SQLITE_VALUE_COLUMNS)}, ?)")
+_UPSERT_SQL = (
+    f"INSERT INTO requests (id, {', '.join(_SQLITE_VALUE_COLUMNS)}, version) "
+    f"VALUES (?, {', '.join('?' for _ in _SQLITE_VALUE_COLUMNS)}, 1) "
+    f"ON CONFLICT(id) DO UPDATE SET "
+    f"{', '.join(f'{name} = excluded.{name}' for name in _SQLITE_VALUE_COLUMNS)}, "
+    f"version = requests.version + 1")
+_CHECKED_UPDATE_SQL = (
+    f"UPDATE requests SET {', '.join(f'{name} = ?' for name in _SQLITE_VALUE_COLUMNS)}, "
+    f"version = version + 1 WHERE id = ? AND version = ?")
+
+
+def _from_row(data, version):
+    record = RequestRecord.from_dict(json.loads(data))
+    record.version = version
+    return record
+
+
+def _sql_filters(since=None, until=None, status=None, status_prefix=None,
+                 manager=None):
+    """matches_filters() as an SQL condition: (" AND ...", params)."""
+    where, params = [], []
+    if since is not None:
+        where.append("form_timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("form_timestamp < ?")
+        params.append(until)
+    if status is not None:
+        where.append("status = ?")
+        params.append(status)
+    if status_prefix is not None:
+        where.append("substr(status, 1, ?) = ?")
+        params.extend((len(status_prefix), status_prefix))
+    if manager is not None:
+        where.append("claimed_by_name = ?")
+        params.append(manager)
+    return "".join(f" AND {condition}" for condition in where), params
+
+
+def _sql_index_key(key):
+    """A request_index.py key as an SQL condition on the indexed columns:
+    (" AND ...", params)."""
+    kind, arg = key[0], key[1] if len(key) > 1 else None
+    if kind == "open":
+        return f" AND {_OPEN_SQL}", []
+    if kind == "open_manager":
+        return f" AND claimed_by_name = ? AND {_OPEN_SQL}", [arg]
+    if kind == "manager":
+        return " AND claimed_by_name = ?", [arg]
+    if kind == "day":
+        next_day = (date.fromisoformat(arg) + timedelta(days=1)).isoformat()
+        return " AND form_timestamp >= ? AND form_timestamp < ?", [arg, next_day]
+    if kind == "status" and arg == "claimed":  # A range, so the index is used
+        return " AND status >= ? AND status < ?", \
+            [STATUS_CLAIMED_PREFIX, STATUS_CLAIMED_PREFIX + "\U0010ffff"]
+    if kind == "status" and arg == "new":
+        return " AND (status IS NULL OR status = ?)", [STATUS_NEW]
+    if kind == "status":
+        return " AND status = ?", [STATUS_GROUP_LABELS[arg]]
+    raise ValueError(f"Unknown request index key {key!r}")
+
+
+def _to_row(req_id, data_dict):
+    data_dict = to_record(data_dict).to_dict()
+    data_dict.pop("version", None)
+    return (req_id, *(data_dict.get(name) for name in SQLITE_INDEXED_FIELDS),
+            json.dumps(data_dict, ensure_ascii=False))
+
+
+STORAGE_BACKENDS = {
+    "json": JsonStorage,
+    "sqlite": SqliteStorage,
+}
+
+
+def create_storage(backend):
+    """Returns a storage instance for a STORAGE_BACKENDS name."""
+    try:
+        return STORAGE_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown STORAGE_BACKEND {backend!r}, expected one of {sorted(STORAGE_BACKENDS)}"
+        ) from None
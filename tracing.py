@@ -0,0 +1,355 @@
+# tracing.py
+import argparse
+import atexit
+import contextlib
+import contextvars
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+import zlib
+from datetime import datetime
+from logging.handlers import QueueListener, RotatingFileHandler
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+from config import TRACE_FILE_PATH, TRACE_MAX_BYTES, TRACE_BACKUPS, \
+                   TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, WEB_WORKERS, WORKER_INDEX
+from logs import LazyQueueHandler
+
+CORRELATION_HEADER = "X-Correlation-Id"
+_CORRELATION_ID = re.compile(r"[\w-]{1,64}")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Trace:
+    __slots__ = ("trace_id", "attrs", "spans", "open", "finished", "error")
+
+    def __init__(self, trace_id, attrs=None):
+        self.trace_id = trace_id
+        self.attrs = dict(attrs) if attrs else {}  # req_id, added to every span
+        self.spans = []  # Ended spans
+        self.open = 0
+        self.finished = False
+        self.error = False
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "start",
+                 "started", "duration", "error")
+
+    def __init__(self, trace, parent_id, name, attrs):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(32):08x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        trace = self.trace
+        entry = {
+            "trace_id": trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        entry.update(trace.attrs)
+        entry.update(self.attrs)
+        if self.error:
+            entry["error"] = self.error
+        return entry
+
+
+class _Lines:
+    """Log record argument turning ended spans into JSON lines when the
+    writer thread formats it."""
+
+    __slots__ = ("spans", )
+
+    def __init__(self, spans):
+        self.spans = spans
+
+    def __str__(self):
+        return "\n".join(
+            json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+            for span in self.spans)
+
+
+class Tracer:
+    """Span tracing of the request lifecycle.
+
+    A trace is one unit of work in this process (a form submission, an
+    update, a queued notification). Its spans are written to TRACE_FILE_PATH
+    as JSON lines by a background thread once the last of them ends, if the
+    tail-sampling policy keeps it: every trace with an error or lasting
+    TRACE_SLOW_SECONDS or more, and TRACE_SAMPLE_RATE of the others (decided
+    per trace_id, so the parts of one request's timeline go together).
+
+    All traces of a request share its correlation id (the trace_id of the
+    form submission, stored in the request as "trace_id") and its req_id;
+    `python tracing.py <req_id>` prints them as a timeline.
+    """
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE,
+                 slow_seconds=TRACE_SLOW_SECONDS):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self._logger = logging.getLogger("tgbot.traces")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._handler = None
+        self._listener = None
+        self.written = 0
+        self.discarded = 0
+
+    @property
+    def enabled(self):
+        return self._listener is not None
+
+    def start(self, path=TRACE_FILE_PATH, max_bytes=TRACE_MAX_BYTES,
+              backups=TRACE_BACKUPS):
+        """Starts the writer thread (no-op without a path). With several
+        workers each writes its own file."""
+        if not path or self._listener is not None:
+            return
+        if WEB_WORKERS > 1:
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{WORKER_INDEX}{ext}"
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                           backupCount=backups,
+                                           encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        span_queue = queue.Queue(10000)
+        self._handler = LazyQueueHandler(span_queue)
+        self._logger.handlers[:] = [self._handler]
+        self._listener = QueueListener(span_queue, file_handler)
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._listener is None:
+            return
+        listener, self._listener = self._listener, None
+        try:
+            listener.stop()
+        except queue.Full:
+            pass
+
+    @contextlib.contextmanager
+    def span(self, name, trace_id=None, child_only=False, **attrs):
+        """Times the block as a span of the current trace.
+
+        Without a current trace (or when it already ended, e.g. in a
+        background task that outlived it) a new trace starts, continuing the
+        id and attributes of the ended one, else with `trace_id` or a fresh
+        id. `child_only` spans are skipped outside any trace. Yields the Span,
+        or None when tracing is off.
+        """
+        if self._listener is None:
+            yield None
+            return
+        parent = _current.get()
+        if parent is None and child_only:
+            yield None
+            return
+        if parent is not None and not parent.trace.finished:
+            trace = parent.trace
+        elif parent is not None:
+            trace = Trace(parent.trace.trace_id, parent.trace.attrs)
+        else:
+            trace = Trace(trace_id or new_trace_id())
+        span = Span(trace, parent.span_id if parent else None, name, attrs)
+        trace.open += 1
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            trace.error = True
+            raise
+        finally:
+            _current.reset(token)
+            span.duration = time.perf_counter() - span.started
+            trace.spans.append(span)
+            trace.open -= 1
+            if trace.open == 0:
+                self._finish(trace)
+
+    def current_trace_id(self):
+        span = _current.get()
+        return span.trace.trace_id if span is not None else None
+
+    def tag(self, trace_id=None, **attrs):
+        """Adds `attrs` to every span of the current trace; `trace_id` moves
+        the trace under that correlation id (e.g. the request's)."""
+        span = _current.get()
+        if span is None:
+            return
+        if trace_id:
+            span.trace.trace_id = trace_id
+        span.trace.attrs.update(attrs)
+
+    def _keep(self, trace):
+        if trace.error:
+            return True
+        first = min(span.start for span in trace.spans)
+        last = max(span.start + span.duration for span in trace.spans)
+        if last - first >= self.slow_seconds:
+            return True
+        return zlib.crc32(
+            trace.trace_id.encode()) < self.sample_rate * 0x100000000
+
+    def _finish(self, trace):
+        trace.finished = True
+        if not self._keep(trace):
+            self.discarded += 1
+            return
+        self.written += 1
+        self._logger.info("%s", _Lines(trace.spans))
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "discarded": self.discarded,
+            "dropped": self._handler.dropped if self._handler else 0,
+        }
+
+
+tracer = Tracer()
+
+
+# --- Instrumentation ---
+def tracing_middleware(route_names):
+    """aiohttp middleware starting a trace for the paths in `route_names`
+    (path -> span name). The trace id is the X-Correlation-Id header if the
+    caller sent a valid one, and is returned in the same header."""
+
+    @web.middleware
+    async def middleware(request, handler):
+        name = route_names.get(request.path)
+        if name is None or not tracer.enabled:
+            return await handler(request)
+        trace_id = request.headers.get(CORRELATION_HEADER, "")
+        if not _CORRELATION_ID.fullmatch(trace_id):
+            trace_id = None
+        with tracer.span(name, trace_id=trace_id) as span:
+            response = await handler(request)
+            span.set(status=response.status)
+            response.headers[CORRELATION_HEADER] = span.trace.trace_id
+            return response
+
+    return middleware
+
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """Dispatcher outer middleware tracing each update; handlers tag the
+    trace with the request it concerns."""
+
+    async def __call__(self, handler, event, data):
+        with tracer.span(f"update.{getattr(event, 'event_type', None)}",
+                         update_id=getattr(event, "update_id", None)):
+            return await handler(event, data)
+
+
+class ApiCallTracing(BaseRequestMiddleware):
+    """Session middleware adding a span per Bot API call to the current
+    trace. Registered before the outbound scheduler the span includes the
+    rate limit wait; a second one after it times each attempt at Telegram."""
+
+    def __init__(self, name=None):
+        self.name = name
+
+    async def __call__(self, make_request, bot, method):
+        name = self.name or f"api.{type(method).__name__}"
+        with tracer.span(name, child_only=True,
+                         chat_id=getattr(method, "chat_id", None)):
+            return await make_request(bot, method)
+
+
+# --- Timeline CLI ---
+def _trace_files(path):
+    root, ext = os.path.splitext(path)
+    return sorted(set(glob.glob(f"{glob.escape(path)}*")) |
+                  set(glob.glob(f"{glob.escape(root)}.*{ext}*")))
+
+
+def read_spans(path=TRACE_FILE_PATH):
+    for file_path in _trace_files(path):
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # Torn last line of a rotated file
+
+
+def timeline(key, path=TRACE_FILE_PATH):
+    """Spans of the request with id (or trace id) `key`, by start time."""
+    spans = list(read_spans(path))
+    trace_ids = {
+        span["trace_id"] for span in spans
+        if str(span.get("req_id")) == key or span.get("trace_id") == key
+    }
+    return sorted((span for span in spans if span["trace_id"] in trace_ids),
+                  key=lambda span: span["start"])
+
+
+def format_timeline(spans):
+    if not spans:
+        return "No spans found."
+    parents = {span["span_id"]: span.get("parent_id") for span in spans}
+
+    def depth(span):
+        level, parent_id = 0, span.get("parent_id")
+        while parent_id in parents and level < 20:
+            level, parent_id = level + 1, parents[parent_id]
+        return level
+
+    first = spans[0]["start"]
+    hidden = {"trace_id", "span_id", "parent_id", "name", "start",
+              "duration_ms", "req_id", "error"}
+    lines = [
+        f"Request {spans[0].get('req_id', '?')}, trace {spans[0]['trace_id']}, "
+        f"from {datetime.fromtimestamp(first).isoformat(timespec='milliseconds')}"
+    ]
+    for span in spans:
+        attrs = " ".join(f"{k}={v}" for k, v in span.items()
+                         if k not in hidden and v is not None)
+        error = f"  !! {span['error']}" if span.get("error") else ""
+        lines.append(
+            f"{(span['start'] - first) * 1000:+10.1f} ms {span['duration_ms']:9.1f} ms  "
+            f"{'  ' * depth(span)}{span['name']}  {attrs}{error}".rstrip())
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prints the span timeline of a request from the trace files.")
+    parser.add_argument("key", help="request id or trace id")
+    parser.add_argument("--file", default=TRACE_FILE_PATH or "traces.jsonl")
+    args = parser.parse_args()
+    spans = timeline(args.key, args.file)
+    print(format_timeline(spans))
+    sys.exit(0 if spans else 1)
@@ -1,9 +1,18 @@
 # utils.py
-import json
+import asyncio
 import logging
-import os
-from datetime import datetime
-from config import DATA_FILE_PATH, STATUS_NEW  # Import constants if needed
+from datetime import date, datetime, timedelta
+from config import STATUS_NEW, STATUS_CLAIMED_PREFIX, STATUS_COMPLETED, \
+                   STORAGE_BACKEND, ID_LEASE_SIZE, TERMINAL_STATUSES, \
+                   ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, \
+                   EXPORT_CHUNK_SIZE, WEB_WORKERS  # Import constants if needed
+from storage import create_storage, matches_filters, VersionConflict
+from archive import RequestArchive
+from records import to_record
+from request_index import request_index, STATUS_GROUP_LABELS
+from stats import request_stats, period_summary, report_count_keys, \
+                  format_report
+from metrics import STORAGE_LOAD_SECONDS
 
 
 # --- Date Formatting --- (Keep as before)
@@ -16,82 +25,276 @@ def format_datetime(dt=None):
         return str(dt)
 
 
-# --- Data Storage (JSON File) ---
-_data_cache = None  # Simple in-memory cache
+# --- Data Storage --- (backend chosen by STORAGE_BACKEND, see storage.py)
+_storage = create_storage(STORAGE_BACKEND)
+# Finished requests moved out of _storage, see archive_old_requests
+_archive = RequestArchive()
+# With several workers request_index would only see this process's saves, so
+# it isn't kept: queries go to the shared database (SQLite, see main.py)
+_shared_index = WEB_WORKERS > 1
 
 
-def _load_data():
-    """Loads data from the JSON file, initializes if not found/corrupt."""
-    global _data_cache
-    if _data_cache is not None:
-        return _data_cache
-
-    if not os.path.exists(DATA_FILE_PATH):
-        logging.warning(
-            f"Data file '{DATA_FILE_PATH}' not found. Initializing empty data."
-        )
-        _data_cache = {"requests": {}, "counter": 0}
-        _save_data()  # Create the file
-        return _data_cache
-    try:
-        with open(DATA_FILE_PATH, 'r', encoding='utf-8') as f:
-            _data_cache = json.load(f)
-            # Ensure basic structure exists after loading
-            if "requests" not in _data_cache: _data_cache["requests"] = {}
-            if "counter" not in _data_cache: _data_cache["counter"] = 0
-            logging.info(f"Data loaded successfully from {DATA_FILE_PATH}")
-            return _data_cache
-    except (json.JSONDecodeError, IOError, TypeError) as e:
-        logging.error(
-            f"Error loading data from {DATA_FILE_PATH}: {e}. Initializing empty data."
-        )
-        _data_cache = {"requests": {}, "counter": 0}
-        return _data_cache
-
-
-def _save_data():
-    """Saves the current data cache to the JSON file."""
-    global _data_cache
-    if _data_cache is None:
-        logging.warning("Attempted to save data, but cache is None.")
+async def init_storage():
+    """Opens the storage backend (loads data / runs migrations)."""
+    with STORAGE_LOAD_SECONDS.time():
+        await _storage.start()
+    await _archive.load()
+    if _shared_index:  # Queries and reports read the database
         return
-    try:
-        with open(DATA_FILE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(_data_cache, f, indent=2,
-                      ensure_ascii=False)  # Use indent=2 for readability
-    except IOError as e:
-        logging.error(f"Error saving data to {DATA_FILE_PATH}: {e}")
+    entries = await _storage.index_entries()
+    # Nothing reads or saves requests before this returns, so the index and
+    # the stats are built on a thread while the loop stays free
+    await asyncio.to_thread(rebuild_request_index, entries)
+    await rebuild_stats(entries)
+
+
+def rebuild_request_index(entries):
+    """Indexes every request of the working set (archived ones aren't
+    listed)."""
+    request_index.clear()
+    for req_id, req_data in entries:
+        request_index.update(req_id, req_data)
+    logging.info(f"Request index built: {request_index.stats()}")
+
+
+async def rebuild_stats(entries):
+    """Recomputes request_stats from the index_entries() of storage,
+    archived requests of the retained days included."""
+    first_day = (datetime.now() -
+                 timedelta(days=request_stats.retain_days)).date().isoformat()
+    archived = await _archive.records_since(first_day)
+    await asyncio.to_thread(request_stats.rebuild, entries + archived)
+    logging.info(
+        f"Request stats rebuilt from {len(entries)} stored and {len(archived)} archived requests"
+    )
+
+
+async def flush_data():
+    """Waits until all data changes made so far are written to disk."""
+    await _storage.flush()
+
+
+async def close_storage():
+    """Persists everything and releases the storage backend."""
+    await _storage.close()
+    await _archive.close()
 
 
 # --- Public Data Access Functions ---
 async def get_request_data(req_id):
-    """Fetches request data."""
-    data_store = _load_data()
-    req_id_str = str(req_id)  # Use string keys for JSON consistency
-    return data_store["requests"].get(req_id_str)
+    """Fetches a request as a RequestRecord (from the archive if it was
+    archived), or None."""
+    req_data = await _storage.get(req_id)
+    if req_data is None:
+        req_data = await _archive.get(req_id)
+    return req_data
+
+
+async def save_request_data(req_id, data_dict, expected_version=None):
+    """Saves a request, a RequestRecord or a plain dict (written in the
+    background, see flush_data).
+
+    Every save bumps data_dict["version"]. With `expected_version` the save
+    raises VersionConflict if someone else saved the request since.
+    """
+    if req_id in _archive:
+        await _unarchive(req_id)
+    await _storage.put(req_id, data_dict, expected_version)
+    if not _shared_index:
+        request_index.update(req_id, data_dict)
+
+
+async def save_many_request_data(items):
+    """Saves several (req_id, data_dict) pairs in one storage operation."""
+    items = list(items)
+    await _storage.put_many(items)
+    if not _shared_index:
+        for req_id, data_dict in items:
+            request_index.update(req_id, data_dict)
+
+
+async def _unarchive(req_id):
+    """Moves an archived request back into the working set (version kept)."""
+    req_data = await _archive.get(req_id)
+    if req_data is not None:
+        await _storage.restore(req_id, req_data)
+    await _archive.forget(req_id)
+    logging.info(f"Request #{req_id} restored from the archive.")
+
+
+async def archive_old_requests(max_age_days=ARCHIVE_AFTER_DAYS):
+    """Moves terminal requests not updated for `max_age_days` to the archive.
+
+    Returns how many were archived. A request changed while being archived
+    stays in the working set (its archived copy is then ignored).
+    """
+    updated_before = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+    total = 0
+    after_id = 0  # Each batch resumes after the previous one
+    while True:
+        candidates = await _storage.find_archivable(TERMINAL_STATUSES,
+                                                    updated_before,
+                                                    ARCHIVE_BATCH_SIZE,
+                                                    after_id)
+        if not candidates:
+            break
+        await _archive.append(candidates)  # On disk before leaving storage
+        deleted = await _storage.delete_many(
+            (req_id, req_data.get("version", 0))
+            for req_id, req_data in candidates)
+        if not _shared_index:
+            for req_id in deleted:
+                request_index.remove(req_id)
+        total += len(deleted)
+        if len(candidates) < ARCHIVE_BATCH_SIZE:
+            break
+        after_id = candidates[-1][0]
+    if total:
+        await _storage.flush()
+        logging.info(f"Archived {total} finished requests.")
+    return total
+
+
+async def count_requests(keys):
+    """request_index.count() of each of `keys` (a list)."""
+    if _shared_index:
+        return await _storage.index_counts(keys)
+    return [request_index.count(key) for key in keys]
+
+
+async def request_ids(key):
+    """request_index.ids(key): all ids under `key`, oldest first."""
+    if _shared_index:
+        return await _storage.index_ids(key)
+    return request_index.ids(key)
+
+
+async def list_requests(key, before=None, limit=10, within=None):
+    """One page of a request_index query: ([(req_id, RequestRecord)], next
+    cursor), newest first. The cursor goes into `before` for the next page."""
+    if _shared_index:
+        return await _storage.index_page(key, before, limit, within)
+    ids, cursor = request_index.page(key, before, limit, within)
+    page = []
+    for req_id in ids:
+        req_data = await _storage.get(req_id)
+        if req_data is not None:
+            page.append((req_id, req_data))
+    return page, cursor
+
+
+async def stats_report(days=1, end=None):
+    """The /stats and digest text (stats.format_report) of `days` days up to
+    `end`.
 
+    With several workers request_stats only counts this process's changes:
+    the report is then computed from the requests with an event in the
+    period (a timestamp index query, not the whole history), off the event
+    loop, and the open counts come from the database.
+    """
+    end = end or date.today()
+    if not _shared_index:
+        return format_report(days, end)
+    first_day = (end - timedelta(days=days - 1)).isoformat()
+    entries = await _storage.stats_entries(first_day)
+    entries += await _archive.records_since(first_day)
+    summary = await asyncio.to_thread(period_summary, entries, days, end,
+                                      request_stats.retain_days)
+    keys = report_count_keys()
+    counts = dict(zip(keys, await _storage.index_counts(keys)))
+    return format_report(days, end, summary, counts)
 
-async def save_request_data(req_id, data_dict):
-    """Saves request data."""
-    data_store = _load_data()
-    req_id_str = str(req_id)
-    data_store["requests"][req_id_str] = data_dict
-    _save_data()  # Write changes to file
+
+async def export_requests(since=None,
+                          until=None,
+                          status_group=None,
+                          manager=None,
+                          chunk_size=EXPORT_CHUNK_SIZE):
+    """Async-yields lists of (req_id, RequestRecord, archived) of the whole
+    history: archived requests a segment at a time, then the working set by
+    id, in chunks of about `chunk_size`.
+
+    Filters: form date in [since, until) ("YYYY-MM-DD"), status group (see
+    request_index.STATUS_GROUPS) and claiming manager.
+    """
+    filters = {"since": since, "until": until, "manager": manager}
+    if status_group == "claimed":
+        filters["status_prefix"] = STATUS_CLAIMED_PREFIX
+    elif status_group is not None:
+        filters["status"] = STATUS_GROUP_LABELS[status_group]
+
+    # A request is archived on the day of its last update, never before its form day
+    chunk = []
+    async for records in _archive.iter_segments(since or ""):
+        for req_id, req_data in records:
+            if matches_filters(req_data, **filters):
+                chunk.append((req_id, to_record(req_data), True))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+    if STORAGE_BACKEND == "json":  # SQLite filters on its column indexes
+        candidates = _indexed_candidates(since, until, status_group, manager)
+        if candidates is not None:
+            filters["ids"] = candidates
+    async for records in _storage.scan(chunk_size, **filters):
+        yield [(req_id, req_data, False) for req_id, req_data in records]
+
+
+def _indexed_candidates(since, until, status_group, manager):
+    """Ids that can match the export filters according to request_index
+    (the intersection of their keys), or None without any filter."""
+    candidates = []
+    if status_group is not None:
+        candidates.append(set(request_index.ids(("status", status_group))))
+    if manager is not None:
+        candidates.append(set(request_index.ids(("manager", manager))))
+    if since is not None or until is not None:
+        candidates.append(request_index.ids_between("day", since, until))
+    if not candidates:
+        return None
+    return set.intersection(*sorted(candidates, key=len))
+
+
+def archive_stats():
+    return _archive.stats()
+
+
+def storage_stats():
+    write_behind = getattr(_storage, "write_behind", None)
+    return {
+        "pending_writes": write_behind.pending if write_behind else 0,
+        "batches_written": write_behind.batches_written if write_behind else 0,
+    }
+
+
+_id_lease = {"next": 0, "end": 0}  # Leased ids [next, end) not handed out yet
+_id_lease_lock = asyncio.Lock()
 
 
 async def get_next_request_id():
-    """Gets and increments the request counter."""
-    data_store = _load_data()
-    try:
-        current_id = int(data_store.get("counter", 0))
-    except (ValueError, TypeError):  # Handle if counter is corrupt
-        logging.warning(
-            f"Counter in {DATA_FILE_PATH} was not an integer. Resetting to 0.")
-        current_id = 0
-    next_id = current_id + 1
-    data_store["counter"] = next_id
-    _save_data()  # Save updated counter
-    return next_id
+    """Gets and increments the request counter.
+
+    With ID_LEASE_SIZE > 1 ids come from a block reserved in one storage
+    call, so processes sharing the storage don't contend on every request
+    (ids then are unique but not strictly in creation order across processes,
+    and unused leased ids are skipped after a restart).
+    """
+    if ID_LEASE_SIZE <= 1:
+        return await _storage.next_id()
+    async with _id_lease_lock:
+        if _id_lease["next"] >= _id_lease["end"]:
+            first_id = await _storage.allocate_ids(ID_LEASE_SIZE)
+            _id_lease["next"], _id_lease["end"] = first_id, first_id + ID_LEASE_SIZE
+        req_id = _id_lease["next"]
+        _id_lease["next"] += 1
+        return req_id
+
+
+async def allocate_request_ids(count):
+    """Reserves `count` consecutive request ids, returns the first one."""
+    return await _storage.allocate_ids(count)
 
 
 # --- Message Formatting --- (Keep format_request_message as before)
@@ -99,16 +302,33 @@ def format_request_message(req_id,
                            req_data,
                            target_status=None,
                            processed_by_name=None):
-    client_name = req_data.get('client_name', 'N/A')
-    client_phone = req_data.get('client_phone', 'N/A')
-    client_messenger = req_data.get('client_messenger', '—')
-    raw_event_details = req_data.get('raw_event_details', '')
-    form_timestamp_iso = req_data.get('form_timestamp')
-    sheet_status = req_data.get('status', STATUS_NEW)
-    claimed_by = req_data.get('claimed_by_name')
-    claimed_ts_iso = req_data.get('claimed_timestamp')
-    last_upd_by = req_data.get('last_updated_by_name')
-    last_upd_ts_iso = req_data.get('last_updated_timestamp')
+    record = to_record(req_data)
+    return format_request_header(req_id, record) + format_request_status(
+        record, target_status, processed_by_name)
+
+
+def format_request_header(req_id, record):
+    """The part of the message that only depends on the submitted form."""
+    client_name = record.get('client_name', 'N/A')
+    client_phone = record.get('client_phone', 'N/A')
+    client_messenger = record.get('client_messenger', '—')
+    raw_event_details = record.raw_event_details or ''
+    form_timestamp_iso = record.form_timestamp
+
+    events_fmt = '\n'.join([
+        f"● {c.strip()}" for c in raw_event_details.split(',')
+    ]) if raw_event_details else "N/A"
+
+    return f"<b>Заяўка #{req_id}</b>\n👤 {client_name}\n📞 {client_phone}\n📲 Tg/Viber: {client_messenger}\n\nМерапрыемства:\n{events_fmt}\n\n⏰ Заяўка ад: {format_datetime(form_timestamp_iso)}\n"
+
+
+def format_request_status(record, target_status=None, processed_by_name=None):
+    """The status lines of the message (they change as managers work on it)."""
+    sheet_status = record.status or STATUS_NEW
+    claimed_by = record.claimed_by_name
+    claimed_ts_iso = record.claimed_timestamp
+    last_upd_by = record.last_updated_by_name
+    last_upd_ts_iso = record.last_updated_timestamp
 
     current_display_status = target_status if target_status is not None else sheet_status
 
@@ -124,11 +344,7 @@ def format_request_message(req_id,
     else:
         display_status_line = current_display_status
 
-    events_fmt = '\n'.join([
-        f"● {c.strip()}" for c in raw_event_details.split(',')
-    ]) if raw_event_details else "N/A"
-
-    text = f"<b>Заяўка #{req_id}</b>\n👤 {client_name}\n📞 {client_phone}\n📲 Tg/Viber: {client_messenger}\n\nМерапрыемства:\n{events_fmt}\n\n⏰ Заяўка ад: {format_datetime(form_timestamp_iso)}\n<b>Статус: {display_status_line}</b>\n"
+    text = f"<b>Статус: {display_status_line}</b>\n"
     if claimed_by and claimed_ts_iso:
         text += f"🔑 Замацавана за: {claimed_by} ({format_datetime(claimed_ts_iso)})\n"
     if last_upd_by and last_upd_ts_iso and not (
@@ -0,0 +1,128 @@
+# webhook_pool.py
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from config import WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_DEDUP_SIZE
+
+
+def _update_chat_key(update: dict):
+    """Returns the chat an update belongs to (for ordering), or None."""
+    for field in ("message", "edited_message", "channel_post",
+                  "callback_query", "my_chat_member", "chat_member"):
+        payload = update.get(field)
+        if not payload:
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+        user = payload.get("from")
+        if user:
+            return user.get("id")
+    return None
+
+
+class PooledRequestHandler(SimpleRequestHandler):
+    """Webhook handler that answers Telegram at once and works in the background.
+
+    - updates already seen (same update_id) are acknowledged and dropped;
+    - updates of one chat are processed in arrival order, different chats
+      run concurrently;
+    - at most WEBHOOK_MAX_IN_FLIGHT updates are processed at a time; beyond
+      that the acknowledgement waits for a free slot (backpressure);
+    - `drain()` waits for everything in flight, `close()` drains but leaves
+      the bot session to on_shutdown.
+    """
+
+    def __init__(self,
+                 dispatcher: Dispatcher,
+                 bot: Bot,
+                 max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+                 dedup_size=WEBHOOK_DEDUP_SIZE,
+                 **data):
+        super().__init__(dispatcher=dispatcher,
+                         bot=bot,
+                         handle_in_background=True,
+                         **data)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._seen_update_ids = OrderedDict()
+        self._dedup_size = dedup_size
+        self._chat_tails = {}  # chat id -> last task queued for that chat
+        self._tasks = set()
+        self._closing = False
+        # Metrics
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def _is_duplicate(self, update_id):
+        if update_id is None:
+            return False
+        if update_id in self._seen_update_ids:
+            return True
+        self._seen_update_ids[update_id] = None
+        if len(self._seen_update_ids) > self._dedup_size:
+            self._seen_update_ids.popitem(last=False)
+        return False
+
+    async def _handle_request_background(self, bot: Bot,
+                                         request: web.Request):
+        if self._closing:
+            # Telegram redelivers it to the next instance
+            return web.Response(status=503, text="Shutting down")
+        update = await request.json(loads=bot.session.json_loads)
+        if self._is_duplicate(update.get("update_id")):
+            self.duplicates += 1
+            logging.info("Ignoring duplicate update %s", update.get('update_id'))
+            return web.json_response({}, dumps=bot.session.json_dumps)
+
+        await self._slots.acquire()
+        chat_key = _update_chat_key(update)
+        previous = self._chat_tails.get(chat_key) if chat_key else None
+        task = asyncio.create_task(self._process(bot, update, previous))
+        self._tasks.add(task)
+        if chat_key:
+            self._chat_tails[chat_key] = task
+        task.add_done_callback(lambda t: self._finish(t, chat_key))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _process(self, bot: Bot, update: dict, previous):
+        if previous is not None:
+            # Keep per-chat order; the previous update's outcome doesn't matter
+            await asyncio.wait([previous])
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+            self.processed += 1
+        except Exception:
+            self.failed += 1
+            logging.exception(
+                f"Error processing update {update.get('update_id')}")
+
+    def _finish(self, task, chat_key):
+        self._tasks.discard(task)
+        self._slots.release()
+        if chat_key and self._chat_tails.get(chat_key) is task:
+            del self._chat_tails[chat_key]
+
+    async def drain(self, timeout=30.0):
+        """Stops accepting updates and waits for those in flight."""
+        self._closing = True
+        if not self._tasks:
+            return
+        logging.info(f"Draining {len(self._tasks)} in-flight updates.")
+        done, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        if pending:
+            logging.warning(
+                f"{len(pending)} updates still running after {timeout}s drain.")
+
+    async def close(self):
+        # The session is closed by on_shutdown, after it used it one last time
+        await self.drain()
@@ -0,0 +1,165 @@
+# write_behind.py
+import asyncio
+import logging
+import time
+
+from config import STORAGE_FLUSH_DELAY, STORAGE_FLUSH_BATCH
+from metrics import STORAGE_WRITE_SECONDS, count_error
+
+
+class WriteBehind:
+    """Collects storage changes and writes them in batches off the event loop.
+
+    `add()` only queues a change. A background task waits STORAGE_FLUSH_DELAY
+    seconds (or until STORAGE_FLUSH_BATCH changes are queued), then calls
+    `prepare(items)` on the loop and `write(prepared)` in `executor`, so a
+    burst of N changes costs one disk write. `flush()` waits until everything
+    queued so far is on disk. `on_written(items, result)` runs on the loop
+    after each successful write.
+    """
+
+    def __init__(self,
+                 prepare,
+                 write,
+                 executor,
+                 on_written=None,
+                 delay=STORAGE_FLUSH_DELAY,
+                 batch_size=STORAGE_FLUSH_BATCH):
+        self._prepare = prepare
+        self._write = write
+        self._executor = executor
+        self._on_written = on_written
+        self._delay = delay
+        self._batch_size = batch_size
+        self._items = []
+        self._future = None  # Resolves once the queued _items are written
+        self._in_flight = None  # Future of the batch being written right now
+        self._dirty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self.batches_written = 0
+        self.items_written = 0
+
+    @property
+    def pending(self):
+        return len(self._items)
+
+    def add(self, item):
+        """Queues one change to be written with the next batch."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(
+                self._run(), name="storage-write-behind")
+        self._items.append(item)
+        if self._future is None:
+            self._future = asyncio.get_running_loop().create_future()
+            self._dirty.set()
+        if len(self._items) >= self._batch_size:
+            self._full.set()
+
+    async def flush(self):
+        """Waits until all changes queued so far have been written."""
+        future = self._future or self._in_flight
+        if self._future is not None:
+            self._full.set()  # Skip the debounce window
+        if future is not None:
+            await asyncio.shield(future)
+
+    async def close(self):
+        """Writes any pending changes and stops the background task."""
+        self._closing = True
+        if self._task is None:
+            return
+        self._dirty.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        try:
+            await self._write_batches()
+        except BaseException as e:
+            # E.g. cancelled or on_written raised: fail the flush() callers
+            # instead of leaving them waiting forever
+            self._fail_outstanding(e)
+            raise
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._dirty.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self._delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._dirty.clear()
+            self._full.clear()
+            items, future = self._items, self._future
+            self._items, self._future = [], None
+            if not items:
+                if self._closing:
+                    return
+                continue
+
+            self._in_flight = future
+            started = time.perf_counter()
+            try:
+                prepared = self._prepare(items)
+                result = await loop.run_in_executor(self._executor,
+                                                    self._write, prepared)
+                STORAGE_WRITE_SECONDS.observe(time.perf_counter() - started)
+            except Exception as e:
+                count_error("storage_write", e)
+                if self._closing:
+                    logging.exception(
+                        f"Final storage flush failed, "
+                        f"{len(items) + len(self._items)} changes lost.")
+                    self._fail_outstanding(e)
+                    return
+                logging.exception(
+                    f"Storage flush of {len(items)} changes failed, retrying.")
+                self._in_flight = None
+                # Put the batch back in front of anything queued meanwhile
+                self._items[:0] = items
+                if self._future is None:
+                    self._future = future
+                else:
+                    _chain_future(self._future, future)
+                self._dirty.set()
+                await asyncio.sleep(self._delay)
+                continue
+
+            self.batches_written += 1
+            self.items_written += len(items)
+            if self._on_written is not None:
+                self._on_written(items, result)
+            self._in_flight = None
+            future.set_result(len(items))
+            if self._closing and not self._items:
+                return
+
+    def _fail_outstanding(self, error):
+        """Fails the batch being written and everything queued after it
+        (earlier failed batches are chained to those)."""
+        for future in (self._in_flight, self._future):
+            if future is None or future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+        self._items, self._future, self._in_flight = [], None, None
+
+def _chain_future(source, target):
+    """Resolves `target` the same way as `source` once it is done."""
+
+    def _copy(done):
+        if target.done():
+            return
+        if done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+
+    source.add_done_callback(_copy)